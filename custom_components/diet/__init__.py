@@ -3,6 +3,7 @@ from homeassistant.core import HomeAssistant
 from homeassistant.config_entries import ConfigEntry
 from .const import DOMAIN, PLATFORMS
 from .db import DietDb
+from .policy import DietPolicy
 from .coordinator import DietCoordinator
 from .services import async_register_services
 from .websocket import async_register_ws
@@ -13,20 +14,32 @@ async def async_setup(hass: HomeAssistant, config: dict):
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
-    db = DietDb(hass)
+    db = DietDb(hass, DietPolicy.from_options(entry.options))
     await db.async_open()
+    await db.acl.async_reload(db)
+    await db.async_prune_history()
     coord = DietCoordinator(hass, db)
     await coord.async_initialize()
     hass.data.setdefault(DOMAIN, {})[entry.entry_id] = {"db": db, "coordinator": coord}
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
-    async_register_services(hass, db, coord)
-    async_register_ws(hass, db, coord)
+    await async_register_services(hass, db, coord)
+    await async_register_ws(hass, db, coord)
+    entry.async_on_unload(entry.add_update_listener(async_options_updated))
     return True
 
 
+async def async_options_updated(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Applica le nuove opzioni a DB, cache e sensori senza ricaricare l'entry."""
+    data = hass.data[DOMAIN][entry.entry_id]
+    await data["db"].async_apply_policy(DietPolicy.from_options(entry.options))
+    # quota/modalità esposte dai sensori
+    data["coordinator"].async_update_listeners()
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
     unloaded = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
     data = hass.data[DOMAIN].pop(entry.entry_id, None)
     if data:
+        await data["coordinator"].async_shutdown()
         await data["db"].async_close()
     return unloaded
@@ -0,0 +1,92 @@
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class AclSnapshot:
+    """Fotografia immutabile di profili e permessi."""
+
+    # ha_user_id -> profile_id
+    users: dict[str, int] = field(default_factory=dict)
+    # profile_id -> display_name (ordine di id)
+    names: dict[int, str] = field(default_factory=dict)
+    # (owner_profile_id, subject_profile_id) -> (can_read, can_write)
+    perms: dict[tuple[int, int], tuple[bool, bool]] = field(default_factory=dict)
+
+
+class AclIndex:
+    """Indice in memoria per l'autorizzazione (utente HA -> profilo, matrice ACL).
+
+    Caricato al setup (o al primo utilizzo) e ricostruito per intero dopo ogni
+    scrittura su diet_profiles/profile_acl: la nuova fotografia sostituisce la
+    precedente con un solo assegnamento, quindi i lettori non vedono mai uno
+    stato parziale.
+    """
+
+    def __init__(self) -> None:
+        self._snapshot: AclSnapshot | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    @property
+    def snapshot(self) -> AclSnapshot:
+        assert self._snapshot is not None
+        return self._snapshot
+
+    async def async_ensure_loaded(self, db) -> AclSnapshot:
+        """Carica l'indice se non ancora presente."""
+        if self._snapshot is None:
+            async with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = await self._async_build(db)
+        return self._snapshot
+
+    async def async_reload(self, db) -> AclSnapshot:
+        """Ricostruisce l'indice da SQLite (dopo il commit di una scrittura ACL)."""
+        async with self._lock:
+            self._snapshot = await self._async_build(db)
+        return self._snapshot
+
+    @staticmethod
+    async def _async_build(db) -> AclSnapshot:
+        users: dict[str, int] = {}
+        names: dict[int, str] = {}
+        perms: dict[tuple[int, int], tuple[bool, bool]] = {}
+        async with db.read() as conn:
+            async with conn.execute(
+                "SELECT id, ha_user_id, display_name FROM diet_profiles ORDER BY id"
+            ) as c:
+                async for r in c:
+                    users[r[1]] = r[0]
+                    names[r[0]] = r[2]
+            # fetchall: la matrice cresce come n², evita un round trip per riga
+            rows = await conn.execute_fetchall(
+                "SELECT owner_profile_id, subject_profile_id, can_read, can_write "
+                "FROM profile_acl"
+            )
+            for r in rows:
+                perms[(r[0], r[1])] = (bool(r[2]), bool(r[3]))
+        return AclSnapshot(users, names, perms)
+
+    def profile_id(self, ha_user_id: str | None) -> int | None:
+        return self.snapshot.users.get(ha_user_id)
+
+    def can_read(self, owner_profile_id: int, subject_profile_id: int | None) -> bool:
+        """Lettura consentita se self o ACL can_read=1."""
+        if owner_profile_id == subject_profile_id:
+            return True
+        return self.snapshot.perms.get(
+            (owner_profile_id, subject_profile_id), (False, False)
+        )[0]
+
+    def can_write(self, owner_profile_id: int, subject_profile_id: int | None) -> bool:
+        """Scrittura consentita se self o ACL can_write=1."""
+        if owner_profile_id == subject_profile_id:
+            return True
+        return self.snapshot.perms.get(
+            (owner_profile_id, subject_profile_id), (False, False)
+        )[1]
@@ -0,0 +1,298 @@
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+from homeassistant.helpers.json import json_bytes
+
+from .const import MEAL_TYPES
+
+# slot compilato: {"id", "proposed", "alternatives"} oppure None se assente
+Slot = dict[str, Any] | None
+# JSON già serializzato di uno slot: (proposed, alternatives)
+SlotJson = tuple[bytes, bytes] | None
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledTemplate:
+    """Template settimanale compilato: matrice densa 7 (dow) × MEAL_TYPES."""
+
+    template_id: int
+    rev: int | None
+    slots: tuple[tuple[Slot, ...], ...]
+    # stessa matrice, con proposed/alternatives serializzati una volta sola
+    slots_json: tuple[tuple[SlotJson, ...], ...] = ()
+
+    def day(self, dow: int) -> tuple[Slot, ...]:
+        """Slot del giorno della settimana, nell'ordine di MEAL_TYPES."""
+        return self.slots[dow]
+
+    def day_json(self, dow: int) -> tuple[SlotJson, ...]:
+        """JSON degli slot del giorno della settimana, nell'ordine di MEAL_TYPES."""
+        return self.slots_json[dow]
+
+    @classmethod
+    def from_rows(
+        cls, template_id: int, rev: int | None, rows: list[tuple]
+    ) -> CompiledTemplate:
+        """Compila le righe ``template_meals LEFT JOIN template_meal_alternatives``.
+
+        Ogni riga: (tm.id, dow, meal_type, title, proposed_items,
+        alt.id, alt.title, alt.items, alt.calories), ordinate per tm.id, alt.id.
+        A parità di (dow, meal_type) vale il primo template_meal.
+        """
+        grid: list[list[Slot]] = [[None] * len(MEAL_TYPES) for _ in range(7)]
+        index = {mt: i for i, mt in enumerate(MEAL_TYPES)}
+        for r in rows:
+            col = index.get(r[2])
+            if col is None:
+                continue
+            slot = grid[r[1]][col]
+            if slot is None:
+                slot = grid[r[1]][col] = {
+                    "id": r[0],
+                    "proposed": {"title": r[3], "items": r[4]},
+                    "alternatives": [],
+                }
+            if slot["id"] == r[0] and r[5] is not None:
+                slot["alternatives"].append(
+                    {"id": r[5], "title": r[6], "items": r[7], "calories": r[8]}
+                )
+        slots_json = tuple(
+            tuple(
+                (
+                    (json_bytes(slot["proposed"]), json_bytes(slot["alternatives"]))
+                    if slot
+                    else None
+                )
+                for slot in day
+            )
+            for day in grid
+        )
+        return cls(template_id, rev, tuple(tuple(day) for day in grid), slots_json)
+
+
+class TemplateCache:
+    """Cache in memoria dei template compilati, validata dal version stamp ``rev``.
+
+    ``week_templates.rev`` è incrementato dai trigger su template_meals e
+    template_meal_alternatives: una voce con rev diverso da quello letto da
+    SQLite è considerata scaduta.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[int, CompiledTemplate] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template_id: int, rev: int | None) -> CompiledTemplate | None:
+        """Ritorna il template compilato se presente e alla revisione indicata."""
+        entry = self._entries.get(template_id)
+        if entry is not None and entry.rev == rev:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, compiled: CompiledTemplate) -> CompiledTemplate | None:
+        """Memorizza un template compilato; ritorna la versione sostituita."""
+        previous = self._entries.get(compiled.template_id)
+        self._entries[compiled.template_id] = compiled
+        return previous
+
+    def stats(self) -> dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def invalidate(self, template_id: int | None = None) -> None:
+        """Scarta un template (o tutti se ``template_id`` è None)."""
+        if template_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(template_id, None)
+
+
+class DayCache:
+    """LRU limitata dei payload DayData già assemblati, per (profile_id, date).
+
+    I payload in cache sono condivisi tra i chiamanti e vanno trattati come
+    sola lettura. Le scritture del repository invalidano le chiavi toccate,
+    mentre i giorni costruiti su un template vengono scartati dal repository
+    quando ``week_templates.rev`` non coincide più con quello della voce;
+    ``generation`` impedisce a una lettura iniziata prima di un'invalidazione
+    di reinserire dati ormai superati. Accanto a ogni payload resta il suo
+    JSON, serializzato alla prima richiesta e riusato per tutte le connessioni.
+    """
+
+    def __init__(self, max_entries: int = 512) -> None:
+        self.max_entries = max_entries
+        # [payload, template compilato usato, {formato: JSON serializzato}]
+        self._entries: OrderedDict[tuple[int, str], list] = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.serializations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, profile_id: int, iso_date: str) -> dict | None:
+        entry = self.get_entry(profile_id, iso_date)
+        return None if entry is None else entry[0]
+
+    def get_entry(
+        self, profile_id: int, iso_date: str
+    ) -> tuple[dict, CompiledTemplate | None] | None:
+        """Payload in cache e template compilato da cui è stato costruito."""
+        entry = self._entries.get((profile_id, iso_date))
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((profile_id, iso_date))
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(
+        self,
+        profile_id: int,
+        day: dict,
+        template: CompiledTemplate | None,
+        generation: int,
+    ) -> None:
+        """Inserisce un giorno letto quando ``generation`` era quella corrente."""
+        if generation != self.generation or self.max_entries <= 0:
+            return
+        key = (profile_id, day["date"])
+        self._entries[key] = [day, template, {}]
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def resize(self, max_entries: int) -> None:
+        """Cambia la capienza; se ridotta scarta subito i giorni meno recenti."""
+        self.max_entries = max_entries
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > max(self.max_entries, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def json(
+        self,
+        profile_id: int,
+        day: dict,
+        template: CompiledTemplate | None,
+        fmt: str,
+        build: Callable[[dict, CompiledTemplate | None], bytes],
+    ) -> bytes:
+        """JSON di un payload nel formato ``fmt``, serializzato al più una volta.
+
+        ``build(day, template)`` è chiamata solo se il payload non ha ancora
+        quel JSON in cache (con il template della voce); per payload non in
+        cache (o già sostituiti) il JSON viene costruito senza memorizzarlo.
+        """
+        entry = self._entries.get((profile_id, day["date"]))
+        if entry is None or entry[0] is not day:
+            return build(day, template)
+        data = entry[2].get(fmt)
+        if data is None:
+            data = entry[2][fmt] = build(day, entry[1])
+            self.serializations += 1
+        return data
+
+    def invalidate(self, profile_id: int, dates: Iterable[str]) -> None:
+        """Scarta i giorni indicati di un profilo."""
+        self.generation += 1
+        for d in dates:
+            if self._entries.pop((profile_id, d), None) is not None:
+                self.invalidations += 1
+
+    def invalidate_template(self, template_id: int) -> None:
+        """Scarta i giorni costruiti su un template modificato."""
+        self.generation += 1
+        stale = [
+            k
+            for k, v in self._entries.items()
+            if v[1] is not None and v[1].template_id == template_id
+        ]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "serializations": self.serializations,
+        }
+
+
+class DayVersions:
+    """Version stamp monotono per (profile_id, date), per le letture condizionali.
+
+    Ogni scrittura del repository assegna ai giorni toccati il valore
+    successivo di un contatore unico; i giorni mai toccati valgono ``floor``.
+    Il contatore parte dall'istante di avvio in millisecondi, così le versioni
+    restano crescenti anche tra un riavvio e l'altro (i client rileggono
+    tutto una volta sola). Una modifica a un template, rilevata da
+    ``observe`` confrontando ``week_templates.rev`` con l'ultimo visto, alza
+    ``floor`` sopra ogni versione emessa: i giorni costruiti su template non
+    sono tracciati singolarmente.
+    """
+
+    def __init__(self, epoch: int | None = None) -> None:
+        self._clock = time.time_ns() // 1_000_000 if epoch is None else epoch
+        self.floor = self._clock
+        self._stamps: dict[tuple[int, str], int] = {}
+        # ultimo rev visto per template_id
+        self._revs: dict[int, int | None] = {}
+
+    def __len__(self) -> int:
+        return len(self._stamps)
+
+    def get(self, profile_id: int, iso_date: str) -> int:
+        return self._stamps.get((profile_id, iso_date), self.floor)
+
+    def bump(self, profile_id: int, dates: Iterable[str]) -> int:
+        """Nuova versione per i giorni indicati di un profilo."""
+        self._clock += 1
+        for d in dates:
+            self._stamps[(profile_id, d)] = self._clock
+        return self._clock
+
+    def observe(self, revs: dict[int, int | None]) -> bool:
+        """Registra i rev letti ({template_id: rev}); se uno è cambiato, bump_all."""
+        changed = False
+        for template_id, rev in revs.items():
+            if self._revs.setdefault(template_id, rev) != rev:
+                self._revs[template_id] = rev
+                changed = True
+        if changed:
+            self.bump_all()
+        return changed
+
+    def bump_all(self) -> int:
+        """Nuova versione per tutti i giorni di tutti i profili."""
+        self._clock += 1
+        self.floor = self._clock
+        self._stamps.clear()
+        return self._clock
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "tracked": len(self._stamps),
+            "templates": len(self._revs),
+            "floor": self.floor,
+            "clock": self._clock,
+        }
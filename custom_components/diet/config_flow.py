@@ -1,15 +1,53 @@
 from __future__ import annotations
 from typing import Any
+import voluptuous as vol
 from homeassistant import config_entries
-from homeassistant.core import HomeAssistant
-from .const import DOMAIN
+from homeassistant.core import HomeAssistant, callback
+from .const import (
+    CONF_DAY_CACHE_SIZE,
+    CONF_FREE_LIMIT_MODE,
+    CONF_FREE_MEALS_PER_WEEK,
+    CONF_HISTORY_RETENTION_DAYS,
+    CONF_READ_POOL_SIZE,
+    CONF_WRITE_BATCH_WINDOW_MS,
+    DEFAULTS,
+    DOMAIN,
+    FREE_LIMIT_MODES,
+)
+
+# Limiti delle opzioni: (chiave, validatore)
+OPTION_VALIDATORS = {
+    CONF_FREE_MEALS_PER_WEEK: vol.All(int, vol.Range(min=0, max=21)),
+    CONF_FREE_LIMIT_MODE: vol.In(FREE_LIMIT_MODES),
+    CONF_DAY_CACHE_SIZE: vol.All(int, vol.Range(min=0, max=10000)),
+    CONF_READ_POOL_SIZE: vol.All(int, vol.Range(min=1, max=8)),
+    CONF_HISTORY_RETENTION_DAYS: vol.All(int, vol.Range(min=0, max=3650)),
+    CONF_WRITE_BATCH_WINDOW_MS: vol.All(int, vol.Range(min=0, max=1000)),
+}
+
+
+def options_schema(current: dict[str, Any]) -> vol.Schema:
+    """Schema del form opzioni, con i valori correnti come default."""
+    return vol.Schema(
+        {
+            vol.Required(key, default=current.get(key, DEFAULTS[key])): validator
+            for key, validator in OPTION_VALIDATORS.items()
+        }
+    )
 
 
 class DietConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
-    """Config flow minimale: una sola istanza, nessuna opzione."""
+    """Config flow minimale: una sola istanza; la configurazione è nelle opzioni."""
 
     VERSION = 1
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(
+        config_entry: config_entries.ConfigEntry,
+    ) -> DietOptionsFlowHandler:
+        return DietOptionsFlowHandler(config_entry)
+
     async def async_step_user(self, user_input: dict[str, Any] | None = None):
         # Consente una sola configurazione
         existing = any(e.domain == DOMAIN for e in self._async_current_entries())
@@ -23,10 +61,21 @@ class DietConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
 
 class DietOptionsFlowHandler(config_entries.OptionsFlow):
-    """Opzioni non previste per ora (placeholder)."""
+    """Quota pasti free, modalità hard/soft, cache, pool, retention e batching.
+
+    Le opzioni salvate vengono applicate a caldo (``async_options_updated``),
+    senza ricaricare l'integrazione.
+    """
 
     def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
-        self.config_entry = config_entry
+        # da HA 2024.11 ``self.config_entry`` è fornito dal framework e non va
+        # assegnato; la versione minima supportata (2024.6) non lo fornisce
+        self._entry = config_entry
 
     async def async_step_init(self, user_input: dict[str, Any] | None = None):
-        return self.async_create_entry(title="", data={})
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        return self.async_show_form(
+            step_id="init", data_schema=options_schema(dict(self._entry.options))
+        )
@@ -2,6 +2,32 @@ DOMAIN = "diet"
 DB_FILENAME = "diet.sqlite"
 CONF_FREE_MEALS_PER_WEEK = "free_meals_per_week"
 CONF_FREE_LIMIT_MODE = "free_limit_mode"  # "hard"|"soft"
-DEFAULTS = {CONF_FREE_MEALS_PER_WEEK: 2, CONF_FREE_LIMIT_MODE: "soft"}
+CONF_DAY_CACHE_SIZE = "day_cache_size"  # giorni assemblati in LRU
+CONF_READ_POOL_SIZE = "read_pool_size"  # connessioni di sola lettura
+CONF_HISTORY_RETENTION_DAYS = "history_retention_days"  # 0 = storico illimitato
+CONF_WRITE_BATCH_WINDOW_MS = "write_batch_window_ms"  # 0 = un commit per scrittura
+FREE_LIMIT_MODES = ("soft", "hard")
+DEFAULTS = {
+    CONF_FREE_MEALS_PER_WEEK: 2,
+    CONF_FREE_LIMIT_MODE: "soft",
+    CONF_DAY_CACHE_SIZE: 512,
+    CONF_READ_POOL_SIZE: 3,
+    CONF_HISTORY_RETENTION_DAYS: 0,
+    CONF_WRITE_BATCH_WINDOW_MS: 5,
+}
 PLATFORMS = ["sensor"]
 MEAL_TYPES = ("breakfast", "lunch", "dinner", "snack_am", "snack_pm")
+MAX_RANGE_DAYS = 92  # limite diet/get_range (circa un trimestre)
+HISTORY_PAGE_SIZE = 31  # giorni per pagina di diet/get_history (default)
+MAX_HISTORY_PAGE_SIZE = MAX_RANGE_DAYS
+# diet/get_next_meals: pasti mostrati e orario nominale di ciascuno (ora locale)
+NEXT_MEAL_TIMES = {"lunch": (13, 0), "dinner": (20, 0)}
+NEXT_MEALS_GRACE_HOURS = 1  # un pasto resta "prossimo" fino a 1h dopo l'orario
+DEFAULT_HORIZON_HOURS = 36
+MAX_HORIZON_HOURS = 24 * 14
+MAX_BATCH_REQUESTS = 32  # sotto-richieste per diet/batch
+MAX_BULK_ENTRIES = (
+    500  # scelte per set_choices_bulk (giorni per set_day_bulk: MAX_RANGE_DAYS)
+)
+# Dispatcher: (profile_id, dates) toccati da una scrittura del repository
+SIGNAL_DAY_CHANGED = f"{DOMAIN}_day_changed"
@@ -1,13 +1,116 @@
 from __future__ import annotations
-from homeassistant.core import HomeAssistant
+import asyncio
+import logging
+from typing import Any, Callable
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.event import async_track_utc_time_change
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
+from .const import SIGNAL_DAY_CHANGED
 from .db import DietDb
 
+_LOGGER = logging.getLogger(__name__)
+
+# Metriche dei sensori: una query per metrica sui rollup mantenuti dai trigger
+# (daily_rollups/weekly_rollups), raggruppata per profilo.
+# {profile} è vuoto (tutti i profili) oppure "AND profile_id=?" (un profilo).
+SENSOR_QUERIES: dict[str, str] = {
+    # media mobile 7 giorni della fame (1–5)
+    "hunger_avg": """
+        SELECT profile_id, SUM(hunger_sum) * 1.0 / SUM(hunger_count)
+        FROM daily_rollups
+        WHERE date BETWEEN date('now','-6 days') AND date('now')
+          AND hunger_count > 0 {profile}
+        GROUP BY profile_id
+    """,
+    # spuntini (AM/PM) fatti oggi
+    "snacks_today": """
+        SELECT profile_id, snacks_done
+        FROM daily_rollups
+        WHERE date=date('now') {profile}
+    """,
+    # pasti FREE nella settimana ISO corrente (da lunedì)
+    "free_meals_week": """
+        SELECT profile_id, free_meals
+        FROM weekly_rollups
+        WHERE week_start=date('now', 'weekday 0', '-6 days')
+          AND free_meals > 0 {profile}
+    """,
+}
+
+
+class DietCoordinator(DataUpdateCoordinator[dict[int, dict[str, Any]]]):
+    """Calcola i valori di tutti i sensori per tutti i profili.
+
+    ``data`` è {profile_id: {"hunger_avg", "snacks_today", "free_meals_week"}}.
+    Nessun polling: le scritture del repository inviano SIGNAL_DAY_CHANGED e
+    vengono ricalcolate solo le metriche del profilo toccato; un refresh
+    completo (e la pulizia dello storico) avviene al cambio di giorno (UTC,
+    come ``date('now')``).
+    """
 
-class DietCoordinator(DataUpdateCoordinator):
     def __init__(self, hass: HomeAssistant, db: DietDb):
-        super().__init__(hass, name="diet", update_interval=None)
+        super().__init__(hass, _LOGGER, name="diet", update_interval=None)
         self.db = db
+        self._pending: set[int] = set()
+        self._pending_task: asyncio.Task | None = None
+        self._unsubs: list[Callable[[], None]] = []
 
     async def async_initialize(self):
-        return
+        await self.async_refresh()
+        self._unsubs.append(
+            async_dispatcher_connect(self.hass, SIGNAL_DAY_CHANGED, self._day_changed)
+        )
+        self._unsubs.append(
+            async_track_utc_time_change(
+                self.hass, self._day_rollover, hour=0, minute=0, second=1
+            )
+        )
+
+    async def async_shutdown(self) -> None:
+        while self._unsubs:
+            self._unsubs.pop()()
+        await super().async_shutdown()
+
+    async def _async_update_data(self) -> dict[int, dict[str, Any]]:
+        return await self._async_compute()
+
+    async def _async_compute(
+        self, profile_id: int | None = None
+    ) -> dict[int, dict[str, Any]]:
+        data: dict[int, dict[str, Any]] = {}
+        where, params = (
+            ("", ()) if profile_id is None else ("AND profile_id=?", (profile_id,))
+        )
+        async with self.db.read() as conn:
+            for metric, query in SENSOR_QUERIES.items():
+                rows = await conn.execute_fetchall(query.format(profile=where), params)
+                for pid, value in rows:
+                    data.setdefault(pid, {})[metric] = value
+        return data
+
+    @callback
+    def _day_changed(self, profile_id: int, dates: tuple[str, ...]) -> None:
+        """Accoda il ricalcolo del profilo; più scritture ravvicinate confluiscono."""
+        self._pending.add(profile_id)
+        if self._pending_task is None:
+            self._pending_task = self.hass.async_create_task(
+                self._async_refresh_pending()
+            )
+
+    async def _async_refresh_pending(self) -> None:
+        try:
+            while self._pending:
+                profile_id = self._pending.pop()
+                metrics = await self._async_compute(profile_id)
+                data = dict(self.data or {})
+                data[profile_id] = metrics.get(profile_id, {})
+                self.async_set_updated_data(data)
+        finally:
+            self._pending_task = None
+
+    @callback
+    def _day_rollover(self, _now) -> None:
+        self.hass.async_create_task(self.async_refresh())
+        # storico oltre la retention configurata (no-op se illimitata)
+        self.hass.async_create_task(self.db.async_prune_history())
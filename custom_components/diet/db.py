@@ -1,14 +1,101 @@
 from __future__ import annotations
+import asyncio
+import logging
 import os
+import pathlib
+import re
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, TypeVar
 import aiosqlite
 from homeassistant.core import HomeAssistant
+from .acl import AclIndex
+from .cache import DayCache, DayVersions, TemplateCache
 from .const import DB_FILENAME
+from .migrations import (
+    CopyRows,
+    Migration,
+    ProgressCallback,
+    Sql,
+    async_apply,
+    async_migration_history,
+    async_read_version,
+    log_progress,
+    migration_plan,
+)
+from .policy import DietPolicy
 
-SCHEMA_VERSION = 5
+_LOGGER = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 10
+
+WriteJob = Callable[[aiosqlite.Connection], Awaitable[Any]]
+_T = TypeVar("_T")
+
+# Pragmas comuni a writer e lettori
+PRAGMAS = [
+    "PRAGMA cache_size = -8000;",  # ~8 MiB di page cache per connessione
+    "PRAGMA mmap_size = 67108864;",  # 64 MiB
+    "PRAGMA temp_store = MEMORY;",
+]
 
 # -------------------------------
 # SCHEMA DI DATABASE (SQLite)
 # -------------------------------
+PLAN_DAYS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        date TEXT NOT NULL,
+        profile_id INTEGER NOT NULL,
+        template_id INTEGER NOT NULL,
+        hunger INTEGER,
+        notes TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY(profile_id, date)
+    ) WITHOUT ROWID;
+    """
+
+DAY_MEALS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        profile_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        meal_type TEXT NOT NULL CHECK(meal_type IN ('breakfast','lunch','dinner','snack_am','snack_pm')),
+        chosen_source TEXT NOT NULL CHECK(chosen_source IN ('proposed','alternative','free','skipped')),
+        chosen_title TEXT,
+        chosen_label TEXT,
+        chosen_items TEXT,
+        notes TEXT,
+        ts TEXT,
+        PRIMARY KEY(profile_id, date, meal_type)
+    ) WITHOUT ROWID;
+    """
+
+DAY_MEAL_HISTORY_TABLE = """
+    CREATE TABLE IF NOT EXISTS day_meal_history (
+        id INTEGER PRIMARY KEY,
+        profile_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        meal_type TEXT NOT NULL,
+        chosen_source TEXT NOT NULL,
+        chosen_title TEXT,
+        chosen_label TEXT,
+        chosen_items TEXT,
+        notes TEXT,
+        ts TEXT
+    );
+    """
+
+DAY_MEAL_COLUMNS = (
+    "profile_id",
+    "date",
+    "meal_type",
+    "chosen_source",
+    "chosen_title",
+    "chosen_label",
+    "chosen_items",
+    "notes",
+    "ts",
+)
+
 CREATE_BASE = [
     """
     CREATE TABLE IF NOT EXISTS meta (
@@ -46,6 +133,7 @@ CREATE_BASE = [
         name TEXT NOT NULL,
         description TEXT,
         is_active INTEGER NOT NULL DEFAULT 0,
+        rev INTEGER NOT NULL DEFAULT 0, -- version stamp per la cache dei template
         created_at TEXT NOT NULL,
         updated_at TEXT NOT NULL
     );
@@ -78,33 +166,12 @@ CREATE_BASE = [
         FOREIGN KEY(template_meal_id) REFERENCES template_meals(id)
     );
     """,
-    # Giorni pianificati
-    """
-    CREATE TABLE IF NOT EXISTS plan_days (
-        date TEXT PRIMARY KEY,
-        profile_id INTEGER NOT NULL,
-        template_id INTEGER NOT NULL,
-        hunger INTEGER,
-        notes TEXT,
-        created_at TEXT NOT NULL,
-        updated_at TEXT NOT NULL
-    );
-    """,
-    # Pasti scelti o completati
-    """
-    CREATE TABLE IF NOT EXISTS day_meals (
-        id INTEGER PRIMARY KEY,
-        profile_id INTEGER NOT NULL,
-        date TEXT NOT NULL,
-        meal_type TEXT NOT NULL CHECK(meal_type IN ('breakfast','lunch','dinner','snack_am','snack_pm')),
-        chosen_source TEXT NOT NULL CHECK(chosen_source IN ('proposed','alternative','free','skipped')),
-        chosen_title TEXT,
-        chosen_label TEXT,
-        chosen_items TEXT,
-        notes TEXT,
-        ts TEXT
-    );
-    """,
+    # Giorni pianificati (uno per profilo e data)
+    PLAN_DAYS_TABLE.format(table="plan_days"),
+    # Scelta corrente per pasto (una riga per profilo, data e meal_type)
+    DAY_MEALS_TABLE.format(table="day_meals"),
+    # Storico append-only delle scelte (alimentato da trigger su day_meals)
+    DAY_MEAL_HISTORY_TABLE,
     # Storico swap
     """
     CREATE TABLE IF NOT EXISTS swaps (
@@ -139,66 +206,595 @@ CREATE_BASE = [
         ts TEXT NOT NULL
     );
     """,
-    # Indici
+]
+
+# Indici: ogni lettura del repository e del coordinator è una SEARCH
+# (verificato da tests/test_query_plans.py). plan_days, day_meals e snacks
+# sono già indicizzati dalle rispettive chiavi (profile_id, date, ...).
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_day_meal_history_p ON day_meal_history(profile_id, date);",
+    "CREATE INDEX IF NOT EXISTS idx_free_meals_p ON free_meals(profile_id, date);",
+    "CREATE INDEX IF NOT EXISTS idx_swaps_p ON swaps(profile_id, date_from);",
+    "CREATE INDEX IF NOT EXISTS idx_week_templates_p ON week_templates(profile_id, is_active);",
+    "CREATE INDEX IF NOT EXISTS idx_template_meals_t ON template_meals(template_id, dow, meal_type);",
+    "CREATE INDEX IF NOT EXISTS idx_template_alts_tm ON template_meal_alternatives(template_meal_id);",
+]
+CREATE_BASE += INDEXES
+
+# Trigger che incrementano week_templates.rev a ogni modifica dei contenuti
+TEMPLATE_REV_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_template_meals_ins
+    AFTER INSERT ON template_meals
+    BEGIN
+        UPDATE week_templates SET rev = rev + 1 WHERE id = NEW.template_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_template_meals_upd
+    AFTER UPDATE ON template_meals
+    BEGIN
+        UPDATE week_templates SET rev = rev + 1
+        WHERE id IN (OLD.template_id, NEW.template_id);
+    END;
+    """,
     """
-    CREATE INDEX IF NOT EXISTS idx_plan_days_p ON plan_days(profile_id, date);
+    CREATE TRIGGER IF NOT EXISTS trg_template_meals_del
+    AFTER DELETE ON template_meals
+    BEGIN
+        UPDATE week_templates SET rev = rev + 1 WHERE id = OLD.template_id;
+    END;
     """,
     """
-    CREATE INDEX IF NOT EXISTS idx_day_meals_p ON day_meals(profile_id, date, meal_type);
+    CREATE TRIGGER IF NOT EXISTS trg_template_alts_ins
+    AFTER INSERT ON template_meal_alternatives
+    BEGIN
+        UPDATE week_templates SET rev = rev + 1
+        WHERE id = (SELECT template_id FROM template_meals WHERE id = NEW.template_meal_id);
+    END;
     """,
     """
-    CREATE INDEX IF NOT EXISTS idx_snacks_p ON snacks(profile_id, date, period);
+    CREATE TRIGGER IF NOT EXISTS trg_template_alts_upd
+    AFTER UPDATE ON template_meal_alternatives
+    BEGIN
+        UPDATE week_templates SET rev = rev + 1
+        WHERE id IN (
+            SELECT template_id FROM template_meals
+            WHERE id IN (OLD.template_meal_id, NEW.template_meal_id)
+        );
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_template_alts_del
+    AFTER DELETE ON template_meal_alternatives
+    BEGIN
+        UPDATE week_templates SET rev = rev + 1
+        WHERE id = (SELECT template_id FROM template_meals WHERE id = OLD.template_meal_id);
+    END;
     """,
 ]
+CREATE_BASE += TEMPLATE_REV_TRIGGERS
+
+
+def _history_trigger(event: str) -> str:
+    cols = ", ".join(DAY_MEAL_COLUMNS)
+    values = ", ".join(f"NEW.{c}" for c in DAY_MEAL_COLUMNS)
+    return f"""
+    CREATE TRIGGER IF NOT EXISTS trg_day_meals_history_{event[:3].lower()}
+    AFTER {event} ON day_meals
+    BEGIN
+        INSERT INTO day_meal_history({cols}) VALUES ({values});
+    END;
+    """
+
+
+# Ogni scrittura di una scelta (insert o upsert) finisce anche nello storico
+DAY_MEAL_HISTORY_TRIGGERS = [_history_trigger("INSERT"), _history_trigger("UPDATE")]
+CREATE_BASE += DAY_MEAL_HISTORY_TRIGGERS
+
+# -------------------------------
+# ROLLUP giornalieri/settimanali
+# -------------------------------
+# Colonne di aggregazione comuni alle due tabelle
+ROLLUP_COLUMNS = (
+    "hunger_sum",
+    "hunger_count",
+    "snacks_done",
+    "free_meals",
+    "choices_proposed",
+    "choices_alternative",
+    "choices_free",
+    "choices_skipped",
+)
+
+# periodo -> (tabella, colonna chiave, espressione della chiave su una riga {r})
+ROLLUP_PERIODS = {
+    "daily": ("daily_rollups", "date", "{r}.date"),
+    # lunedì della settimana ISO
+    "weekly": (
+        "weekly_rollups",
+        "week_start",
+        "date({r}.date, 'weekday 0', '-6 days')",
+    ),
+}
+
+# tabella sorgente -> {colonna rollup: contributo di una riga {r}}
+ROLLUP_SOURCES: dict[str, dict[str, str]] = {
+    "plan_days": {
+        "hunger_sum": "COALESCE({r}.hunger, 0)",
+        "hunger_count": "({r}.hunger IS NOT NULL)",
+    },
+    "snacks": {"snacks_done": "{r}.done"},
+    "free_meals": {"free_meals": "1"},
+    "day_meals": {
+        f"choices_{src}": f"({{r}}.chosen_source = '{src}')"
+        for src in ("proposed", "alternative", "free", "skipped")
+    },
+}
+
+
+def _rollup_tables() -> list[str]:
+    cols = ",\n".join(f"        {c} INTEGER NOT NULL DEFAULT 0" for c in ROLLUP_COLUMNS)
+    out = []
+    for table, key, _ in ROLLUP_PERIODS.values():
+        out.append(f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        profile_id INTEGER NOT NULL,
+        {key} TEXT NOT NULL,
+{cols},
+        PRIMARY KEY(profile_id, {key})
+    ) WITHOUT ROWID;
+    """)
+        # letture "tutti i profili per un giorno/settimana" (coordinator)
+        out.append(f"CREATE INDEX IF NOT EXISTS idx_{table}_{key} ON {table}({key});")
+    return out
+
+
+def _rollup_apply(source: str, row: str, sign: str) -> list[str]:
+    """Upsert dei contributi di una riga (NEW/OLD) su rollup giornaliero e settimanale."""
+    deltas = ROLLUP_SOURCES[source]
+    stmts = []
+    for table, key, key_expr in ROLLUP_PERIODS.values():
+        cols = ", ".join(deltas)
+        values = ", ".join(f"{sign}({e.format(r=row)})" for e in deltas.values())
+        sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in deltas)
+        stmts.append(
+            f"INSERT INTO {table}(profile_id, {key}, {cols}) "
+            f"VALUES ({row}.profile_id, {key_expr.format(r=row)}, {values}) "
+            f"ON CONFLICT(profile_id, {key}) DO UPDATE SET {sets};"
+        )
+    return stmts
+
+
+def _rollup_columns(source: str) -> list[str]:
+    """Colonne della tabella sorgente da cui dipendono i rollup."""
+    cols = []
+    for expr in ROLLUP_SOURCES[source].values():
+        cols += [c for c in re.findall(r"\{r\}\.(\w+)", expr) if c not in cols]
+    return cols + ["profile_id", "date"]
+
+
+def _rollup_triggers(sources: Iterable[str] = ROLLUP_SOURCES) -> list[str]:
+    """Trigger che mantengono i rollup nella stessa transazione della scrittura.
+
+    Il trigger di UPDATE scatta solo sulle colonne che entrano nei rollup:
+    aggiornare le altre (notes, ts, ...) non ricalcola nulla.
+    """
+    out = []
+    for source in sources:
+        events = {
+            "ins": ("INSERT", _rollup_apply(source, "NEW", "+")),
+            "del": ("DELETE", _rollup_apply(source, "OLD", "-")),
+            "upd": (
+                f"UPDATE OF {', '.join(_rollup_columns(source))}",
+                _rollup_apply(source, "OLD", "-") + _rollup_apply(source, "NEW", "+"),
+            ),
+        }
+        for suffix, (event, body) in events.items():
+            stmts = "\n        ".join(body)
+            out.append(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_{source}_{suffix}
+    AFTER {event} ON {source}
+    BEGIN
+        {stmts}
+    END;
+    """)
+    return out
+
+
+def rollup_rebuild_statements() -> list[str]:
+    """Svuota e ricalcola i rollup dalle tabelle sorgente (backfill)."""
+    out = []
+    for table, _, _ in ROLLUP_PERIODS.values():
+        out.append(f"DELETE FROM {table};")
+    for source, deltas in ROLLUP_SOURCES.items():
+        for table, key, key_expr in ROLLUP_PERIODS.values():
+            cols = ", ".join(deltas)
+            sums = ", ".join(f"SUM({e.format(r=source)})" for e in deltas.values())
+            sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in deltas)
+            # "WHERE true": evita l'ambiguità di parsing tra SELECT e ON CONFLICT
+            out.append(
+                f"INSERT INTO {table}(profile_id, {key}, {cols}) "
+                f"SELECT profile_id, {key_expr.format(r=source)}, {sums} "
+                f"FROM {source} WHERE true GROUP BY 1, 2 "
+                f"ON CONFLICT(profile_id, {key}) DO UPDATE SET {sets};"
+            )
+    return out
+
+
+ROLLUP_SCHEMA = _rollup_tables() + _rollup_triggers()
+CREATE_BASE += ROLLUP_SCHEMA
+
+# Migrazioni incrementali: versione di destinazione -> statement
+PLAN_DAYS_COLUMNS = (
+    "date",
+    "profile_id",
+    "template_id",
+    "hunger",
+    "notes",
+    "created_at",
+    "updated_at",
+)
+
+# Registro ordinato delle migrazioni: ciascuna porta lo schema da version-1
+# a version in un'unica transazione. Le riscritture di tabelle grandi usano
+# CopyRows (a chunk, con avanzamento).
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(
+        6,
+        "version stamp rev su week_templates",
+        [
+            Sql(
+                [
+                    "ALTER TABLE week_templates ADD COLUMN rev INTEGER NOT NULL DEFAULT 0;",
+                    *TEMPLATE_REV_TRIGGERS,
+                ]
+            )
+        ],
+    ),
+    Migration(
+        7,
+        "rollup giornalieri e settimanali",
+        [Sql(ROLLUP_SCHEMA), Sql(rollup_rebuild_statements())],
+    ),
+    Migration(
+        8,
+        "plan_days con chiave (profile_id, date) e indici mancanti",
+        [
+            Sql([PLAN_DAYS_TABLE.format(table="plan_days_v8")]),
+            # (profile_id, date) è univoca anche nel vecchio schema (date PK)
+            CopyRows(
+                "plan_days", "plan_days_v8", PLAN_DAYS_COLUMNS, ("profile_id", "date")
+            ),
+            Sql(
+                [
+                    # elimina anche idx_plan_days_p e i trigger dei rollup su plan_days
+                    "DROP TABLE plan_days;",
+                    "ALTER TABLE plan_days_v8 RENAME TO plan_days;",
+                    *_rollup_triggers(["plan_days"]),
+                    # ridondante con UNIQUE(profile_id, date, period)
+                    "DROP INDEX IF EXISTS idx_snacks_p;",
+                    # indici della v8 (elenco fisso: INDEXES segue lo schema corrente)
+                    "CREATE INDEX IF NOT EXISTS idx_day_meals_p ON day_meals(profile_id, date, meal_type);",
+                    "CREATE INDEX IF NOT EXISTS idx_free_meals_p ON free_meals(profile_id, date);",
+                    "CREATE INDEX IF NOT EXISTS idx_swaps_p ON swaps(profile_id, date_from);",
+                    "CREATE INDEX IF NOT EXISTS idx_week_templates_p ON week_templates(profile_id, is_active);",
+                    "CREATE INDEX IF NOT EXISTS idx_template_meals_t ON template_meals(template_id, dow, meal_type);",
+                    "CREATE INDEX IF NOT EXISTS idx_template_alts_tm ON template_meal_alternatives(template_meal_id);",
+                ]
+            ),
+        ],
+    ),
+    Migration(
+        9,
+        "scelta corrente in day_meals e storico in day_meal_history",
+        [
+            Sql(
+                [
+                    DAY_MEAL_HISTORY_TABLE,
+                    DAY_MEALS_TABLE.format(table="day_meals_v9"),
+                ]
+            ),
+            # tutte le righe accumulate diventano storico (stesso id, stesso ordine)
+            CopyRows(
+                "day_meals", "day_meal_history", ("id", *DAY_MEAL_COLUMNS), ("id",)
+            ),
+            Sql(
+                [
+                    # scelta corrente: l'ultima registrata per ogni slot
+                    f"""
+                    INSERT INTO day_meals_v9({", ".join(DAY_MEAL_COLUMNS)})
+                    SELECT {", ".join(DAY_MEAL_COLUMNS)} FROM day_meals
+                    WHERE id IN (
+                        SELECT MAX(id) FROM day_meals
+                        GROUP BY profile_id, date, meal_type
+                    );
+                    """,
+                    # elimina anche idx_day_meals_p e i trigger dei rollup su day_meals
+                    "DROP TABLE day_meals;",
+                    "ALTER TABLE day_meals_v9 RENAME TO day_meals;",
+                    *_rollup_triggers(["day_meals"]),
+                    *DAY_MEAL_HISTORY_TRIGGERS,
+                    *INDEXES,
+                    # un solo pasto free per slot, e solo se la scelta corrente è free
+                    """
+                    DELETE FROM free_meals
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM day_meals d
+                        WHERE d.profile_id = free_meals.profile_id
+                          AND d.date = free_meals.date
+                          AND d.meal_type = free_meals.meal_type
+                          AND d.chosen_source = 'free'
+                    )
+                    OR id NOT IN (
+                        SELECT MAX(id) FROM free_meals
+                        GROUP BY profile_id, date, meal_type
+                    );
+                    """,
+                    # choices_* e free_meals contano ora solo le scelte correnti
+                    *rollup_rebuild_statements(),
+                ]
+            ),
+        ],
+    ),
+    Migration(
+        10,
+        "trigger UPDATE dei rollup limitati alle colonne aggregate",
+        [
+            Sql(
+                [
+                    *(
+                        f"DROP TRIGGER IF EXISTS trg_rollup_{source}_upd;"
+                        for source in ROLLUP_SOURCES
+                    ),
+                    *_rollup_triggers(),
+                ]
+            )
+        ],
+    ),
+)
 
 
 class DietDb:
     """Gestione connessione SQLite + migrazioni."""
 
-    def __init__(self, hass: HomeAssistant):
+    def __init__(self, hass: HomeAssistant, policy: DietPolicy | None = None):
         self._hass = hass
         self._conn: aiosqlite.Connection | None = None
+        self.policy = policy or DietPolicy()
+        self._path: str | None = None
+        # Connessioni di sola lettura affiancate al writer (WAL: i lettori non
+        # attendono le scritture in corso).
+        self._readers: list[aiosqlite.Connection] = []
+        self._pool: asyncio.Queue[aiosqlite.Connection] | None = None
+        # Finestra (secondi) in cui le scritture concorrenti confluiscono in
+        # un'unica transazione/commit. None => un commit per scrittura.
+        self.write_batch_window = self.policy.write_batch_window
+        self._write_lock = asyncio.Lock()
+        self._write_queue: list[tuple[WriteJob, asyncio.Future]] = []
+        self._flush_task: asyncio.Task | None = None
+        self.write_stats = {"writes": 0, "commits": 0, "failed": 0}
+        # avanzamento delle migrazioni eseguite in async_open (default: nel log)
+        self.migration_progress: ProgressCallback | None = log_progress
+        # condivisa da tutte le istanze DietRepo costruite su questo DB
+        self.templates = TemplateCache()
+        self.days = DayCache(self.policy.day_cache_size)
+        self.versions = DayVersions()
+        self.acl = AclIndex()
+
+    @property
+    def hass(self) -> HomeAssistant:
+        return self._hass
 
     @property
     def conn(self) -> aiosqlite.Connection:
+        """Connessione writer (unica)."""
         assert self._conn is not None
         return self._conn
 
+    @property
+    def readers(self) -> tuple[aiosqlite.Connection, ...]:
+        """Connessioni di sola lettura del pool."""
+        return tuple(self._readers)
+
     async def async_open(self):
-        """Apre il database e applica le migrazioni."""
+        """Apre il database (WAL), applica le migrazioni e avvia il pool di lettura."""
         path = os.path.join(self._hass.config.path(".storage"), DB_FILENAME)
         os.makedirs(os.path.dirname(path), exist_ok=True)
         self._conn = await aiosqlite.connect(path)
+        await self._conn.execute("PRAGMA journal_mode = WAL;")
+        # In WAL, NORMAL è durabile ai crash applicativi e risparmia un fsync per commit
+        await self._conn.execute("PRAGMA synchronous = NORMAL;")
         await self._conn.execute("PRAGMA foreign_keys = ON;")
+        for pragma in PRAGMAS:
+            await self._conn.execute(pragma)
         await self._migrate()
 
-    async def _migrate(self):
-        """Esegue la creazione o aggiornamento schema."""
+        self._path = path
+        self._pool = asyncio.Queue()
+        await self._resize_pool(self.policy.read_pool_size)
+
+    async def _resize_pool(self, size: int) -> None:
+        """Apre o chiude lettori fino ad averne ``size``.
+
+        Un lettore da chiudere viene prima ritirato dal pool, quindi le
+        letture in corso terminano sulla connessione che hanno in prestito.
+        """
+        assert self._pool is not None
+        # almeno un lettore: sul writer le letture vedrebbero le scritture non
+        # ancora confermate della transazione di gruppo (e le metterebbero in cache)
+        size = max(size, 1)
+        while len(self._readers) < size:
+            # percorso codificato nell'URI: ?, # e % nella config dir non sono separatori
+            uri = f"{pathlib.Path(self._path).as_uri()}?mode=ro"
+            reader = await aiosqlite.connect(uri, uri=True)
+            await reader.execute("PRAGMA query_only = ON;")
+            for pragma in PRAGMAS:
+                await reader.execute(pragma)
+            self._readers.append(reader)
+            self._pool.put_nowait(reader)
+        while len(self._readers) > size:
+            reader = await self._pool.get()
+            self._readers.remove(reader)
+            await reader.close()
+
+    async def async_apply_policy(self, policy: DietPolicy) -> None:
+        """Applica a caldo una nuova policy (opzioni cambiate), senza riaprire il DB."""
+        previous, self.policy = self.policy, policy
+        self.write_batch_window = policy.write_batch_window
+        self.days.resize(policy.day_cache_size)
+        if self._pool is not None:
+            await self._resize_pool(policy.read_pool_size)
+        if policy.history_retention_days != previous.history_retention_days:
+            await self.async_prune_history()
+
+    async def async_prune_history(self) -> int:
+        """Elimina lo storico (day_meal_history, swaps) oltre la finestra di retention.
+
+        Ritorna le righe eliminate; con ``history_retention_days`` a 0 lo
+        storico è conservato per intero.
+        """
+        days = self.policy.history_retention_days
+        if days <= 0:
+            return 0
+        cutoff = f"-{days} days"
+
+        async def _write(conn):
+            deleted = 0
+            for stmt in (
+                "DELETE FROM day_meal_history WHERE date < date('now', ?)",
+                "DELETE FROM swaps WHERE date_from < date('now', ?)",
+            ):
+                async with conn.execute(stmt, (cutoff,)) as c:
+                    deleted += c.rowcount
+            return deleted
+
+        return await self.async_write(_write)
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Presta una connessione di sola lettura (o il writer se il pool è vuoto)."""
+        if self._pool is None or not self._readers:
+            yield self.conn
+            return
+        reader = await self._pool.get()
         try:
-            async with self._conn.execute(
-                "SELECT value FROM meta WHERE key='schema_version'"
-            ) as c:
-                row = await c.fetchone()
-            current = int(row[0]) if row else 0
-        except Exception:
-            current = 0
+            yield reader
+        finally:
+            self._pool.put_nowait(reader)
+
+    async def async_write(
+        self, job: Callable[[aiosqlite.Connection], Awaitable[_T]]
+    ) -> _T:
+        """Esegue ``job(conn)`` sul writer dentro una transazione condivisa.
 
+        Le scritture arrivate entro ``write_batch_window`` vengono raggruppate in
+        un unico commit; ogni job gira in un proprio SAVEPOINT, quindi un errore
+        annulla solo quel job e viene rilanciato al solo chiamante. Il risultato
+        del job è restituito dopo il commit comune.
+        """
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        if self.write_batch_window is None:
+            await self._run_batch([(job, fut)])
+            return fut.result()
+
+        self._write_queue.append((job, fut))
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(
+                self._flush_later()
+            )
+        return await fut
+
+    async def _flush_later(self) -> None:
+        """Attende la finestra di batching e scarica la coda."""
+        try:
+            await asyncio.sleep(self.write_batch_window or 0)
+        finally:
+            self._flush_task = None
+        batch, self._write_queue = self._write_queue, []
+        await self._run_batch(batch)
+
+    async def _run_batch(self, batch: list[tuple[WriteJob, asyncio.Future]]) -> None:
+        """Applica i job in una transazione unica e risolve i future dopo il commit."""
+        if not batch:
+            return
+        conn = self.conn
+        done: list[tuple[asyncio.Future, Any]] = []
+        async with self._write_lock:
+            try:
+                if not conn.in_transaction:
+                    await conn.execute("BEGIN")
+                for i, (job, fut) in enumerate(batch):
+                    await conn.execute(f"SAVEPOINT w{i}")
+                    try:
+                        result = await job(conn)
+                    except Exception as err:  # isolamento per singolo chiamante
+                        await conn.execute(f"ROLLBACK TO w{i}")
+                        await conn.execute(f"RELEASE w{i}")
+                        self.write_stats["failed"] += 1
+                        if not fut.done():
+                            fut.set_exception(err)
+                        continue
+                    await conn.execute(f"RELEASE w{i}")
+                    done.append((fut, result))
+                await conn.commit()
+            except Exception as err:
+                # errore della transazione (BEGIN/SAVEPOINT/RELEASE/COMMIT):
+                # falliscono tutti i job del gruppo non ancora risolti
+                if conn.in_transaction:
+                    await conn.rollback()
+                failed = [fut for _, fut in batch if not fut.done()]
+                for fut in failed:
+                    fut.set_exception(err)
+                self.write_stats["failed"] += len(failed)
+                return
+            self.write_stats["commits"] += 1
+            self.write_stats["writes"] += len(done)
+        for fut, result in done:
+            if not fut.done():
+                fut.set_result(result)
+
+    async def _migrate(self):
+        """Crea lo schema o applica in ordine le migrazioni mancanti."""
+        current = await async_read_version(self._conn)
         if current == 0:
-            for stmt in CREATE_BASE:
-                await self._conn.executescript(stmt)
-            await self._conn.execute(
-                "INSERT OR REPLACE INTO meta(key,value) VALUES('schema_version', ?)",
-                (str(SCHEMA_VERSION),),
+            plan = [Migration(SCHEMA_VERSION, "schema iniziale", [Sql(CREATE_BASE)])]
+        elif current > SCHEMA_VERSION:
+            _LOGGER.warning(
+                "Schema diet v%s più recente di quello supportato (v%s)",
+                current,
+                SCHEMA_VERSION,
             )
-            await self._conn.commit()
             return
+        else:
+            plan = migration_plan(MIGRATIONS, current, SCHEMA_VERSION)
+        for migration in plan:
+            await async_apply(self._conn, migration, self.migration_progress)
+
+    async def async_migration_history(self) -> dict[int, dict]:
+        """Durata e righe copiate delle migrazioni applicate (da meta)."""
+        async with self.read() as conn:
+            return await async_migration_history(conn)
+
+    async def async_rebuild_rollups(self) -> None:
+        """Ricostruisce daily_rollups/weekly_rollups dalle tabelle sorgente."""
+
+        async def _write(conn):
+            for stmt in rollup_rebuild_statements():
+                await conn.execute(stmt)
 
-        # future migrations (incrementali)
-        # while current < SCHEMA_VERSION:
-        #     apply migration steps...
+        await self.async_write(_write)
 
     async def async_close(self):
-        """Chiude la connessione al DB."""
+        """Scarica le scritture in coda e chiude le connessioni al DB."""
+        if self._flush_task is not None:
+            await self._flush_task
+        async with self._write_lock:
+            pass
+        for reader in self._readers:
+            await reader.close()
+        self._readers = []
+        self._pool = None
         if self._conn:
             await self._conn.close()
             self._conn = None
@@ -0,0 +1,22 @@
+from __future__ import annotations
+from dataclasses import asdict
+from typing import Any
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> dict[str, Any]:
+    """Policy, contatori di cache e scritture e tempi delle migrazioni per la diagnostica di HA."""
+    db = hass.data[DOMAIN][entry.entry_id]["db"]
+    return {
+        "policy": asdict(db.policy),
+        "day_cache": db.days.stats(),
+        "template_cache": db.templates.stats(),
+        "day_versions": db.versions.stats(),
+        "writes": dict(db.write_stats),
+        "migrations": await db.async_migration_history(),
+    }
@@ -0,0 +1,232 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Sequence
+import aiosqlite
+
+_LOGGER = logging.getLogger(__name__)
+
+# righe copiate per chunk nelle riscritture di tabelle
+DEFAULT_CHUNK_SIZE = 5000
+
+META_SCHEMA_VERSION = "schema_version"
+
+
+class MigrationError(Exception):
+    """Migrazione fallita: la versione in corso è stata annullata."""
+
+
+@dataclass(frozen=True, slots=True)
+class MigrationProgress:
+    """Avanzamento di una migrazione, passato alla callback ``progress``."""
+
+    version: int
+    description: str
+    step: int  # 1-based
+    steps: int
+    rows: int = 0
+    total_rows: int = 0
+    # tabella sorgente del passo CopyRows ("" per i passi Sql)
+    table: str = ""
+
+
+ProgressCallback = Callable[[MigrationProgress], None]
+Report = Callable[[int, int], None]
+
+
+@dataclass(frozen=True, slots=True)
+class Sql:
+    """Passo di migrazione: statement SQL singoli, eseguiti in ordine."""
+
+    statements: Sequence[str]
+
+    async def run(self, conn: aiosqlite.Connection, report: Report) -> int:
+        for stmt in self.statements:
+            await conn.execute(stmt)
+        return 0
+
+
+@dataclass(frozen=True, slots=True)
+class CopyRows:
+    """Passo di migrazione: copia ``source`` in ``target`` a chunk.
+
+    Paginazione keyset su ``key`` (colonne univoche in ``source``): ogni chunk
+    è una SELECT limitata + ``executemany``, e tra un chunk e l'altro il
+    controllo torna all'event loop.
+    """
+
+    source: str
+    target: str
+    columns: Sequence[str]
+    key: Sequence[str]
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+
+    async def run(self, conn: aiosqlite.Connection, report: Report) -> int:
+        cols = ", ".join(self.columns)
+        key = ", ".join(self.key)
+        key_pos = [list(self.columns).index(k) for k in self.key]
+        marks = ", ".join("?" for _ in self.columns)
+        async with conn.execute(f"SELECT COUNT(*) FROM {self.source}") as c:
+            total = (await c.fetchone())[0]
+
+        copied = 0
+        last: tuple | None = None
+        while True:
+            if last is None:
+                rows = await conn.execute_fetchall(
+                    f"SELECT {cols} FROM {self.source} ORDER BY {key} LIMIT ?",
+                    (self.chunk_size,),
+                )
+            else:
+                rows = await conn.execute_fetchall(
+                    f"SELECT {cols} FROM {self.source} "
+                    f"WHERE ({key}) > ({', '.join('?' for _ in self.key)}) "
+                    f"ORDER BY {key} LIMIT ?",
+                    (*last, self.chunk_size),
+                )
+            if not rows:
+                break
+            await conn.executemany(
+                f"INSERT INTO {self.target}({cols}) VALUES ({marks})", rows
+            )
+            copied += len(rows)
+            last = tuple(rows[-1][i] for i in key_pos)
+            report(copied, total)
+            await asyncio.sleep(0)
+        return copied
+
+
+Step = Sql | CopyRows
+
+
+def log_progress(progress: MigrationProgress) -> None:
+    """Callback predefinita: registra nel log ogni chunk copiato."""
+    if not progress.total_rows:
+        return
+    _LOGGER.info(
+        "Migrazione schema diet v%s (passo %s/%s): %s, %s/%s righe copiate",
+        progress.version,
+        progress.step,
+        progress.steps,
+        progress.table,
+        progress.rows,
+        progress.total_rows,
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class Migration:
+    """Passaggio dello schema a ``version``, applicato in un'unica transazione."""
+
+    version: int
+    description: str
+    steps: Sequence[Step]
+
+
+def migration_plan(
+    registry: Sequence[Migration], current: int, target: int
+) -> list[Migration]:
+    """Migrazioni da applicare per passare da ``current`` a ``target``.
+
+    Il registro deve essere ordinato e senza buchi da ``current + 1`` a ``target``.
+    """
+    versions = [m.version for m in registry]
+    if versions != sorted(set(versions)):
+        raise MigrationError(f"Registro migrazioni non ordinato: {versions}")
+    plan = [m for m in registry if current < m.version <= target]
+    if [m.version for m in plan] != list(range(current + 1, target + 1)):
+        raise MigrationError(
+            f"Nessun percorso di migrazione dalla versione {current} alla {target}"
+        )
+    return plan
+
+
+async def async_read_version(conn: aiosqlite.Connection) -> int:
+    """Versione dello schema registrata in meta (0 se database nuovo)."""
+    try:
+        async with conn.execute(
+            "SELECT value FROM meta WHERE key=?", (META_SCHEMA_VERSION,)
+        ) as c:
+            row = await c.fetchone()
+    except aiosqlite.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+
+async def async_apply(
+    conn: aiosqlite.Connection,
+    migration: Migration,
+    progress: ProgressCallback | None = None,
+) -> dict:
+    """Applica una migrazione in transazione e registra versione e tempi in meta.
+
+    In caso di errore la transazione è annullata e viene sollevato MigrationError.
+    """
+    steps = len(migration.steps)
+
+    def _reporter(step: int, table: str) -> Report:
+        def _report(rows: int, total: int) -> None:
+            if progress is not None:
+                progress(
+                    MigrationProgress(
+                        migration.version,
+                        migration.description,
+                        step,
+                        steps,
+                        rows,
+                        total,
+                        table,
+                    )
+                )
+
+        return _report
+
+    _LOGGER.info(
+        "Migrazione schema diet v%s: %s", migration.version, migration.description
+    )
+    started = time.monotonic()
+    rows = 0
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        for i, step in enumerate(migration.steps, start=1):
+            report = _reporter(i, step.source if isinstance(step, CopyRows) else "")
+            report(0, 0)
+            rows += await step.run(conn, report)
+        stats = {
+            "description": migration.description,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+            "rows": rows,
+            "applied_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+        await conn.execute(
+            "INSERT OR REPLACE INTO meta(key,value) VALUES(?, ?)",
+            (META_SCHEMA_VERSION, str(migration.version)),
+        )
+        await conn.execute(
+            "INSERT OR REPLACE INTO meta(key,value) VALUES(?, ?)",
+            (f"migration.{migration.version}", json.dumps(stats)),
+        )
+        await conn.commit()
+    except Exception as err:
+        await conn.rollback()
+        raise MigrationError(
+            f"Migrazione alla versione {migration.version} fallita: {err}"
+        ) from err
+    _LOGGER.info(
+        "Migrazione schema diet v%s completata in %s ms (%s righe copiate)",
+        migration.version,
+        stats["duration_ms"],
+        rows,
+    )
+    return stats
+
+
+async def async_migration_history(conn: aiosqlite.Connection) -> dict[int, dict]:
+    """Tempi delle migrazioni applicate, letti da meta."""
+    rows = await conn.execute_fetchall(
+        "SELECT key, value FROM meta WHERE key LIKE 'migration.%'"
+    )
+    return {int(k.split(".", 1)[1]): json.loads(v) for k, v in rows}
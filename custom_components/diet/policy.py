@@ -0,0 +1,49 @@
+from __future__ import annotations
+from dataclasses import dataclass, fields
+from typing import Any, Mapping
+from .const import (
+    CONF_DAY_CACHE_SIZE,
+    CONF_FREE_LIMIT_MODE,
+    CONF_FREE_MEALS_PER_WEEK,
+    CONF_HISTORY_RETENTION_DAYS,
+    CONF_READ_POOL_SIZE,
+    CONF_WRITE_BATCH_WINDOW_MS,
+    DEFAULTS,
+)
+
+
+@dataclass(frozen=True, slots=True)
+class DietPolicy:
+    """Opzioni della config entry materializzate una volta sola.
+
+    Servizi, repository e sensori leggono ``db.policy`` senza consultare
+    la config entry; un cambio di opzioni sostituisce l'intero oggetto.
+    I nomi dei campi coincidono con le chiavi delle opzioni.
+    """
+
+    free_meals_per_week: int = DEFAULTS[CONF_FREE_MEALS_PER_WEEK]
+    free_limit_mode: str = DEFAULTS[CONF_FREE_LIMIT_MODE]
+    day_cache_size: int = DEFAULTS[CONF_DAY_CACHE_SIZE]
+    read_pool_size: int = DEFAULTS[CONF_READ_POOL_SIZE]
+    history_retention_days: int = DEFAULTS[CONF_HISTORY_RETENTION_DAYS]
+    write_batch_window_ms: int = DEFAULTS[CONF_WRITE_BATCH_WINDOW_MS]
+
+    @classmethod
+    def from_options(cls, options: Mapping[str, Any]) -> DietPolicy:
+        """Policy da ``entry.options``; chiavi mancanti o sconosciute ignorate."""
+        return cls(
+            **{f.name: options[f.name] for f in fields(cls) if f.name in options}
+        )
+
+    @property
+    def hard_free_quota(self) -> int | None:
+        """Quota settimanale di pasti free da imporre (None in modalità soft)."""
+        return self.free_meals_per_week if self.free_limit_mode == "hard" else None
+
+    @property
+    def write_batch_window(self) -> float | None:
+        """Finestra di batching in secondi per DietDb (None => nessun batching)."""
+        return self.write_batch_window_ms / 1000 if self.write_batch_window_ms else None
+
+    def free_meals_remaining(self, used: int) -> int:
+        return max(self.free_meals_per_week - used, 0)
@@ -1,14 +1,15 @@
 from __future__ import annotations
+import json
 from typing import Dict, Tuple, List
 from homeassistant.core import HomeAssistant
 
 
-async def _existing_profiles(db) -> Dict[str, Tuple[int, str]]:
+async def _existing_profiles(conn) -> Dict[str, Tuple[int, str]]:
     """
     Ritorna mappa ha_user_id -> (profile_id, display_name) per i profili già presenti.
     """
     out: Dict[str, Tuple[int, str]] = {}
-    async with db.conn.execute(
+    async with conn.execute(
         "SELECT id, ha_user_id, display_name FROM diet_profiles"
     ) as c:
         async for row in c:
@@ -16,40 +17,6 @@ async def _existing_profiles(db) -> Dict[str, Tuple[int, str]]:
     return out
 
 
-async def _ensure_profile(db, ha_user_id: str, display_name: str) -> int:
-    """
-    Inserisce o aggiorna un profilo e ritorna il profile_id.
-    """
-    # prova fetch
-    async with db.conn.execute(
-        "SELECT id, display_name FROM diet_profiles WHERE ha_user_id=?",
-        (ha_user_id,),
-    ) as c:
-        row = await c.fetchone()
-
-    if row:
-        pid, current_name = row
-        if current_name != display_name:
-            await db.conn.execute(
-                "UPDATE diet_profiles SET display_name=?, created_at=created_at WHERE id=?",
-                (display_name, pid),
-            )
-        return pid
-
-    # insert
-    await db.conn.execute(
-        "INSERT INTO diet_profiles(ha_user_id, display_name, created_at) "
-        "VALUES(?,?, datetime('now'))",
-        (ha_user_id, display_name),
-    )
-    async with db.conn.execute(
-        "SELECT id FROM diet_profiles WHERE ha_user_id=?",
-        (ha_user_id,),
-    ) as c2:
-        row2 = await c2.fetchone()
-    return int(row2[0])
-
-
 async def _prune_missing(db, present_ha_ids: List[str]) -> None:
     """
     (Opzionale) Rimuove profili che non hanno più un corrispondente utente HA.
@@ -60,42 +27,94 @@ async def _prune_missing(db, present_ha_ids: List[str]) -> None:
     return
 
 
-async def _ensure_cross_read_acl(db, profile_ids: List[int]) -> None:
+async def _apply_profiles(
+    conn, wanted: Dict[str, str], summary: Dict[str, int]
+) -> List[int]:
+    """
+    Allinea diet_profiles a ``wanted`` (ha_user_id -> display_name) applicando solo
+    il diff: insert dei mancanti e update dei nomi cambiati. Ritorna i profile_id.
+    """
+    existing = await _existing_profiles(conn)
+    to_insert = [(uid, name) for uid, name in wanted.items() if uid not in existing]
+    to_rename = [
+        (name, existing[uid][0])
+        for uid, name in wanted.items()
+        if uid in existing and existing[uid][1] != name
+    ]
+    if to_insert:
+        await conn.executemany(
+            "INSERT INTO diet_profiles(ha_user_id, display_name, created_at) "
+            "VALUES(?,?, datetime('now'))",
+            to_insert,
+        )
+        existing = await _existing_profiles(conn)
+    if to_rename:
+        await conn.executemany(
+            "UPDATE diet_profiles SET display_name=? WHERE id=?", to_rename
+        )
+    summary["profiles_created"] = len(to_insert)
+    summary["profiles_renamed"] = len(to_rename)
+    return [existing[uid][0] for uid in wanted]
+
+
+async def _apply_cross_read_acl(
+    conn, profile_ids: List[int], summary: Dict[str, int]
+) -> None:
     """
     Imposta ACL di default: tra profili diversi => can_read=1, can_write=0.
     Non crea righe self->self (self handled a livello logico).
+    Il diff con profile_acl è calcolato in memoria; le coppie mancanti sono
+    inserite con un'unica INSERT ... SELECT, quelle difformi aggiornate in blocco.
     """
-    for owner in profile_ids:
-        for subject in profile_ids:
-            if owner == subject:
-                continue
-            # INSERT OR IGNORE; poi eventuale update per normalizzare flags
-            await db.conn.execute(
-                "INSERT OR IGNORE INTO profile_acl(owner_profile_id, subject_profile_id, can_read, can_write) "
-                "VALUES(?, ?, 1, 0)",
-                (owner, subject),
-            )
-            # Forza policy a (1,0) se già esiste ma diversa
-            await db.conn.execute(
-                "UPDATE profile_acl SET can_read=1, can_write=0 "
-                "WHERE owner_profile_id=? AND subject_profile_id=?",
-                (owner, subject),
-            )
-
-
-async def sync_profiles_from_ha(
+    ids = set(profile_ids)
+    current: Dict[Tuple[int, int], Tuple[int, int]] = {}
+    # fetchall: un solo passaggio sul thread di aiosqlite anche con n² righe
+    rows = await conn.execute_fetchall(
+        "SELECT owner_profile_id, subject_profile_id, can_read, can_write FROM profile_acl"
+    )
+    for r in rows:
+        if r[0] != r[1] and r[0] in ids and r[1] in ids:
+            current[(r[0], r[1])] = (r[2], r[3])
+
+    missing = len(ids) * (len(ids) - 1) - len(current)
+    to_fix = [pair for pair, flags in current.items() if flags != (1, 0)]
+
+    if missing:
+        await conn.execute(
+            """
+            INSERT OR IGNORE INTO profile_acl(owner_profile_id, subject_profile_id, can_read, can_write)
+            SELECT o.value, s.value, 1, 0
+            FROM json_each(?) AS o, json_each(?) AS s
+            WHERE o.value != s.value
+            """,
+            (json.dumps(sorted(ids)), json.dumps(sorted(ids))),
+        )
+    if to_fix:
+        # Forza policy a (1,0) dove già esiste ma diversa
+        await conn.executemany(
+            "UPDATE profile_acl SET can_read=1, can_write=0 "
+            "WHERE owner_profile_id=? AND subject_profile_id=?",
+            to_fix,
+        )
+    summary["acl_created"] = missing
+    summary["acl_updated"] = len(to_fix)
+
+
+async def async_sync_profiles(
     hass: HomeAssistant,
     db,
     *,
     prune_missing: bool = False,
     include_system: bool = False,
-) -> int:
+) -> Dict[str, int]:
     """
     Sincronizza diet_profiles con gli utenti HA:
     - crea/aggiorna i profili per ogni utente HA attivo (non system, salvo include_system=True),
     - imposta ACL incrociate read-only tra profili diversi.
 
-    Ritorna il numero di profili presenti dopo la sincronizzazione.
+    Calcola il diff con lo stato attuale e applica solo le modifiche, in una
+    sola transazione. Ritorna il riepilogo delle modifiche (``count`` = profili
+    sincronizzati).
     """
     # 1) Leggi utenti da HA
     # Nota: .async_get_users() ritorna User objects con .id, .name, .is_active, .system_generated
@@ -105,23 +124,39 @@ async def sync_profiles_from_ha(
         for u in ha_users
         if u.is_active and (include_system or not u.system_generated)
     ]
+    wanted = {u.id: u.name or f"User {u.id[:8]}" for u in selected}
+    summary: Dict[str, int] = {}
 
-    # 2) Snapshot profili esistenti
-    existing = await _existing_profiles(db)
+    async def _write(conn):
+        # 2) Profili: insert/update solo del diff
+        profile_ids = await _apply_profiles(conn, wanted, summary)
+        # 3) ACL read-only incrociate
+        await _apply_cross_read_acl(conn, profile_ids, summary)
+        summary["count"] = len(profile_ids)
 
-    # 3) Crea/aggiorna profili
-    profile_ids: List[int] = []
-    for u in selected:
-        display = u.name or f"User {u.id[:8]}"
-        pid = await _ensure_profile(db, u.id, display)
-        profile_ids.append(pid)
+    await db.async_write(_write)
 
     # 4) (Opzionale) pruning di profili orfani
     if prune_missing:
-        await _prune_missing(db, [u.id for u in selected])
+        await _prune_missing(db, list(wanted))
+
+    # ricostruisce l'indice di autorizzazione in memoria
+    await db.acl.async_reload(db)
+    return summary
 
-    # 5) ACL read-only incrociate
-    await _ensure_cross_read_acl(db, profile_ids)
 
-    await db.conn.commit()
-    return len(profile_ids)
+async def sync_profiles_from_ha(
+    hass: HomeAssistant,
+    db,
+    *,
+    prune_missing: bool = False,
+    include_system: bool = False,
+) -> int:
+    """
+    Come ``async_sync_profiles``; ritorna il numero di profili presenti dopo la
+    sincronizzazione.
+    """
+    summary = await async_sync_profiles(
+        hass, db, prune_missing=prune_missing, include_system=include_system
+    )
+    return summary["count"]
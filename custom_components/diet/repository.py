@@ -1,7 +1,164 @@
 from __future__ import annotations
+import json
 from datetime import datetime, timedelta
-from typing import Any
-from .const import MEAL_TYPES
+from typing import Any, AsyncIterator, Iterable
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.json import json_bytes, json_fragment
+from .cache import CompiledTemplate, Slot
+from .const import (
+    HISTORY_PAGE_SIZE,
+    MEAL_TYPES,
+    NEXT_MEAL_TIMES,
+    NEXT_MEALS_GRACE_HOURS,
+    SIGNAL_DAY_CHANGED,
+)
+
+# Pasto free di uno slot: registrato una sola volta e solo se la scelta
+# corrente in day_meals è 'free'
+_INSERT_FREE_MEAL = """
+    INSERT INTO free_meals(profile_id,date,meal_type,notes,ts)
+    SELECT ?1, ?2, ?3, ?4, datetime('now')
+    WHERE EXISTS (
+        SELECT 1 FROM day_meals
+        WHERE profile_id=?1 AND date=?2 AND meal_type=?3 AND chosen_source='free'
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM free_meals WHERE profile_id=?1 AND date=?2 AND meal_type=?3
+    )
+"""
+
+
+# Scelta corrente di uno slot: upsert (lo storico è scritto dai trigger)
+_UPSERT_CHOICE = """
+    INSERT INTO day_meals
+    (profile_id,date,meal_type,chosen_source,chosen_title,notes,ts)
+    VALUES (?,?,?,?,?,?,datetime('now'))
+    ON CONFLICT(profile_id,date,meal_type) DO UPDATE SET
+        chosen_source=excluded.chosen_source,
+        chosen_title=excluded.chosen_title,
+        chosen_label=NULL,
+        chosen_items=NULL,
+        notes=excluded.notes,
+        ts=excluded.ts
+"""
+
+_DELETE_FREE_MEAL = (
+    "DELETE FROM free_meals WHERE profile_id=? AND date=? AND meal_type=?"
+)
+
+_UPSERT_SNACK = """
+    INSERT INTO snacks(profile_id,date,period,done,ts)
+    VALUES (?,?,?,?,datetime('now'))
+    ON CONFLICT(profile_id,date,period)
+    DO UPDATE SET done=excluded.done, ts=datetime('now')
+"""
+
+_UPDATE_HUNGER = """
+    UPDATE plan_days
+    SET hunger=?, updated_at=datetime('now')
+    WHERE profile_id=? AND date=?
+"""
+
+
+def _week_start(iso_date: str) -> str:
+    """Lunedì della settimana ISO del giorno indicato."""
+    day = datetime.fromisoformat(iso_date).date()
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+def _empty_day(iso_date: str) -> dict[str, Any]:
+    """Payload di un giorno non pianificato."""
+    return {
+        "date": iso_date,
+        "meals": [],
+        "snacks": {"am": {"done": False}, "pm": {"done": False}},
+        "hunger": None,
+    }
+
+
+def _build_meals(
+    slots: tuple[Slot, ...], chosen: dict[str, tuple]
+) -> list[dict[str, Any]]:
+    """Assembla la lista pasti da slot template (ordine MEAL_TYPES) e scelte."""
+    meals = []
+    for mt, slot in zip(MEAL_TYPES, slots):
+        ch = chosen.get(mt)
+        meals.append(
+            {
+                "meal_type": mt,
+                "proposed": dict(slot["proposed"]) if slot else None,
+                "alternatives": [dict(a) for a in slot["alternatives"]] if slot else [],
+                "chosen": (
+                    {"source": ch[0], "title": ch[1], "notes": ch[2], "ts": ch[3]}
+                    if ch
+                    else None
+                ),
+            }
+        )
+    return meals
+
+
+# giorno assemblato e template compilato da cui è stato costruito
+DayEntry = tuple[dict[str, Any], CompiledTemplate | None]
+
+
+def _day_json(day: dict[str, Any], compiled: CompiledTemplate | None) -> bytes:
+    """Serializza un giorno riusando il JSON degli slot del template compilato."""
+    if compiled is None or not day["meals"]:
+        return json_bytes(day)
+    slots = compiled.day_json(datetime.fromisoformat(day["date"]).weekday())
+    meals = [
+        (
+            {
+                **meal,
+                "proposed": json_fragment(slot[0]),
+                "alternatives": json_fragment(slot[1]),
+            }
+            if slot
+            else meal
+        )
+        for meal, slot in zip(day["meals"], slots)
+    ]
+    return json_bytes({**day, "meals": meals})
+
+
+def _compact_day_json(day: dict[str, Any], compiled: CompiledTemplate | None) -> bytes:
+    """Serializza un giorno con i pasti ridotti a riferimento allo slot e scelta.
+
+    Con ``ref`` None il template non prevede il pasto; i pasti assenti
+    non hanno né slot né scelta.
+    """
+    if compiled is None or not day["meals"]:
+        return json_bytes(day)
+    slots = compiled.day(datetime.fromisoformat(day["date"]).weekday())
+    # solo gli slot con proposta o scelta: gli altri sono ricostruibili da MEAL_TYPES
+    meals = [
+        {
+            "meal_type": meal["meal_type"],
+            "ref": slot["id"] if slot else None,
+            "chosen": meal["chosen"],
+        }
+        for meal, slot in zip(day["meals"], slots)
+        if slot or meal["chosen"]
+    ]
+    return json_bytes({**day, "meals": meals})
+
+
+def _template_dictionary(entries: list[DayEntry]) -> dict[int, bytes]:
+    """``{template_meal_id: JSON {proposed, alternatives}}`` degli slot usati."""
+    out: dict[int, bytes] = {}
+    seen: set[tuple[int, int]] = set()
+    for day, compiled in entries:
+        if compiled is None or not day["meals"]:
+            continue
+        dow = datetime.fromisoformat(day["date"]).weekday()
+        if (id(compiled), dow) in seen:
+            continue
+        seen.add((id(compiled), dow))
+        for slot, slot_json in zip(compiled.day(dow), compiled.day_json(dow)):
+            if slot and slot["id"] not in out:
+                out[slot["id"]] = b'{"proposed":%s,"alternatives":%s}' % slot_json
+    return out
 
 
 class DietRepo:
@@ -10,132 +167,218 @@ class DietRepo:
     def __init__(self, db):
         self.db = db
 
+    def _touched(self, profile_id: int, dates: Iterable[str]) -> None:
+        """Da chiamare dopo il commit di una scrittura sui giorni indicati."""
+        dates = tuple(dates)
+        self.db.days.invalidate(profile_id, dates)
+        self.db.versions.bump(profile_id, dates)
+        async_dispatcher_send(self.db.hass, SIGNAL_DAY_CHANGED, profile_id, dates)
+
+    async def _write_days(
+        self, profile_id: int, dates: list[str], write, with_state: bool
+    ) -> dict | None:
+        """Esegue ``write(conn)`` e, con ``with_state``, ne ritorna l'esito.
+
+        Lo stato è riletto sul writer nella stessa transazione della scrittura:
+        nessun round trip in più sul pool di lettura.
+        """
+
+        async def _job(conn):
+            await write(conn)
+            if with_state:
+                return await self._state(conn, profile_id, dates)
+            return None
+
+        state = await self.db.async_write(_job)
+        self._touched(profile_id, dates)
+        return state
+
+    async def _state(self, conn, profile_id: int, dates: Iterable[str]) -> dict:
+        """Giorni indicati e pasti free usati nelle loro settimane ISO.
+
+        ``{"days": [...], "free_meals_used": {week_start: n}}``
+        """
+        dates = sorted(set(dates))
+        days = [day for day, _ in await self._read_range(conn, profile_id, dates)]
+        used = {w: 0 for w in sorted({_week_start(d) for d in dates})}
+        async with conn.execute(
+            f"""
+            SELECT week_start, free_meals FROM weekly_rollups
+            WHERE profile_id=? AND week_start IN ({",".join("?" * len(used))})
+            """,
+            (profile_id, *used),
+        ) as c:
+            async for r in c:
+                used[r[0]] = r[1]
+        return {"days": days, "free_meals_used": used}
+
     # -------------------------------
     # TEMPLATE E PIANIFICAZIONE
     # -------------------------------
     async def get_active_template_id(self, profile_id: int | None = None) -> int | None:
         """Ritorna il template attivo per profilo o condiviso."""
-        if profile_id is not None:
-            async with self.db.conn.execute(
-                "SELECT id FROM week_templates WHERE profile_id=? AND is_active=1",
-                (profile_id,),
+        async with self.db.read() as conn:
+            if profile_id is not None:
+                async with conn.execute(
+                    "SELECT id FROM week_templates WHERE profile_id=? AND is_active=1",
+                    (profile_id,),
+                ) as c:
+                    r = await c.fetchone()
+                    if r:
+                        return r[0]
+            async with conn.execute(
+                "SELECT id FROM week_templates WHERE profile_id IS NULL AND is_active=1"
             ) as c:
                 r = await c.fetchone()
-                if r:
-                    return r[0]
-        async with self.db.conn.execute(
-            "SELECT id FROM week_templates WHERE profile_id IS NULL AND is_active=1"
-        ) as c:
-            r = await c.fetchone()
         return r[0] if r else None
 
     async def apply_week_template(
-        self, profile_id: int, start_monday: str, template_id: int
-    ):
+        self,
+        profile_id: int,
+        start_monday: str,
+        template_id: int,
+        with_state: bool = False,
+    ) -> dict | None:
         """Crea plan_days e pre-popola FREE/SKIP da default_source."""
-        start = datetime.fromisoformat(start_monday)
+        return await self.apply_template_range(
+            profile_id, start_monday, template_id, 1, with_state=with_state
+        )
 
-        for i in range(7):
-            date_str = (start + timedelta(days=i)).date().isoformat()
+    async def apply_template_range(
+        self,
+        profile_id: int,
+        start_monday: str,
+        template_id: int,
+        weeks: int = 1,
+        with_state: bool = False,
+    ) -> dict | None:
+        """Applica il template a ``weeks`` settimane consecutive in una transazione.
+
+        Il template viene letto una sola volta; plan_days, day_meals e free_meals
+        sono inseriti con ``executemany``.
+        """
+        start = datetime.fromisoformat(start_monday).date()
+        dates = [start + timedelta(days=i) for i in range(7 * weeks)]
 
-            await self.db.conn.execute(
+        async def _write(conn):
+            # default_source per (dow, meal_type): vale il primo template_meal
+            defaults: dict[tuple[int, str], str] = {}
+            async with conn.execute(
+                """
+                SELECT dow, meal_type, default_source
+                FROM template_meals
+                WHERE template_id=?
+                ORDER BY id
+                """,
+                (template_id,),
+            ) as c:
+                async for r in c:
+                    defaults.setdefault((r[0], r[1]), r[2])
+
+            plan_rows = []
+            meal_rows = []
+            free_rows = []
+            for d in dates:
+                date_str = d.isoformat()
+                plan_rows.append((date_str, profile_id, template_id))
+                for mt in MEAL_TYPES:
+                    default_source = defaults.get((d.weekday(), mt))
+                    if default_source == "free":
+                        meal_rows.append(
+                            (profile_id, date_str, mt, "free", f"FREE – {mt}")
+                        )
+                        free_rows.append((profile_id, date_str, mt, ""))
+                    elif default_source == "skipped":
+                        meal_rows.append(
+                            (profile_id, date_str, mt, "skipped", f"SKIP – {mt}")
+                        )
+
+            await conn.executemany(
                 """
                 INSERT OR IGNORE INTO plan_days
                 (date, profile_id, template_id, created_at, updated_at)
                 VALUES (?, ?, ?, datetime('now'), datetime('now'))
                 """,
-                (date_str, profile_id, template_id),
+                plan_rows,
             )
+            # una scelta già presente (es. riapplicazione) non viene sovrascritta
+            await conn.executemany(
+                """
+                INSERT INTO day_meals
+                (profile_id,date,meal_type,chosen_source,chosen_title,ts)
+                VALUES (?,?,?,?,?,datetime('now'))
+                ON CONFLICT(profile_id,date,meal_type) DO NOTHING
+                """,
+                meal_rows,
+            )
+            await conn.executemany(_INSERT_FREE_MEAL, free_rows)
 
-            dow = (start.weekday() + i) % 7
-
-            for mt in MEAL_TYPES:
-                async with self.db.conn.execute(
-                    """
-                    SELECT id, title, default_source
-                    FROM template_meals
-                    WHERE template_id=? AND dow=? AND meal_type=?
-                    """,
-                    (template_id, dow, mt),
-                ) as c:
-                    t = await c.fetchone()
-
-                if not t:
-                    continue
-
-                _, title, default_source = t
-
-                if default_source == "free":
-                    await self.db.conn.execute(
-                        """
-                        INSERT INTO day_meals
-                        (profile_id,date,meal_type,chosen_source,chosen_title,ts)
-                        VALUES (?,?,?,?,?,datetime('now'))
-                        """,
-                        (profile_id, date_str, mt, "free", f"FREE – {mt}"),
-                    )
-                    await self.db.conn.execute(
-                        """
-                        INSERT INTO free_meals
-                        (profile_id,date,meal_type,notes,ts)
-                        VALUES (?,?,?,?,datetime('now'))
-                        """,
-                        (profile_id, date_str, mt, ""),
-                    )
-
-                elif default_source == "skipped":
-                    await self.db.conn.execute(
-                        """
-                        INSERT INTO day_meals
-                        (profile_id,date,meal_type,chosen_source,chosen_title,ts)
-                        VALUES (?,?,?,?,?,datetime('now'))
-                        """,
-                        (profile_id, date_str, mt, "skipped", f"SKIP – {mt}"),
-                    )
-
-        await self.db.conn.commit()
+        return await self._write_days(
+            profile_id, [d.isoformat() for d in dates], _write, with_state
+        )
 
     # -------------------------------
     # OPERAZIONI GIORNALIERE
     # -------------------------------
-    async def set_snack(self, profile_id: int, iso_date: str, period: str, done: bool):
+    async def set_snack(
+        self,
+        profile_id: int,
+        iso_date: str,
+        period: str,
+        done: bool,
+        with_state: bool = False,
+    ) -> dict | None:
         """Aggiorna o crea lo stato di uno spuntino."""
-        await self.db.conn.execute(
-            """
-            INSERT INTO snacks(profile_id,date,period,done,ts)
-            VALUES (?,?,?,?,datetime('now'))
-            ON CONFLICT(profile_id,date,period)
-            DO UPDATE SET done=excluded.done, ts=datetime('now')
-            """,
-            (profile_id, iso_date, period, 1 if done else 0),
-        )
-        await self.db.conn.commit()
 
-    async def set_hunger(self, profile_id: int, iso_date: str, score: int):
+        async def _write(conn):
+            await conn.execute(
+                _UPSERT_SNACK, (profile_id, iso_date, period, 1 if done else 0)
+            )
+
+        return await self._write_days(profile_id, [iso_date], _write, with_state)
+
+    async def set_hunger(
+        self, profile_id: int, iso_date: str, score: int, with_state: bool = False
+    ) -> dict | None:
         """Aggiorna il livello di fame giornaliero (1–5)."""
-        await self.db.conn.execute(
-            """
-            UPDATE plan_days
-            SET hunger=?, updated_at=datetime('now')
-            WHERE profile_id=? AND date=?
-            """,
-            (score, profile_id, iso_date),
-        )
-        await self.db.conn.commit()
+
+        async def _write(conn):
+            await conn.execute(_UPDATE_HUNGER, (score, profile_id, iso_date))
+
+        return await self._write_days(profile_id, [iso_date], _write, with_state)
 
     async def free_meals_used_in_week(self, profile_id: int, iso_date: str) -> int:
         """Conta quanti pasti free risultano in settimana ISO del giorno indicato."""
         query = """
-        SELECT COUNT(*)
-        FROM free_meals
-        WHERE profile_id=?
-          AND date BETWEEN date(?, 'weekday 1', '-6 days')
-                        AND date(?, 'weekday 1')
+        SELECT free_meals
+        FROM weekly_rollups
+        WHERE profile_id=? AND week_start=date(?, 'weekday 0', '-6 days')
         """
-        async with self.db.conn.execute(query, (profile_id, iso_date, iso_date)) as c:
-            r = await c.fetchone()
+        async with self.db.read() as conn:
+            async with conn.execute(query, (profile_id, iso_date)) as c:
+                r = await c.fetchone()
         return int(r[0]) if r and r[0] is not None else 0
 
+    async def rebuild_rollups(self) -> None:
+        """Ricalcola i rollup da zero (es. dopo modifiche SQL manuali)."""
+        await self.db.async_rebuild_rollups()
+
+    async def _check_free_quota(self, conn, free: list[tuple], quota: int) -> None:
+        """Solleva ValueError se una settimana dei pasti free supera ``quota``.
+
+        Letta dai rollup sulla connessione della scrittura, quindi include il
+        batch in corso.
+        """
+        for week in {(f[0], _week_start(f[1])) for f in free}:
+            async with conn.execute(
+                "SELECT free_meals FROM weekly_rollups "
+                "WHERE profile_id=? AND week_start=?",
+                week,
+            ) as c:
+                r = await c.fetchone()
+            if r and r[0] > quota:
+                raise ValueError("Quota pasti free settimanale superata")
+
     async def set_choice(
         self,
         profile_id: int,
@@ -144,42 +387,101 @@ class DietRepo:
         source: str,
         title: str,
         notes: str | None = None,
-    ):
-        """Registra la scelta effettiva del pasto (proposto, alternativa, free, skip)."""
-        await self.db.conn.execute(
-            """
-            INSERT INTO day_meals
-            (profile_id,date,meal_type,chosen_source,chosen_title,notes,ts)
-            VALUES (?,?,?,?,?,?,datetime('now'))
-            """,
-            (profile_id, iso_date, meal_type, source, title, notes or ""),
-        )
+        with_state: bool = False,
+    ) -> dict | None:
+        """Registra la scelta effettiva del pasto (proposto, alternativa, free, skip).
 
-        if source == "free":
-            await self.db.conn.execute(
-                """
-                INSERT INTO free_meals
-                (profile_id,date,meal_type,notes,ts)
-                VALUES (?,?,?,?,datetime('now'))
-                """,
-                (profile_id, iso_date, meal_type, notes or ""),
+        In modalità hard (``db.policy``) una scelta free che supera la quota
+        settimanale solleva ValueError e non viene salvata.
+        """
+        quota = self.db.policy.hard_free_quota
+
+        async def _write(conn):
+            await conn.execute(
+                _UPSERT_CHOICE,
+                (profile_id, iso_date, meal_type, source, title, notes or ""),
+            )
+            # free_meals segue la scelta corrente: al più un pasto free per slot
+            if source == "free":
+                await conn.execute(
+                    _INSERT_FREE_MEAL, (profile_id, iso_date, meal_type, notes or "")
+                )
+                if quota is not None:
+                    await self._check_free_quota(conn, [(profile_id, iso_date)], quota)
+            else:
+                await conn.execute(_DELETE_FREE_MEAL, (profile_id, iso_date, meal_type))
+
+        return await self._write_days(profile_id, [iso_date], _write, with_state)
+
+    async def set_bulk(
+        self,
+        choices: Iterable[tuple] = (),
+        snacks: Iterable[tuple] = (),
+        hunger: Iterable[tuple] = (),
+        with_state: bool = False,
+    ) -> dict[int, dict] | None:
+        """Applica molte scritture giornaliere in un'unica transazione.
+
+        - ``choices``: (profile_id, date, meal_type, source, title, notes)
+        - ``snacks``: (profile_id, date, period, done)
+        - ``hunger``: (profile_id, date, score)
+
+        In modalità hard (``db.policy``) la quota di pasti free è verificata
+        sull'intero batch, dopo averlo applicato, per ogni settimana in cui il
+        batch registra un pasto free: se superata, nessuna scrittura viene salvata
+        e viene sollevato ValueError. Righe ripetute per lo stesso slot: vale
+        l'ultima. Con ``with_state`` ritorna ``{profile_id: stato}`` dei giorni
+        toccati, letto nella stessa transazione.
+        """
+        choices, snacks, hunger = list(choices), list(snacks), list(hunger)
+        free_quota = self.db.policy.hard_free_quota
+        touched: dict[int, set[str]] = {}
+        for row in (*choices, *snacks, *hunger):
+            touched.setdefault(row[0], set()).add(row[1])
+        if not touched:
+            return {} if with_state else None
+
+        async def _write(conn):
+            await conn.executemany(
+                _UPSERT_CHOICE, [(*c[:5], c[5] or "") for c in choices]
             )
+            free = [(*c[:3], c[5] or "") for c in choices if c[3] == "free"]
+            await conn.executemany(
+                _DELETE_FREE_MEAL, [c[:3] for c in choices if c[3] != "free"]
+            )
+            await conn.executemany(_INSERT_FREE_MEAL, free)
+            await conn.executemany(
+                _UPSERT_SNACK, [(*s[:3], 1 if s[3] else 0) for s in snacks]
+            )
+            await conn.executemany(_UPDATE_HUNGER, [(h[2], h[0], h[1]) for h in hunger])
+            if free_quota is not None:
+                await self._check_free_quota(conn, free, free_quota)
+            if with_state:
+                return {
+                    pid: await self._state(conn, pid, dates)
+                    for pid, dates in touched.items()
+                }
+            return None
 
-        await self.db.conn.commit()
+        state = await self.db.async_write(_write)
+        for profile_id, dates in touched.items():
+            self._touched(profile_id, sorted(dates))
+        return state
 
     # -------------------------------
     # LETTURE (GIORNO / SETTIMANA)
     # -------------------------------
     async def get_template_meal(self, template_id: int, dow: int, meal_type: str):
-        async with self.db.conn.execute(
-            """
-            SELECT id,title,proposed_items,calories
-            FROM template_meals
-            WHERE template_id=? AND dow=? AND meal_type=?
-            """,
-            (template_id, dow, meal_type),
-        ) as c:
-            return await c.fetchone()
+        async with self.db.read() as conn:
+            async with conn.execute(
+                """
+                SELECT id,title,proposed_items,calories
+                FROM template_meals
+                WHERE template_id=? AND dow=? AND meal_type=?
+                """,
+                (template_id, dow, meal_type),
+            ) as c:
+                return await c.fetchone()
 
     async def get_template_alternatives(self, template_meal_id: int) -> list[dict]:
         q = """
@@ -188,109 +490,471 @@ class DietRepo:
         WHERE template_meal_id=?
         """
         out = []
-        async with self.db.conn.execute(q, (template_meal_id,)) as c:
+        async with self.db.read() as conn:
+            async with conn.execute(q, (template_meal_id,)) as c:
+                async for r in c:
+                    out.append(
+                        {
+                            "id": r[0],
+                            "title": r[1],
+                            "items": r[2],
+                            "calories": r[3],
+                        }
+                    )
+        return out
+
+    async def _get_templates(
+        self, conn, revs: dict[int, int | None]
+    ) -> dict[int, CompiledTemplate]:
+        """Ritorna i template compilati richiesti ({template_id: rev}).
+
+        Solo i template assenti dalla cache (o con rev cambiato) sono letti da
+        SQLite, con un'unica query join template_meals/alternative.
+        """
+        self.db.versions.observe(revs)
+        out: dict[int, CompiledTemplate] = {}
+        missing = []
+        for template_id, rev in revs.items():
+            compiled = self.db.templates.get(template_id, rev)
+            if compiled is None:
+                missing.append(template_id)
+            else:
+                out[template_id] = compiled
+        if not missing:
+            return out
+
+        rows: dict[int, list[tuple]] = {tid: [] for tid in missing}
+        marks = ",".join("?" * len(missing))
+        async with conn.execute(
+            f"""
+            SELECT tm.template_id,tm.id,tm.dow,tm.meal_type,tm.title,tm.proposed_items,
+                   a.id,a.title,a.items,a.calories
+            FROM template_meals tm
+            LEFT JOIN template_meal_alternatives a ON a.template_meal_id = tm.id
+            WHERE tm.template_id IN ({marks})
+            ORDER BY tm.id, a.id
+            """,
+            tuple(missing),
+        ) as c:
             async for r in c:
-                out.append(
-                    {
-                        "id": r[0],
-                        "title": r[1],
-                        "items": r[2],
-                        "calories": r[3],
-                    }
-                )
+                rows[r[0]].append(r[1:])
+        for template_id in missing:
+            compiled = CompiledTemplate.from_rows(
+                template_id, revs[template_id], rows[template_id]
+            )
+            previous = self.db.templates.put(compiled)
+            if previous is not None and previous.rev != compiled.rev:
+                # template modificato: i giorni assemblati sulla versione precedente sono superati
+                self.db.days.invalidate_template(template_id)
+            out[template_id] = compiled
         return out
 
-    async def get_day(self, profile_id: int, iso_date: str) -> dict[str, Any]:
-        """Ritorna i dati completi di un giorno."""
-        async with self.db.conn.execute(
-            "SELECT template_id,hunger,notes FROM plan_days WHERE profile_id=? AND date=?",
-            (profile_id, iso_date),
+    async def get_range(
+        self, profile_id: int, start: str, end: str
+    ) -> list[dict[str, Any]]:
+        """Ritorna i dati completi dei giorni tra start ed end (inclusi).
+
+        Il numero di query è costante: ogni tabella viene letta una sola volta
+        con ``date BETWEEN`` e i risultati sono raggruppati in memoria.
+        """
+        return [day for day, _ in await self._get_entries(profile_id, start, end)]
+
+    async def _get_entries(
+        self, profile_id: int, start: str, end: str
+    ) -> list[DayEntry]:
+        """Coppie (payload, template compilato) tra start ed end, via DayCache."""
+        first = datetime.fromisoformat(start).date()
+        last = datetime.fromisoformat(end).date()
+        dates = [
+            (first + timedelta(days=i)).isoformat()
+            for i in range((last - first).days + 1)
+        ]
+        if not dates:
+            return []
+        async with self.db.read() as conn:
+            return await self._load_entries(conn, profile_id, dates)
+
+    async def _load_entries(
+        self,
+        conn,
+        profile_id: int,
+        dates: list[str],
+        revs: dict[int, int | None] | None = None,
+    ) -> list[DayEntry]:
+        """Giorni indicati (date consecutive) dalla DayCache, rileggendo i mancanti.
+
+        ``revs`` sono i rev dei template già letti dal chiamante; se None e
+        in cache ci sono giorni costruiti su un template, vengono letti qui.
+        """
+        cache = self.db.days
+        entries = [cache.get_entry(profile_id, d) for d in dates]
+        if revs is None and any(e is not None and e[1] is not None for e in entries):
+            revs = await self._template_revs(conn, profile_id, dates[0], dates[-1])
+        if revs is not None:
+            entries = self._drop_stale(entries, revs)
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if not missing:
+            return entries
+
+        # rilegge solo l'intervallo che copre i giorni mancanti
+        generation = cache.generation
+        span = dates[missing[0] : missing[-1] + 1]
+        fresh = await self._read_range(conn, profile_id, span)
+        for offset, (day, compiled) in enumerate(fresh, start=missing[0]):
+            entries[offset] = (day, compiled)
+            cache.put(profile_id, day, compiled, generation)
+        return entries
+
+    async def _template_revs(
+        self, conn, profile_id: int, start: str, end: str
+    ) -> dict[int, int | None]:
+        """rev correnti dei template pianificati tra start ed end ({template_id: rev}).
+
+        I rev letti sono registrati in DayVersions: un template modificato
+        alza la versione di tutti i giorni prima che venga confrontata.
+        """
+        async with conn.execute(
+            """
+            SELECT DISTINCT pd.template_id,wt.rev
+            FROM plan_days pd
+            JOIN week_templates wt ON wt.id = pd.template_id
+            WHERE pd.profile_id=? AND pd.date BETWEEN ? AND ?
+            """,
+            (profile_id, start, end),
         ) as c:
-            pd = await c.fetchone()
-
-        if not pd:
-            return {
-                "date": iso_date,
-                "meals": [],
-                "snacks": {"am": {"done": False}, "pm": {"done": False}},
-                "hunger": None,
-            }
+            revs = {r[0]: r[1] async for r in c}
+        self.db.versions.observe(revs)
+        return revs
+
+    def _drop_stale(
+        self, entries: list[DayEntry | None], revs: dict[int, int | None]
+    ) -> list[DayEntry | None]:
+        """Scarta i giorni in cache costruiti su un template con rev superato.
+
+        Le modifiche a template_meals/alternative non passano dalle scritture
+        del repository: solo il confronto con ``week_templates.rev`` le rileva.
+        """
+        stale = {
+            e[1].template_id
+            for e in entries
+            if e is not None
+            and e[1] is not None
+            and revs.get(e[1].template_id, -1) != e[1].rev
+        }
+        for template_id in stale:
+            self.db.days.invalidate_template(template_id)
+        return [
+            (
+                None
+                if e is not None and e[1] is not None and e[1].template_id in stale
+                else e
+            )
+            for e in entries
+        ]
+
+    async def _read_range(
+        self, conn, profile_id: int, dates: list[str]
+    ) -> list[DayEntry]:
+        """Legge e assembla i giorni indicati (date crescenti) su una connessione.
 
-        template_id, hunger, notes = pd
-        dow = datetime.fromisoformat(iso_date).weekday()
+        Ritorna coppie (payload, template compilato) nell'ordine di ``dates``.
+        """
+        bounds = (profile_id, dates[0], dates[-1])
+
+        # rev del template letto insieme al giorno: valida la cache senza query extra
+        plans: dict[str, tuple] = {}
+        async with conn.execute(
+            """
+            SELECT pd.date,pd.template_id,pd.hunger,pd.notes,wt.rev
+            FROM plan_days pd
+            LEFT JOIN week_templates wt ON wt.id = pd.template_id
+            WHERE pd.profile_id=? AND pd.date BETWEEN ? AND ?
+            """,
+            bounds,
+        ) as c:
+            async for r in c:
+                plans.setdefault(r[0], r[1:])
+        if not plans:
+            return [(_empty_day(d), None) for d in dates]
 
         # Spuntini
-        snacks = {"am": {"done": False}, "pm": {"done": False}}
-        async with self.db.conn.execute(
-            "SELECT period,done,ts FROM snacks WHERE profile_id=? AND date=?",
-            (profile_id, iso_date),
+        snacks: dict[str, dict[str, Any]] = {}
+        async with conn.execute(
+            """
+            SELECT date,period,done,ts
+            FROM snacks
+            WHERE profile_id=? AND date BETWEEN ? AND ?
+            """,
+            bounds,
+        ) as c:
+            async for r in c:
+                snacks.setdefault(r[0], {})[r[1]] = {"done": bool(r[2]), "ts": r[3]}
+
+        # Scelte correnti: una riga per (date, meal_type)
+        chosen: dict[str, dict[str, tuple]] = {}
+        async with conn.execute(
+            """
+            SELECT date,meal_type,chosen_source,chosen_title,notes,ts
+            FROM day_meals
+            WHERE profile_id=? AND date BETWEEN ? AND ?
+            """,
+            bounds,
         ) as c:
             async for r in c:
-                snacks[r[0]] = {"done": bool(r[1]), "ts": r[2]}
+                chosen.setdefault(r[0], {})[r[1]] = r[2:]
+
+        templates = await self._get_templates(
+            conn, {p[0]: p[3] for p in plans.values()}
+        )
+
+        days = []
+        for d in dates:
+            pd = plans.get(d)
+            if not pd:
+                days.append((_empty_day(d), None))
+                continue
+            template_id, hunger, notes, _ = pd
+            compiled = templates[template_id]
+            dow = datetime.fromisoformat(d).weekday()
+            day_snacks = {"am": {"done": False}, "pm": {"done": False}}
+            day_snacks.update(snacks.get(d, {}))
+            days.append(
+                (
+                    {
+                        "date": d,
+                        "hunger": hunger,
+                        "notes": notes,
+                        "snacks": day_snacks,
+                        "meals": _build_meals(compiled.day(dow), chosen.get(d, {})),
+                    },
+                    compiled,
+                )
+            )
+        return days
 
-        # Pasti
-        meals = []
-        for mt in MEAL_TYPES:
-            async with self.db.conn.execute(
+    async def get_range_if_modified(
+        self, profile_id: int, start: str, end: str, known: dict[str, int]
+    ) -> tuple[list[dict[str, Any]], dict[str, int]]:
+        """Come get_range, ma solo per i giorni con versione diversa da ``known``.
+
+        Ritorna (giorni modificati, versioni correnti di tutti i giorni
+        dell'intervallo).
+        """
+        entries, versions = await self._get_modified(profile_id, start, end, known)
+        return [day for day, _ in entries], versions
+
+    async def _get_modified(
+        self, profile_id: int, start: str, end: str, known: dict[str, int]
+    ) -> tuple[list[DayEntry], dict[str, int]]:
+        first = datetime.fromisoformat(start).date()
+        last = datetime.fromisoformat(end).date()
+        dates = [
+            (first + timedelta(days=i)).isoformat()
+            for i in range((last - first).days + 1)
+        ]
+        if not dates:
+            return [], {}
+        async with self.db.read() as conn:
+            # i rev dei template sono registrati prima di leggere le versioni,
+            # così una modifica al template cambia la versione anche dei giorni
+            # non in cache; versioni lette prima dei dati: una scrittura
+            # concorrente produce al più una rilettura in eccesso, mai un giorno perso
+            revs = await self._template_revs(conn, profile_id, dates[0], dates[-1])
+            versions = {d: self.db.versions.get(profile_id, d) for d in dates}
+            stale = [d for d, v in versions.items() if known.get(d) != v]
+            if not stale:
+                return [], versions
+            span = dates[dates.index(stale[0]) : dates.index(stale[-1]) + 1]
+            entries = await self._load_entries(conn, profile_id, span, revs)
+        stale_set = set(stale)
+        return [e for e in entries if e[0]["date"] in stale_set], versions
+
+    async def get_range_json(
+        self,
+        profile_id: int,
+        start: str,
+        end: str,
+        known: dict[str, int] | None = None,
+        compact: bool = False,
+    ) -> tuple[list[bytes], dict[str, int], dict[int, bytes]]:
+        """JSON dei giorni tra start ed end, per l'invio via WebSocket.
+
+        Ritorna (JSON dei giorni con versione diversa da ``known``, versioni
+        correnti, dizionario template). Il JSON di ogni giorno è serializzato
+        una sola volta e conservato nella DayCache, così lo stesso giorno
+        inviato a più connessioni non viene riserializzato. Con ``compact`` i
+        pasti riportano solo ``ref`` (id del template_meal) e la scelta, e il
+        dizionario ``{template_meal_id: {proposed, alternatives}}`` contiene
+        ogni slot referenziato una volta sola.
+        """
+        entries, versions = await self._get_modified(
+            profile_id, start, end, known or {}
+        )
+        cache = self.db.days
+        if not compact:
+            days = [cache.json(profile_id, d, c, "full", _day_json) for d, c in entries]
+            return days, versions, {}
+        days = [
+            cache.json(profile_id, d, c, "compact", _compact_day_json)
+            for d, c in entries
+        ]
+        return days, versions, _template_dictionary(entries)
+
+    def to_json(self, profile_id: int, days: list[dict[str, Any]]) -> list[bytes]:
+        """JSON completo di giorni già restituiti da get_range (via DayCache)."""
+        cache = self.db.days
+        return [cache.json(profile_id, day, None, "full", _day_json) for day in days]
+
+    async def get_day(self, profile_id: int, iso_date: str) -> dict[str, Any]:
+        """Ritorna i dati completi di un giorno."""
+        return (await self.get_range(profile_id, iso_date, iso_date))[0]
+
+    async def get_week(self, profile_id: int, start_monday: str) -> list[dict]:
+        """Ritorna i dati dei 7 giorni della settimana."""
+        end = (datetime.fromisoformat(start_monday) + timedelta(days=6)).date()
+        return await self.get_range(profile_id, start_monday, end.isoformat())
+
+    # -------------------------------
+    # PROSSIMI PASTI (più profili)
+    # -------------------------------
+    async def get_next_meals(
+        self, profile_ids: list[int], now: datetime, horizon: datetime
+    ) -> list[dict[str, Any]]:
+        """Pasti di NEXT_MEAL_TIMES tra ``now`` e ``horizon`` per più profili.
+
+        Un'unica query per tutti i profili e tutti i giorni dell'orizzonte:
+        nome del profilo, scelta corrente e proposta del template (il primo
+        template_meal dello slot). Un pasto resta in elenco fino a
+        NEXT_MEALS_GRACE_HOURS dopo il suo orario nominale.
+        """
+        if not profile_ids:
+            return []
+        earliest = now - timedelta(hours=NEXT_MEALS_GRACE_HOURS)
+        async with self.db.read() as conn:
+            rows = await conn.execute_fetchall(
                 """
-                SELECT chosen_source,chosen_title,notes,ts
-                FROM day_meals
-                WHERE profile_id=? AND date=? AND meal_type=?
+                SELECT p.id, p.display_name, pd.date, mt.value,
+                       dm.chosen_source, dm.chosen_title,
+                       (SELECT tm.title FROM template_meals tm
+                        WHERE tm.template_id = pd.template_id
+                          AND tm.dow = (CAST(strftime('%w', pd.date) AS INTEGER) + 6) % 7
+                          AND tm.meal_type = mt.value
+                        ORDER BY tm.id LIMIT 1)
+                FROM json_each(?1) AS ids
+                JOIN diet_profiles p ON p.id = ids.value
+                LEFT JOIN plan_days pd
+                    ON pd.profile_id = p.id AND pd.date BETWEEN ?2 AND ?3
+                LEFT JOIN json_each(?4) AS mt ON pd.date IS NOT NULL
+                LEFT JOIN day_meals dm
+                    ON dm.profile_id = p.id AND dm.date = pd.date AND dm.meal_type = mt.value
+                ORDER BY ids.key, pd.date, mt.key
                 """,
-                (profile_id, iso_date, mt),
-            ) as c:
-                chosen = await c.fetchone()
-
-            tm = await self.get_template_meal(template_id, dow, mt)
-            alts = await self.get_template_alternatives(tm[0]) if tm else []
+                (
+                    json.dumps(profile_ids),
+                    earliest.date().isoformat(),
+                    horizon.date().isoformat(),
+                    json.dumps(list(NEXT_MEAL_TIMES)),
+                ),
+            )
 
-            meals.append(
+        profiles: dict[int, dict[str, Any]] = {}
+        for pid, name, iso_date, meal_type, source, chosen_title, proposed in rows:
+            entry = profiles.setdefault(
+                pid, {"profile_id": pid, "display_name": name, "upcoming": []}
+            )
+            if iso_date is None:
+                continue
+            hour, minute = NEXT_MEAL_TIMES[meal_type]
+            at = datetime.fromisoformat(iso_date).replace(
+                hour=hour, minute=minute, tzinfo=now.tzinfo
+            )
+            if not earliest <= at <= horizon:
+                continue
+            entry["upcoming"].append(
                 {
-                    "meal_type": mt,
-                    "proposed": {"title": tm[1], "items": tm[2]} if tm else None,
-                    "alternatives": alts,
-                    "chosen": (
-                        {
-                            "source": chosen[0],
-                            "title": chosen[1],
-                            "notes": chosen[2],
-                            "ts": chosen[3],
-                        }
-                        if chosen
-                        else None
-                    ),
+                    "type": meal_type,
+                    "date": iso_date,
+                    "at": at.isoformat(timespec="minutes"),
+                    "title": (chosen_title if source else proposed) or "",
+                    "status": source or "planned",
                 }
             )
+        return list(profiles.values())
 
-        return {
-            "date": iso_date,
-            "hunger": hunger,
-            "notes": notes,
-            "snacks": snacks,
-            "meals": meals,
-        }
+    # -------------------------------
+    # STORICO (paginazione keyset)
+    # -------------------------------
+    async def get_history_page(
+        self,
+        profile_id: int,
+        start: str,
+        end: str,
+        page_size: int = HISTORY_PAGE_SIZE,
+        after: str | None = None,
+    ) -> tuple[list[dict[str, Any]], str | None]:
+        """Una pagina dei giorni pianificati tra start ed end (inclusi), per data.
+
+        Paginazione keyset su (profile_id, date): ``after`` è il cursore della
+        pagina precedente (l'ultima data restituita). Ritorna i giorni e il
+        cursore della pagina successiva, None se non ce ne sono altre.
+        I giorni non passano dalla DayCache, per non espellere quelli in uso.
+        """
+        async with self.db.read() as conn:
+            rows = await conn.execute_fetchall(
+                """
+                SELECT date FROM plan_days
+                WHERE profile_id=? AND date BETWEEN ? AND ? AND date > ?
+                ORDER BY date
+                LIMIT ?
+                """,
+                (profile_id, start, end, after or "", page_size + 1),
+            )
+            dates = [r[0] for r in rows[:page_size]]
+            if not dates:
+                return [], None
+            days = [day for day, _ in await self._read_range(conn, profile_id, dates)]
+        return days, (dates[-1] if len(rows) > page_size else None)
 
-    async def get_week(self, profile_id: int, start_monday: str) -> list[dict]:
-        """Ritorna i dati dei 7 giorni della settimana."""
-        start = datetime.fromisoformat(start_monday)
-        days = []
-        for i in range(7):
-            date = (start + timedelta(days=i)).date().isoformat()
-            days.append(await self.get_day(profile_id, date))
-        return days
+    async def iter_history(
+        self,
+        profile_id: int,
+        start: str,
+        end: str,
+        page_size: int = HISTORY_PAGE_SIZE,
+    ) -> AsyncIterator[list[dict[str, Any]]]:
+        """Scorre lo storico a pagine di ``page_size`` giorni (memoria limitata)."""
+        cursor = None
+        while True:
+            days, cursor = await self.get_history_page(
+                profile_id, start, end, page_size, cursor
+            )
+            if days:
+                yield days
+            if cursor is None:
+                return
 
     # -------------------------------
     # SWAP
     # -------------------------------
     async def swap_meal(
-        self, profile_id: int, date_from: str, date_to: str, meal_type: str
-    ) -> None:
+        self,
+        profile_id: int,
+        date_from: str,
+        date_to: str,
+        meal_type: str,
+        with_state: bool = False,
+    ) -> dict | None:
         """Registra uno swap forward-only (audit)."""
-        await self.db.conn.execute(
-            """
-            INSERT INTO swaps(profile_id,date_from,date_to,meal_type,ts)
-            VALUES (?,?,?,?,datetime('now'))
-            """,
-            (profile_id, date_from, date_to, meal_type),
+
+        async def _write(conn):
+            await conn.execute(
+                """
+                INSERT INTO swaps(profile_id,date_from,date_to,meal_type,ts)
+                VALUES (?,?,?,?,datetime('now'))
+                """,
+                (profile_id, date_from, date_to, meal_type),
+            )
+
+        return await self._write_days(
+            profile_id, [date_from, date_to], _write, with_state
         )
-        await self.db.conn.commit()
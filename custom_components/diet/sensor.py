@@ -3,56 +3,59 @@ from homeassistant.components.sensor import SensorEntity
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.entity import EntityCategory
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 from .const import DOMAIN
+from .coordinator import DietCoordinator
 
 
 async def async_setup_entry(
     hass: HomeAssistant, entry, async_add_entities: AddEntitiesCallback
 ):
     """Crea i sensori per ciascun profilo presente nel DB."""
-    db = hass.data[DOMAIN][entry.entry_id]["db"]
+    data = hass.data[DOMAIN][entry.entry_id]
+    db = data["db"]
+    coordinator: DietCoordinator = data["coordinator"]
 
-    profiles: list[tuple[int, str]] = []
-    async with db.conn.execute("SELECT id, display_name FROM diet_profiles") as c:
-        async for row in c:
-            profiles.append((row[0], row[1]))
+    snapshot = await db.acl.async_ensure_loaded(db)
 
     entities: list[SensorEntity] = []
-    for profile_id, display_name in profiles:
-        entities.append(HungerAvgSensor(hass, entry.entry_id, profile_id, display_name))
+    for profile_id, display_name in snapshot.names.items():
+        entities.append(HungerAvgSensor(coordinator, profile_id, display_name))
         entities.append(
-            SnacksCompletedTodaySensor(hass, entry.entry_id, profile_id, display_name)
-        )
-        entities.append(
-            FreeMealsUsedWeekSensor(hass, entry.entry_id, profile_id, display_name)
+            SnacksCompletedTodaySensor(coordinator, profile_id, display_name)
         )
+        entities.append(FreeMealsUsedWeekSensor(coordinator, profile_id, display_name))
 
     async_add_entities(entities)
 
 
-class BaseDietSensor(SensorEntity):
-    """Base class con utilità comuni."""
+class BaseDietSensor(CoordinatorEntity[DietCoordinator], SensorEntity):
+    """Base class con utilità comuni: i valori arrivano da ``coordinator.data``."""
 
     _attr_entity_category = EntityCategory.DIAGNOSTIC
     _attr_has_entity_name = True
+    # aggiornati in push dal coordinator
+    _attr_should_poll = False
+    metric: str
 
     def __init__(
-        self, hass: HomeAssistant, entry_id: str, profile_id: int, display_name: str
+        self, coordinator: DietCoordinator, profile_id: int, display_name: str
     ):
-        self.hass = hass
-        self._entry_id = entry_id
+        super().__init__(coordinator)
         self.profile_id = profile_id
         self.display_name = display_name
 
     @property
-    def _db(self):
-        return self.hass.data[DOMAIN][self._entry_id]["db"]
+    def _metric_value(self):
+        return (self.coordinator.data or {}).get(self.profile_id, {}).get(self.metric)
 
 
 class HungerAvgSensor(BaseDietSensor):
     """Media mobile 7 giorni del punteggio di fame (1–5)."""
 
+    metric = "hunger_avg"
+
     @property
     def name(self) -> str:
         return f"Diet Hunger Score ({self.display_name})"
@@ -61,22 +64,17 @@ class HungerAvgSensor(BaseDietSensor):
     def unique_id(self) -> str:
         return f"{DOMAIN}_hunger_avg_{self.profile_id}"
 
-    async def async_update(self) -> None:
-        q = """
-        SELECT AVG(hunger)
-        FROM plan_days
-        WHERE profile_id=?
-          AND date>=date('now','-6 days')
-          AND hunger IS NOT NULL
-        """
-        async with self._db.conn.execute(q, (self.profile_id,)) as c:
-            r = await c.fetchone()
-        self._attr_native_value = round(r[0], 1) if r and r[0] is not None else None
+    @property
+    def native_value(self) -> float | None:
+        v = self._metric_value
+        return round(v, 1) if v is not None else None
 
 
 class SnacksCompletedTodaySensor(BaseDietSensor):
     """Numero di spuntini (AM/PM) marcati come fatti oggi (0..2)."""
 
+    metric = "snacks_today"
+
     @property
     def name(self) -> str:
         return f"Snacks Completed Today ({self.display_name})"
@@ -85,20 +83,20 @@ class SnacksCompletedTodaySensor(BaseDietSensor):
     def unique_id(self) -> str:
         return f"{DOMAIN}_snacks_today_{self.profile_id}"
 
-    async def async_update(self) -> None:
-        q = """
-        SELECT COALESCE(SUM(done), 0)
-        FROM snacks
-        WHERE profile_id=?
-          AND date=date('now')
-        """
-        async with self._db.conn.execute(q, (self.profile_id,)) as c:
-            r = await c.fetchone()
-        self._attr_native_value = int(r[0]) if r and r[0] is not None else 0
+    @property
+    def native_value(self) -> int:
+        v = self._metric_value
+        return int(v) if v is not None else 0
 
 
 class FreeMealsUsedWeekSensor(BaseDietSensor):
-    """Conteggio pasti FREE usati nella settimana corrente (lun-dom)."""
+    """Conteggio pasti FREE usati nella settimana corrente (lun-dom).
+
+    Quota e modalità arrivano da ``db.policy``: un cambio di opzioni le
+    aggiorna al successivo aggiornamento del coordinator.
+    """
+
+    metric = "free_meals_week"
 
     @property
     def name(self) -> str:
@@ -108,14 +106,16 @@ class FreeMealsUsedWeekSensor(BaseDietSensor):
     def unique_id(self) -> str:
         return f"{DOMAIN}_free_meals_week_{self.profile_id}"
 
-    async def async_update(self) -> None:
-        q = """
-        SELECT COUNT(*)
-        FROM free_meals
-        WHERE profile_id=?
-          AND date BETWEEN date('now', 'weekday 1', '-6 days')
-                        AND date('now', 'weekday 1')
-        """
-        async with self._db.conn.execute(q, (self.profile_id,)) as c:
-            r = await c.fetchone()
-        self._attr_native_value = int(r[0]) if r and r[0] is not None else 0
+    @property
+    def native_value(self) -> int:
+        v = self._metric_value
+        return int(v) if v is not None else 0
+
+    @property
+    def extra_state_attributes(self) -> dict[str, int | str]:
+        policy = self.coordinator.db.policy
+        return {
+            "quota": policy.free_meals_per_week,
+            "remaining": policy.free_meals_remaining(self.native_value),
+            "limit_mode": policy.free_limit_mode,
+        }
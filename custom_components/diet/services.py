@@ -1,19 +1,24 @@
 from __future__ import annotations
 from datetime import timedelta
 import voluptuous as vol
-from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.core import (
+    HomeAssistant,
+    ServiceCall,
+    ServiceResponse,
+    SupportsResponse,
+)
 from homeassistant.helpers import config_validation as cv
 
 from .const import (
     DOMAIN,
-    DEFAULTS,
-    CONF_FREE_MEALS_PER_WEEK,
-    CONF_FREE_LIMIT_MODE,
+    MAX_BULK_ENTRIES,
+    MAX_RANGE_DAYS,
     MEAL_TYPES,
 )
+from .policy import DietPolicy
 from .repository import DietRepo
 from .util import get_profile_id_by_ha_user, check_acl_read, check_acl_write
-from .profiles import sync_profiles_from_ha  # <-- NUOVO
+from .profiles import async_sync_profiles  # <-- NUOVO
 
 
 # ---- Schemi di validazione ---------------------------------------------------
@@ -24,6 +29,8 @@ SCHEMA_APPLY = SCHEMA_OWNER.extend(
     {
         vol.Required("start_date"): cv.date,
         vol.Optional("template_id"): int,
+        # settimane consecutive da pianificare (1 = solo la settimana indicata)
+        vol.Optional("weeks", default=1): vol.All(int, vol.Range(min=1, max=53)),
     }
 )
 
@@ -62,6 +69,50 @@ SCHEMA_CHOICE = SCHEMA_OWNER.extend(
     }
 )
 
+# Scelta di uno slot dentro un'operazione bulk (il giorno è indicato a parte)
+SCHEMA_MEAL_CHOICE = vol.Schema(
+    {
+        vol.Required("meal_type"): vol.In(MEAL_TYPES),
+        vol.Required("source"): vol.In(["proposed", "alternative", "free", "skipped"]),
+        vol.Optional("title"): str,
+        vol.Optional("notes"): str,
+    }
+)
+
+SCHEMA_CHOICES_BULK = SCHEMA_OWNER.extend(
+    {
+        vol.Required("entries"): vol.All(
+            [
+                SCHEMA_MEAL_CHOICE.extend(
+                    {
+                        # default: owner_profile_id del servizio
+                        vol.Optional("owner_profile_id"): int,
+                        vol.Required("date"): cv.date,
+                    }
+                )
+            ],
+            vol.Length(min=1, max=MAX_BULK_ENTRIES),
+        ),
+    }
+)
+
+SCHEMA_DAY_BULK = SCHEMA_OWNER.extend(
+    {
+        vol.Required("days"): vol.All(
+            [
+                {
+                    vol.Optional("owner_profile_id"): int,
+                    vol.Required("date"): cv.date,
+                    vol.Optional("hunger"): vol.All(int, vol.Range(min=1, max=5)),
+                    vol.Optional("snacks"): {vol.In(["am", "pm"]): bool},
+                    vol.Optional("choices"): [SCHEMA_MEAL_CHOICE],
+                }
+            ],
+            vol.Length(min=1, max=MAX_RANGE_DAYS),
+        ),
+    }
+)
+
 # NUOVO: servizio di sync profili da HA User Registry
 SCHEMA_SYNC_PROFILES = vol.Schema(
     {
@@ -73,6 +124,55 @@ SCHEMA_SYNC_PROFILES = vol.Schema(
 )
 
 
+def bulk_rows(data: dict) -> tuple[set[int], list[tuple], list[tuple], list[tuple]]:
+    """Righe per DietRepo.set_bulk da SCHEMA_CHOICES_BULK / SCHEMA_DAY_BULK.
+
+    Ritorna (owner coinvolti, scelte, spuntini, fame).
+    """
+    default_owner = data["owner_profile_id"]
+    choices: list[tuple] = []
+    snacks: list[tuple] = []
+    hunger: list[tuple] = []
+
+    def _choice(owner: int, iso_date: str, c: dict) -> tuple:
+        title = c.get("title") or ""
+        return (owner, iso_date, c["meal_type"], c["source"], title, c.get("notes"))
+
+    for e in data.get("entries", ()):
+        owner = e.get("owner_profile_id", default_owner)
+        choices.append(_choice(owner, e["date"].isoformat(), e))
+    for d in data.get("days", ()):
+        owner = d.get("owner_profile_id", default_owner)
+        iso_date = d["date"].isoformat()
+        if "hunger" in d:
+            hunger.append((owner, iso_date, d["hunger"]))
+        for period, done in d.get("snacks", {}).items():
+            snacks.append((owner, iso_date, period, done))
+        for c in d.get("choices", ()):
+            choices.append(_choice(owner, iso_date, c))
+    owners = {row[0] for row in (*choices, *snacks, *hunger)}
+    return owners, choices, snacks, hunger
+
+
+def write_response(state: dict | None, policy: DietPolicy) -> ServiceResponse:
+    """Risposta dei servizi di scrittura dallo stato letto in transazione."""
+    if state is None:
+        return None
+    quota = policy.free_meals_per_week
+    return {
+        "days": state["days"],
+        "free_meals": [
+            {
+                "week_start": week,
+                "used": used,
+                "quota": quota,
+                "remaining": policy.free_meals_remaining(used),
+            }
+            for week, used in state["free_meals_used"].items()
+        ],
+    }
+
+
 # ---- Registrazione servizi ---------------------------------------------------
 
 
@@ -94,10 +194,20 @@ async def async_register_services(hass: HomeAssistant, db, coord) -> None:
             raise ValueError("Permesso negato")
         return subject_pid
 
+    async def _authorize_writes(call: ServiceCall, owners: set[int]) -> int:
+        """Come _authorize in scrittura, risolvendo il chiamante una sola volta."""
+        subject_pid = await get_profile_id_by_ha_user(hass, db, call.context.user_id)
+        if subject_pid is None:
+            raise ValueError("Profilo non registrato per l'utente corrente")
+        for owner_pid in owners:
+            if not await check_acl_write(db, owner_pid, subject_pid):
+                raise ValueError("Permesso negato")
+        return subject_pid
+
     # ------------------ Servizi core dominio diet ------------------
 
-    async def _apply(call: ServiceCall) -> None:
-        data = SCHEMA_APPLY(call.data)
+    async def _apply(call: ServiceCall) -> ServiceResponse:
+        data = SCHEMA_APPLY(dict(call.data))
         owner_pid = data["owner_profile_id"]
         await _authorize(call, owner_pid, write=True)
 
@@ -108,10 +218,13 @@ async def async_register_services(hass: HomeAssistant, db, coord) -> None:
         if tpl_id is None:
             raise ValueError("Nessun template attivo")
 
-        await repo.apply_week_template(owner_pid, monday, tpl_id)
+        state = await repo.apply_template_range(
+            owner_pid, monday, tpl_id, data["weeks"], with_state=call.return_response
+        )
+        return write_response(state, db.policy)
 
-    async def _swap(call: ServiceCall) -> None:
-        data = SCHEMA_SWAP(call.data)
+    async def _swap(call: ServiceCall) -> ServiceResponse:
+        data = SCHEMA_SWAP(dict(call.data))
         owner_pid = data["owner_profile_id"]
         await _authorize(call, owner_pid, write=True)
 
@@ -123,70 +236,118 @@ async def async_register_services(hass: HomeAssistant, db, coord) -> None:
         if dfrom.isocalendar()[1] != dto.isocalendar()[1]:
             raise ValueError("Lo scambio deve rimanere nella stessa settimana")
 
-        await repo.swap_meal(
-            owner_pid, dfrom.isoformat(), dto.isoformat(), data["meal_type"]
+        state = await repo.swap_meal(
+            owner_pid,
+            dfrom.isoformat(),
+            dto.isoformat(),
+            data["meal_type"],
+            with_state=call.return_response,
         )
+        return write_response(state, db.policy)
 
-    async def _snack(call: ServiceCall) -> None:
-        data = SCHEMA_SNACK(call.data)
+    async def _snack(call: ServiceCall) -> ServiceResponse:
+        data = SCHEMA_SNACK(dict(call.data))
         owner_pid = data["owner_profile_id"]
         await _authorize(call, owner_pid, write=True)
-        await repo.set_snack(
-            owner_pid, data["date"].isoformat(), data["period"], data["done"]
+        state = await repo.set_snack(
+            owner_pid,
+            data["date"].isoformat(),
+            data["period"],
+            data["done"],
+            with_state=call.return_response,
         )
+        return write_response(state, db.policy)
 
-    async def _hunger(call: ServiceCall) -> None:
-        data = SCHEMA_HUNGER(call.data)
+    async def _hunger(call: ServiceCall) -> ServiceResponse:
+        data = SCHEMA_HUNGER(dict(call.data))
         owner_pid = data["owner_profile_id"]
         await _authorize(call, owner_pid, write=True)
-        await repo.set_hunger(owner_pid, data["date"].isoformat(), data["score"])
+        state = await repo.set_hunger(
+            owner_pid,
+            data["date"].isoformat(),
+            data["score"],
+            with_state=call.return_response,
+        )
+        return write_response(state, db.policy)
 
-    async def _choice(call: ServiceCall) -> None:
-        data = SCHEMA_CHOICE(call.data)
+    async def _choice(call: ServiceCall) -> ServiceResponse:
+        data = SCHEMA_CHOICE(dict(call.data))
         owner_pid = data["owner_profile_id"]
         await _authorize(call, owner_pid, write=True)
 
-        src = data["source"]
-        title = data.get("title") or ""
-
-        # Quota free: applica policy hard/soft
-        if src == "free":
-            used = await repo.free_meals_used_in_week(
-                owner_pid, data["date"].isoformat()
-            )
-            quota = DEFAULTS[CONF_FREE_MEALS_PER_WEEK]
-            if used >= quota and DEFAULTS[CONF_FREE_LIMIT_MODE] == "hard":
-                raise ValueError("Quota pasti free settimanale superata")
-
-        await repo.set_choice(
+        # Quota free (hard/soft da db.policy): verificata dal repository
+        # nella stessa transazione della scrittura
+        state = await repo.set_choice(
             owner_pid,
             data["date"].isoformat(),
             data["meal_type"],
-            src,
-            title,
+            data["source"],
+            data.get("title") or "",
             data.get("notes"),
+            with_state=call.return_response,
         )
+        return write_response(state, db.policy)
+
+    async def _bulk(call: ServiceCall, schema: vol.Schema) -> ServiceResponse:
+        owners, choices, snacks, hunger = bulk_rows(schema(dict(call.data)))
+        await _authorize_writes(call, owners)
+        states = await repo.set_bulk(
+            choices,
+            snacks,
+            hunger,
+            with_state=call.return_response,
+        )
+        if states is None:
+            return None
+        return {
+            "profiles": [
+                {"profile_id": pid, **write_response(state, db.policy)}
+                for pid, state in states.items()
+            ]
+        }
+
+    async def _choices_bulk(call: ServiceCall) -> ServiceResponse:
+        """Più scelte (date e pasti diversi) in un'unica transazione."""
+        return await _bulk(call, SCHEMA_CHOICES_BULK)
+
+    async def _day_bulk(call: ServiceCall) -> ServiceResponse:
+        """Fame, spuntini e scelte di più giorni in un'unica transazione."""
+        return await _bulk(call, SCHEMA_DAY_BULK)
 
     # ------------------ NUOVO: servizio di sincronizzazione profili ------------------
 
     async def _sync_profiles(call: ServiceCall) -> None:
         """Sincronizza diet_profiles con l'user registry di Home Assistant."""
-        data = SCHEMA_SYNC_PROFILES(call.data)
-        total = await sync_profiles_from_ha(
+        data = SCHEMA_SYNC_PROFILES(dict(call.data))
+        summary = await async_sync_profiles(
             hass,
             db,
             prune_missing=data["prune_missing"],
             include_system=data["include_system"],
         )
-        # Nessun result richiesto dai servizi HA; log informativo
-        hass.bus.async_fire(f"{DOMAIN}_profiles_synced", {"count": total})
-
-    # Registrazione servizi
-    hass.services.async_register(DOMAIN, "apply_week_template", _apply)
-    hass.services.async_register(DOMAIN, "swap_meal", _swap)
-    hass.services.async_register(DOMAIN, "set_snack", _snack)
-    hass.services.async_register(DOMAIN, "set_hunger", _hunger)
-    hass.services.async_register(DOMAIN, "set_choice", _choice)
+        # Nessun result richiesto dai servizi HA; evento con il riepilogo del diff
+        hass.bus.async_fire(f"{DOMAIN}_profiles_synced", summary)
+
+    async def _rebuild_rollups(call: ServiceCall) -> None:
+        """Ricalcola daily_rollups/weekly_rollups dalle tabelle sorgente."""
+        await repo.rebuild_rollups()
+        await coord.async_refresh()
+
+    # Registrazione servizi: le scritture ritornano, se richiesto, lo stato
+    # aggiornato dei giorni e la quota pasti free (niente get_day successivo)
+    for name, handler in (
+        ("apply_week_template", _apply),
+        ("swap_meal", _swap),
+        ("set_snack", _snack),
+        ("set_hunger", _hunger),
+        ("set_choice", _choice),
+        ("set_choices_bulk", _choices_bulk),
+        ("set_day_bulk", _day_bulk),
+    ):
+        hass.services.async_register(
+            DOMAIN, name, handler, supports_response=SupportsResponse.OPTIONAL
+        )
     hass.services.async_register(
         DOMAIN, "sync_profiles_from_ha", _sync_profiles
     )  # <-- NUOVO
+    hass.services.async_register(DOMAIN, "rebuild_rollups", _rebuild_rollups)
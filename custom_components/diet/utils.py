@@ -6,12 +6,8 @@ async def get_profile_id_by_ha_user(
     hass: HomeAssistant, db, ha_user_id: str
 ) -> int | None:
     """Ritorna il profile_id associato all'utente HA, se presente."""
-    async with db.conn.execute(
-        "SELECT id FROM diet_profiles WHERE ha_user_id=?",
-        (ha_user_id,),
-    ) as c:
-        row = await c.fetchone()
-    return row[0] if row else None
+    await db.acl.async_ensure_loaded(db)
+    return db.acl.profile_id(ha_user_id)
 
 
 async def ensure_profile(
@@ -22,39 +18,30 @@ async def ensure_profile(
     if pid is not None:
         return pid
     dn = display_name or ha_user_id
-    await db.conn.execute(
-        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) "
-        "VALUES(?,?,datetime('now'))",
-        (ha_user_id, dn),
-    )
-    await db.conn.commit()
-    async with db.conn.execute(
-        "SELECT id FROM diet_profiles WHERE ha_user_id=?",
-        (ha_user_id,),
-    ) as c2:
-        r2 = await c2.fetchone()
-    return r2[0]
+
+    async def _write(conn):
+        await conn.execute(
+            "INSERT OR IGNORE INTO diet_profiles(ha_user_id,display_name,created_at) "
+            "VALUES(?,?,datetime('now'))",
+            (ha_user_id, dn),
+        )
+
+    await db.async_write(_write)
+    await db.acl.async_reload(db)
+    return db.acl.profile_id(ha_user_id)
 
 
 async def check_acl_read(db, owner_profile_id: int, subject_profile_id: int) -> bool:
     """Controlla permesso di lettura: consentito se self o ACL can_read=1."""
     if owner_profile_id == subject_profile_id:
         return True
-    async with db.conn.execute(
-        "SELECT can_read FROM profile_acl WHERE owner_profile_id=? AND subject_profile_id=?",
-        (owner_profile_id, subject_profile_id),
-    ) as c:
-        r = await c.fetchone()
-    return bool(r and r[0])
+    await db.acl.async_ensure_loaded(db)
+    return db.acl.can_read(owner_profile_id, subject_profile_id)
 
 
 async def check_acl_write(db, owner_profile_id: int, subject_profile_id: int) -> bool:
     """Controlla permesso di scrittura: consentito se self o ACL can_write=1."""
     if owner_profile_id == subject_profile_id:
         return True
-    async with db.conn.execute(
-        "SELECT can_write FROM profile_acl WHERE owner_profile_id=? AND subject_profile_id=?",
-        (owner_profile_id, subject_profile_id),
-    ) as c:
-        r = await c.fetchone()
-    return bool(r and r[0])
+    await db.acl.async_ensure_loaded(db)
+    return db.acl.can_write(owner_profile_id, subject_profile_id)
@@ -1,11 +1,74 @@
 from __future__ import annotations
+import asyncio
 from datetime import datetime, timedelta
+import logging
+from typing import Any, Callable
 
+import voluptuous as vol
 from homeassistant.components import websocket_api
-from homeassistant.core import HomeAssistant
+from homeassistant.components.websocket_api.messages import construct_result_message
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.json import json_bytes, json_fragment
+from homeassistant.util import dt as dt_util
 
+from .const import (
+    DEFAULT_HORIZON_HOURS,
+    HISTORY_PAGE_SIZE,
+    MAX_HISTORY_PAGE_SIZE,
+    MAX_BATCH_REQUESTS,
+    MAX_HORIZON_HOURS,
+    MAX_RANGE_DAYS,
+    SIGNAL_DAY_CHANGED,
+)
 from .repository import DietRepo
-from .util import get_profile_id_by_ha_user, check_acl_read
+from .services import SCHEMA_CHOICES_BULK, SCHEMA_DAY_BULK, bulk_rows
+from .util import get_profile_id_by_ha_user, check_acl_read, check_acl_write
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class _CommandError(Exception):
+    """Errore di un comando di lettura, inviato come ``send_error(code, message)``."""
+
+    def __init__(self, code: str, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+def _fragments(templates: dict[int, bytes]) -> dict[str, Any]:
+    """Dizionario template di get_range_json, pronto per json_bytes."""
+    return {str(tid): json_fragment(data) for tid, data in templates.items()}
+
+
+def _day_delta(old: dict[str, Any] | None, new: dict[str, Any]) -> dict | None:
+    """Differenze tra due payload dello stesso giorno (None se identici).
+
+    Se cambia la struttura dei pasti (es. giorno appena pianificato) il giorno
+    viene reinviato per intero in ``day``; altrimenti solo pasti, spuntini,
+    fame e note modificati.
+    """
+    if old == new:
+        return None
+    delta: dict[str, Any] = {"date": new["date"]}
+    old_types = [m["meal_type"] for m in old["meals"]] if old else None
+    if old_types != [m["meal_type"] for m in new["meals"]]:
+        delta["day"] = new
+        return delta
+    meals = [n for o, n in zip(old["meals"], new["meals"]) if o != n]
+    if meals:
+        delta["meals"] = meals
+    snacks = {
+        period: state
+        for period, state in new["snacks"].items()
+        if old["snacks"].get(period) != state
+    }
+    if snacks:
+        delta["snacks"] = snacks
+    for key in ("hunger", "notes"):
+        if old.get(key) != new.get(key):
+            delta[key] = new.get(key)
+    return delta
 
 
 async def async_register_ws(hass: HomeAssistant, db, coord) -> None:
@@ -18,73 +81,272 @@ async def async_register_ws(hass: HomeAssistant, db, coord) -> None:
         uid = connection.user.id
         return await get_profile_id_by_ha_user(hass, db, uid)
 
+    # Comandi di lettura: query(subject, msg) -> result, usate sia dal comando
+    # WebSocket omonimo sia da diet/batch
+    read_commands: dict[str, tuple[vol.Schema, Callable]] = {}
+
+    def _read_command(schema: dict, query: Callable):
+        """Registra una query di lettura e ne costruisce l'handler WebSocket."""
+        read_commands[schema["type"]] = (vol.Schema(schema), query)
+
+        @websocket_api.websocket_command(schema)
+        @websocket_api.async_response
+        async def _handler(hass, connection, msg):
+            subject = await _subject_pid(connection)
+            try:
+                result = await query(subject, msg)
+            except _CommandError as err:
+                connection.send_error(msg["id"], err.code, str(err))
+                return
+            # i giorni sono già frammenti JSON: si serializza solo l'involucro
+            connection.send_message(
+                construct_result_message(msg["id"], json_bytes(result))
+            )
+
+        return _handler
+
+    async def _require_read(owner: int, subject: int | None) -> int:
+        if not await check_acl_read(db, owner, subject):
+            raise _CommandError("forbidden", "Permesso negato")
+        return owner
+
     # ---------------------------------------------------------------------
     # CAPABILITIES
     # ---------------------------------------------------------------------
-    @websocket_api.websocket_command({"type": "diet/get_capabilities"})
-    @websocket_api.async_response
-    async def ws_get_capabilities(hass, connection, msg):
-        subject = await _subject_pid(connection)
+    async def _get_capabilities(subject, msg):
         if subject is None:
-            connection.send_result(
-                msg["id"], {"subject_profile_id": None, "profiles": []}
-            )
-            return
+            return {"subject_profile_id": None, "profiles": []}
 
-        profiles = []
-        async with db.conn.execute("SELECT id,display_name FROM diet_profiles") as c:
-            async for r in c:
-                pid, name = r
-                can_read = await check_acl_read(db, pid, subject)
+        # scansione in memoria dell'indice ACL (nessuna query)
+        acl = db.acl
+        profiles = [
+            {
+                "profile_id": pid,
+                "display_name": name,
+                "can_read": acl.can_read(pid, subject),
                 # policy: solo self in scrittura (di default)
-                can_write = pid == subject
-                profiles.append(
-                    {
-                        "profile_id": pid,
-                        "display_name": name,
-                        "can_read": bool(can_read),
-                        "can_write": bool(can_write),
-                    }
-                )
+                "can_write": pid == subject,
+            }
+            for pid, name in acl.snapshot.names.items()
+        ]
+        return {"subject_profile_id": subject, "profiles": profiles}
 
-        connection.send_result(
-            msg["id"], {"subject_profile_id": subject, "profiles": profiles}
-        )
+    ws_get_capabilities = _read_command(
+        {"type": "diet/get_capabilities"}, _get_capabilities
+    )
 
     # ---------------------------------------------------------------------
     # GET DAY
     # ---------------------------------------------------------------------
-    @websocket_api.websocket_command(
+    async def _get_day(subject, msg):
+        owner = await _require_read(int(msg["owner_profile_id"]), subject)
+        try:
+            day = datetime.fromisoformat(msg["date"]).date().isoformat()
+        except ValueError as err:
+            raise _CommandError("invalid_format", "Data non valida") from err
+        known = msg.get("version")
+        changed, versions, _ = await repo.get_range_json(
+            owner, day, day, {} if known is None else {day: known}
+        )
+        if not changed:
+            return {"date": day, "version": versions[day], "not_modified": True}
+        # JSON del giorno dalla DayCache, con la versione aggiunta in coda
+        (payload,) = changed
+        return json_fragment(b'%s,"version":%d}' % (payload[:-1], versions[day]))
+
+    ws_get_day = _read_command(
         {
             "type": "diet/get_day",
             "owner_profile_id": int,
             "date": str,  # ISO YYYY-MM-DD
+            # versione già nota al client: se invariata risponde not_modified
+            vol.Optional("version"): int,
+        },
+        _get_day,
+    )
+
+    # ---------------------------------------------------------------------
+    # GET WEEK
+    # ---------------------------------------------------------------------
+    async def _get_week(subject, msg):
+        owner = await _require_read(int(msg["owner_profile_id"]), subject)
+        try:
+            dt = datetime.fromisoformat(msg["start_date"])
+        except ValueError as err:
+            raise _CommandError("invalid_format", "Data non valida") from err
+        monday = (dt - timedelta(days=dt.weekday())).date()
+        sunday = monday + timedelta(days=6)
+        days, versions, templates = await repo.get_range_json(
+            owner,
+            monday.isoformat(),
+            sunday.isoformat(),
+            msg.get("versions"),
+            msg["compact"],
+        )
+        result = {
+            "start": monday.isoformat(),
+            "days": [json_fragment(d) for d in days],
+            "versions": versions,
+            "not_modified": not days,
+        }
+        if msg["compact"]:
+            result["templates"] = _fragments(templates)
+        return result
+
+    ws_get_week = _read_command(
+        {
+            "type": "diet/get_week",
+            "owner_profile_id": int,
+            "start_date": str,  # qualsiasi giorno della settimana; sarà normalizzato al lunedì
+            # {date: versione} già noti al client: tornano solo i giorni cambiati
+            vol.Optional("versions"): {str: int},
+            # pasti come riferimenti al dizionario "templates" (template_meal_id)
+            vol.Optional("compact", default=False): bool,
+        },
+        _get_week,
+    )
+
+    # ---------------------------------------------------------------------
+    # GET RANGE (viste mensili)
+    # ---------------------------------------------------------------------
+    async def _get_range(subject, msg):
+        owner = await _require_read(int(msg["owner_profile_id"]), subject)
+        try:
+            start = datetime.fromisoformat(msg["start_date"]).date()
+            end = datetime.fromisoformat(msg["end_date"]).date()
+        except ValueError as err:
+            raise _CommandError("invalid_format", "Data non valida") from err
+        if end < start or (end - start).days >= MAX_RANGE_DAYS:
+            raise _CommandError(
+                "invalid_range",
+                f"Intervallo non valido (massimo {MAX_RANGE_DAYS} giorni)",
+            )
+        days, _, templates = await repo.get_range_json(
+            owner, start.isoformat(), end.isoformat(), compact=msg["compact"]
+        )
+        result = {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "days": [json_fragment(d) for d in days],
+        }
+        if msg["compact"]:
+            result["templates"] = _fragments(templates)
+        return result
+
+    ws_get_range = _read_command(
+        {
+            "type": "diet/get_range",
+            "owner_profile_id": int,
+            "start_date": str,  # ISO YYYY-MM-DD
+            "end_date": str,  # ISO YYYY-MM-DD (incluso)
+            vol.Optional("compact", default=False): bool,
+        },
+        _get_range,
+    )
+
+    # ---------------------------------------------------------------------
+    # SUBSCRIBE DAY / WEEK (snapshot + delta push)
+    # ---------------------------------------------------------------------
+    async def _async_subscribe(connection, msg_id: int, owner: int, dates: list[str]):
+        """Invia lo snapshot dei giorni e poi i soli cambiamenti, a ogni scrittura.
+
+        Le scritture del repository inviano SIGNAL_DAY_CHANGED con le date
+        toccate: i giorni sottoscritti vengono riletti (DayCache condivisa
+        tra le sottoscrizioni) e confrontati con l'ultimo stato inviato.
+        """
+        wanted = set(dates)
+        sent: dict[str, dict] = {}
+        pending: set[str] = set()
+        task: asyncio.Task | None = None
+        ready = False
+
+        async def _push() -> None:
+            while pending:
+                touched = sorted(pending)
+                pending.clear()
+                days = await repo.get_range(owner, touched[0], touched[-1])
+                changes = []
+                for day in days:
+                    if day["date"] not in touched:
+                        continue
+                    delta = _day_delta(sent.get(day["date"]), day)
+                    sent[day["date"]] = day
+                    if delta:
+                        changes.append(delta)
+                if changes:
+                    connection.send_message(
+                        websocket_api.event_message(
+                            msg_id, {"type": "delta", "changes": changes}
+                        )
+                    )
+
+        def _schedule() -> None:
+            nonlocal task
+            if task is None or task.done():
+                task = hass.async_create_task(_push())
+
+        @callback
+        def _day_changed(profile_id: int, changed: tuple[str, ...]) -> None:
+            if profile_id != owner:
+                return
+            hit = wanted.intersection(changed)
+            if not hit:
+                return
+            pending.update(hit)
+            if ready:
+                _schedule()
+
+        unsub_dispatcher = async_dispatcher_connect(
+            hass, SIGNAL_DAY_CHANGED, _day_changed
+        )
+
+        @callback
+        def _unsubscribe() -> None:
+            unsub_dispatcher()
+            if task is not None:
+                task.cancel()
+
+        connection.subscriptions[msg_id] = _unsubscribe
+        connection.send_result(msg_id)
+
+        # connesso prima dello snapshot: le scritture concorrenti restano in pending
+        days = await repo.get_range(owner, dates[0], dates[-1])
+        sent.update((day["date"], day) for day in days)
+        snapshot = [json_fragment(d) for d in repo.to_json(owner, days)]
+        connection.send_message(
+            websocket_api.event_message(msg_id, {"type": "snapshot", "days": snapshot})
+        )
+        ready = True
+        if pending:
+            _schedule()
+
+    @websocket_api.websocket_command(
+        {
+            "type": "diet/subscribe_day",
+            "owner_profile_id": int,
+            "date": str,  # ISO YYYY-MM-DD
         }
     )
     @websocket_api.async_response
-    async def ws_get_day(hass, connection, msg):
+    async def ws_subscribe_day(hass, connection, msg):
         subject = await _subject_pid(connection)
         owner = int(msg.get("owner_profile_id"))
         if not await check_acl_read(db, owner, subject):
             connection.send_error(msg["id"], "forbidden", "Permesso negato")
             return
 
-        date = msg.get("date")
-        res = await repo.get_day(owner, date)
-        connection.send_result(msg["id"], res)
+        day = datetime.fromisoformat(msg.get("date")).date().isoformat()
+        await _async_subscribe(connection, msg["id"], owner, [day])
 
-    # ---------------------------------------------------------------------
-    # GET WEEK
-    # ---------------------------------------------------------------------
     @websocket_api.websocket_command(
         {
-            "type": "diet/get_week",
+            "type": "diet/subscribe_week",
             "owner_profile_id": int,
             "start_date": str,  # qualsiasi giorno della settimana; sarà normalizzato al lunedì
         }
     )
     @websocket_api.async_response
-    async def ws_get_week(hass, connection, msg):
+    async def ws_subscribe_week(hass, connection, msg):
         subject = await _subject_pid(connection)
         owner = int(msg.get("owner_profile_id"))
         if not await check_acl_read(db, owner, subject):
@@ -92,67 +354,161 @@ async def async_register_ws(hass: HomeAssistant, db, coord) -> None:
             return
 
         dt = datetime.fromisoformat(msg.get("start_date"))
-        monday = (dt - timedelta(days=dt.weekday())).date().isoformat()
-        days = await repo.get_week(owner, monday)
-        connection.send_result(msg["id"], {"start": monday, "days": days})
+        monday = (dt - timedelta(days=dt.weekday())).date()
+        dates = [(monday + timedelta(days=i)).isoformat() for i in range(7)]
+        await _async_subscribe(connection, msg["id"], owner, dates)
+
+    # ---------------------------------------------------------------------
+    # HISTORY (pagine con cursore, per frontend ed export)
+    # ---------------------------------------------------------------------
+    async def _get_history(subject, msg):
+        owner = await _require_read(int(msg["owner_profile_id"]), subject)
+        try:
+            start = datetime.fromisoformat(msg["start_date"]).date().isoformat()
+            end = datetime.fromisoformat(msg["end_date"]).date().isoformat()
+            cursor = msg.get("cursor")
+            if cursor is not None:
+                cursor = datetime.fromisoformat(cursor).date().isoformat()
+        except ValueError as err:
+            raise _CommandError("invalid_format", "Data o cursore non validi") from err
+
+        days, next_cursor = await repo.get_history_page(
+            owner, start, end, msg["page_size"], cursor
+        )
+        return {"days": days, "next_cursor": next_cursor}
+
+    ws_get_history = _read_command(
+        {
+            "type": "diet/get_history",
+            "owner_profile_id": int,
+            "start_date": str,  # ISO YYYY-MM-DD
+            "end_date": str,  # ISO YYYY-MM-DD (incluso)
+            vol.Optional("page_size", default=HISTORY_PAGE_SIZE): vol.All(
+                int, vol.Range(min=1, max=MAX_HISTORY_PAGE_SIZE)
+            ),
+            # next_cursor della pagina precedente
+            vol.Optional("cursor"): vol.Any(str, None),
+        },
+        _get_history,
+    )
 
     # ---------------------------------------------------------------------
     # NEXT MEALS (vista comune pranzo/cena)
     # ---------------------------------------------------------------------
-    @websocket_api.websocket_command(
+    async def _get_next_meals(subject, msg):
+        # ACL dall'indice in memoria; una sola query per tutti i profili leggibili
+        owners = [
+            pid
+            for pid in dict.fromkeys(msg["owner_profile_ids"])
+            if await check_acl_read(db, pid, subject)
+        ]
+        now = dt_util.now()
+        horizon = now + timedelta(hours=msg["horizon_hours"])
+        return {
+            "now": now.isoformat(timespec="seconds"),
+            "horizon": horizon.isoformat(timespec="seconds"),
+            "profiles": await repo.get_next_meals(owners, now, horizon),
+        }
+
+    ws_get_next_meals = _read_command(
         {
             "type": "diet/get_next_meals",
-            "owner_profile_ids": list,  # [int, ...]
-            "horizon_hours": int,  # default 36
+            "owner_profile_ids": [int],
+            vol.Optional("horizon_hours", default=DEFAULT_HORIZON_HOURS): vol.All(
+                int, vol.Range(min=1, max=MAX_HORIZON_HOURS)
+            ),
+        },
+        _get_next_meals,
+    )
+
+    # ---------------------------------------------------------------------
+    # BATCH (più letture in un solo round trip)
+    # ---------------------------------------------------------------------
+    async def _run_sub_request(subject, request: dict) -> dict:
+        """Esegue una sotto-richiesta; gli errori restano confinati al suo esito."""
+        command = read_commands.get(request.get("type"))
+        if command is None:
+            return {
+                "success": False,
+                "error": {
+                    "code": "unknown_command",
+                    "message": f"Comando non supportato in batch: {request.get('type')}",
+                },
+            }
+        schema, query = command
+        try:
+            result = await query(subject, schema(request))
+        except vol.Invalid as err:
+            error = {"code": "invalid_format", "message": str(err)}
+        except _CommandError as err:
+            error = {"code": err.code, "message": str(err)}
+        except Exception as err:  # pylint: disable=broad-except
+            _LOGGER.exception("Errore in diet/batch (%s)", request.get("type"))
+            error = {"code": "unknown_error", "message": str(err)}
+        else:
+            return {"success": True, "result": result}
+        return {"success": False, "error": error}
+
+    @websocket_api.websocket_command(
+        {
+            "type": "diet/batch",
+            # sotto-richieste senza "id": {"type": "diet/get_week", ...}
+            "requests": vol.All([dict], vol.Length(min=1, max=MAX_BATCH_REQUESTS)),
         }
     )
     @websocket_api.async_response
-    async def ws_get_next_meals(hass, connection, msg):
+    async def ws_batch(hass, connection, msg):
+        # utente → profilo risolto una sola volta per tutte le sotto-richieste
         subject = await _subject_pid(connection)
-        owners = [int(x) for x in msg.get("owner_profile_ids", [])]
-        now = datetime.now()
-        horizon = now + timedelta(hours=int(msg.get("horizon_hours", 36)))
-
-        payload = {
-            "now": now.isoformat(timespec="seconds"),
-            "horizon": horizon.isoformat(timespec="seconds"),
-            "profiles": [],
-        }
+        results = await asyncio.gather(
+            *(_run_sub_request(subject, request) for request in msg["requests"])
+        )
+        connection.send_message(
+            construct_result_message(msg["id"], json_bytes({"results": results}))
+        )
 
-        for pid in owners:
-            if not await check_acl_read(db, pid, subject):
-                continue
-
-            meals = []
-            # oggi
-            today = now.date().isoformat()
-            day = await repo.get_day(pid, today)
-
-            for mt in ("lunch", "dinner"):
-                m = next((x for x in day["meals"] if x["meal_type"] == mt), None)
-                if m:
-                    status = m["chosen"]["source"] if m.get("chosen") else "planned"
-                    title = (
-                        m["chosen"]["title"]
-                        if m.get("chosen")
-                        else (m["proposed"]["title"] if m.get("proposed") else "")
-                    )
-                    meals.append(
-                        {"type": mt, "date": today, "title": title, "status": status}
-                    )
+    # ---------------------------------------------------------------------
+    # SCRITTURE BULK (stessi schemi dei servizi set_choices_bulk / set_day_bulk)
+    # ---------------------------------------------------------------------
+    async def _write_bulk(connection, msg) -> None:
+        subject = await _subject_pid(connection)
+        owners, choices, snacks, hunger = bulk_rows(msg)
+        for owner in owners:
+            if subject is None or not await check_acl_write(db, owner, subject):
+                connection.send_error(msg["id"], "forbidden", "Permesso negato")
+                return
+        try:
+            await repo.set_bulk(choices, snacks, hunger)
+        except ValueError as err:
+            connection.send_error(msg["id"], "quota_exceeded", str(err))
+            return
+        connection.send_result(
+            msg["id"], {"written": len(choices) + len(snacks) + len(hunger)}
+        )
 
-            payload["profiles"].append(
-                {
-                    "profile_id": pid,
-                    "display_name": "",  # opzionale: popolare con join su diet_profiles
-                    "upcoming": meals,
-                }
-            )
+    @websocket_api.websocket_command(
+        {"type": "diet/set_choices_bulk", **SCHEMA_CHOICES_BULK.schema}
+    )
+    @websocket_api.async_response
+    async def ws_set_choices_bulk(hass, connection, msg):
+        await _write_bulk(connection, msg)
 
-        connection.send_result(msg["id"], payload)
+    @websocket_api.websocket_command(
+        {"type": "diet/set_day_bulk", **SCHEMA_DAY_BULK.schema}
+    )
+    @websocket_api.async_response
+    async def ws_set_day_bulk(hass, connection, msg):
+        await _write_bulk(connection, msg)
 
     # Registrazione comandi
     hass.components.websocket_api.async_register_command(ws_get_capabilities)
     hass.components.websocket_api.async_register_command(ws_get_day)
     hass.components.websocket_api.async_register_command(ws_get_week)
+    hass.components.websocket_api.async_register_command(ws_get_range)
+    hass.components.websocket_api.async_register_command(ws_get_history)
+    hass.components.websocket_api.async_register_command(ws_subscribe_day)
+    hass.components.websocket_api.async_register_command(ws_subscribe_week)
     hass.components.websocket_api.async_register_command(ws_get_next_meals)
+    hass.components.websocket_api.async_register_command(ws_batch)
+    hass.components.websocket_api.async_register_command(ws_set_choices_bulk)
+    hass.components.websocket_api.async_register_command(ws_set_day_bulk)
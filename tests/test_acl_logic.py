@@ -34,3 +34,36 @@ async def test_acl_cross_read_only(diet_db):
 
     assert await check_acl_read(db, 1, 2) is True
     assert await check_acl_write(db, 1, 2) is False
+
+
+@pytest.mark.asyncio
+async def test_acl_index_is_in_memory_and_rebuilt_on_sync(hass, diet_db, fake_users_three, monkeypatch):
+    from custom_components.diet.profiles import sync_profiles_from_ha
+    from custom_components.diet.util import get_profile_id_by_ha_user
+
+    db, _ = diet_db
+
+    async def _fake_get_users():
+        return fake_users_three
+
+    monkeypatch.setattr(hass.auth, "async_get_users", _fake_get_users)
+
+    # indice caricato prima del sync: nessun profilo
+    assert await get_profile_id_by_ha_user(hass, db, "user-1") is None
+
+    await sync_profiles_from_ha(hass, db)
+    pid1 = await get_profile_id_by_ha_user(hass, db, "user-1")
+    pid2 = await get_profile_id_by_ha_user(hass, db, "user-2")
+    assert pid1 is not None and pid2 is not None
+
+    # autorizzazione senza round trip verso SQLite
+    statements: list[str] = []
+    for conn in (db.conn, *db.readers):
+        await conn.set_trace_callback(statements.append)
+    assert await get_profile_id_by_ha_user(hass, db, "user-3") is not None
+    assert await check_acl_read(db, pid1, pid2) is True
+    assert await check_acl_write(db, pid1, pid2) is False
+    for conn in (db.conn, *db.readers):
+        await conn.set_trace_callback(None)
+    assert statements == []
+    assert len(db.acl.snapshot.names) == 3
@@ -0,0 +1,88 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+
+from custom_components.diet.coordinator import DietCoordinator
+from custom_components.diet.sensor import (
+    FreeMealsUsedWeekSensor,
+    HungerAvgSensor,
+    SnacksCompletedTodaySensor,
+)
+
+
+@pytest.mark.asyncio
+async def test_coordinator_computes_all_profiles_in_constant_queries(hass, diet_db):
+    db, _ = diet_db
+    # 'now' di SQLite è UTC
+    now = datetime.now(timezone.utc).date()
+    today = now.isoformat()
+
+    # un giorno diverso (entro 7) per profilo
+    n_profiles = 5
+    for pid in range(1, n_profiles + 1):
+        await db.conn.execute(
+            "INSERT INTO plan_days(date,profile_id,template_id,hunger,created_at,updated_at) "
+            "VALUES (?,?,1,?,datetime('now'),datetime('now'))",
+            ((now - timedelta(days=pid - 1)).isoformat(), pid, pid),
+        )
+        await db.conn.execute(
+            "INSERT INTO snacks(profile_id,date,period,done,ts) VALUES (?,?,?,1,datetime('now'))",
+            (pid, today, "am"),
+        )
+    await db.conn.execute(
+        "INSERT INTO free_meals(profile_id,date,meal_type,notes,ts) VALUES (2,?,'dinner','',datetime('now'))",
+        (today,),
+    )
+    await db.conn.commit()
+
+    coord = DietCoordinator(hass, db)
+    statements: list[str] = []
+    for conn in (db.conn, *db.readers):
+        await conn.set_trace_callback(statements.append)
+    await coord.async_initialize()
+    for conn in (db.conn, *db.readers):
+        await conn.set_trace_callback(None)
+
+    assert len(statements) == 3
+    assert set(coord.data) == set(range(1, n_profiles + 1))
+    assert coord.data[2]["free_meals_week"] == 1
+    assert "free_meals_week" not in coord.data[1]
+
+    # i sensori leggono solo da coordinator.data
+    assert SnacksCompletedTodaySensor(coord, 1, "A").native_value == 1
+    assert FreeMealsUsedWeekSensor(coord, 1, "A").native_value == 0
+    assert FreeMealsUsedWeekSensor(coord, 2, "B").native_value == 1
+    assert HungerAvgSensor(coord, 3, "C").native_value == 3.0
+    assert HungerAvgSensor(coord, 99, "X").native_value is None
+
+    await coord.async_shutdown()
+
+
+@pytest.mark.asyncio
+async def test_repository_writes_push_profile_metrics(hass, diet_db):
+    from custom_components.diet.repository import DietRepo
+
+    db, _ = diet_db
+    today = datetime.now(timezone.utc).date().isoformat()
+    coord = DietCoordinator(hass, db)
+    await coord.async_initialize()
+    assert coord.data == {}
+
+    updates = []
+    coord.async_add_listener(lambda: updates.append(dict(coord.data)))
+
+    statements: list[str] = []
+    for conn in db.readers:
+        await conn.set_trace_callback(statements.append)
+    repo = DietRepo(db)
+    await repo.set_snack(7, today, "am", True)
+    await repo.set_snack(7, today, "pm", True)
+    await hass.async_block_till_done()
+    for conn in db.readers:
+        await conn.set_trace_callback(None)
+
+    assert coord.data[7]["snacks_today"] == 2
+    assert updates and updates[-1][7]["snacks_today"] == 2
+    # ricalcolo del solo profilo toccato
+    assert statements and all("profile_id=7" in s for s in statements)
+
+    await coord.async_shutdown()
@@ -1,4 +1,6 @@
+import logging
 import pytest
+from custom_components.diet.db import DietDb, SCHEMA_VERSION
 
 
 @pytest.mark.asyncio
@@ -33,3 +35,257 @@ async def test_schema_created(diet_db):
     async with db.conn.execute("PRAGMA table_info(template_meals)") as c:
         cols = {r[1] async for r in c}
     assert "default_source" in cols, "Colonna default_source mancante su template_meals"
+
+
+@pytest.mark.asyncio
+async def test_wal_and_read_pool(diet_db):
+    db, _ = diet_db
+
+    async with db.conn.execute("PRAGMA journal_mode") as c:
+        assert (await c.fetchone())[0] == "wal"
+    assert len(db.readers) >= 1
+
+    # Scrittura non ancora committata: i lettori vedono l'ultimo snapshot senza bloccarsi
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        ("user-1", "Diego"),
+    )
+    async with db.read() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM diet_profiles") as c:
+            assert (await c.fetchone())[0] == 0
+    await db.conn.commit()
+    async with db.read() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM diet_profiles") as c:
+            assert (await c.fetchone())[0] == 1
+
+    # Il pool è di sola lettura
+    async with db.read() as conn:
+        with pytest.raises(Exception):
+            await conn.execute("DELETE FROM diet_profiles")
+
+
+@pytest.mark.asyncio
+async def test_read_pool_opens_paths_with_uri_characters(hass, tmp_path):
+    config = tmp_path / "conf?ig#100%"
+    orig_path = hass.config.path
+    hass.config.path = lambda *p: str(config.joinpath(*p))  # type: ignore[attr-defined]
+    db = DietDb(hass)
+    try:
+        await db.async_open()
+        await db.conn.execute(
+            "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+            ("user-1", "Diego"),
+        )
+        await db.conn.commit()
+        async with db.read() as conn:
+            async with conn.execute("SELECT COUNT(*) FROM diet_profiles") as c:
+                assert (await c.fetchone())[0] == 1
+    finally:
+        await db.async_close()
+        hass.config.path = orig_path  # type: ignore[attr-defined]
+
+
+# day_meals com'era fino alla v8: una riga per ogni scelta registrata
+LEGACY_DAY_MEALS = """
+    DROP TABLE day_meals;
+    DROP TABLE day_meal_history;
+    CREATE TABLE day_meals (
+        id INTEGER PRIMARY KEY,
+        profile_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        meal_type TEXT NOT NULL,
+        chosen_source TEXT NOT NULL,
+        chosen_title TEXT,
+        chosen_label TEXT,
+        chosen_items TEXT,
+        notes TEXT,
+        ts TEXT
+    );
+    CREATE INDEX idx_day_meals_p ON day_meals(profile_id, date, meal_type);
+"""
+
+
+async def _downgrade_to_v5(db, data: str = "") -> list[str]:
+    """Riporta lo schema alla v5 (niente rev su week_templates né trigger).
+
+    ``data`` è SQL eseguito sullo schema v5; ritorna i trigger eliminati.
+    """
+    async with db.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='trigger'"
+    ) as c:
+        triggers = [r[0] async for r in c]
+    for name in triggers:
+        await db.conn.execute(f"DROP TRIGGER {name}")
+    await db.conn.executescript(LEGACY_DAY_MEALS + data)
+    await db.conn.execute("ALTER TABLE week_templates DROP COLUMN rev")
+    await db.conn.execute("UPDATE meta SET value='5' WHERE key='schema_version'")
+    await db.conn.commit()
+    await db.async_close()
+    return triggers
+
+
+@pytest.mark.asyncio
+async def test_migrates_v5_database(hass, diet_db):
+    db, _ = diet_db
+    triggers = await _downgrade_to_v5(db)
+
+    await db.async_open()
+    async with db.conn.execute("SELECT value FROM meta WHERE key='schema_version'") as c:
+        assert int((await c.fetchone())[0]) == SCHEMA_VERSION
+    async with db.conn.execute("PRAGMA table_info(week_templates)") as c:
+        assert "rev" in {r[1] async for r in c}
+    async with db.conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='trigger'"
+    ) as c:
+        assert (await c.fetchone())[0] == len(triggers)
+
+
+@pytest.mark.asyncio
+async def test_migrates_plan_days_to_composite_key(hass, diet_db):
+    db, _ = diet_db
+    # schema v7: plan_days con la sola data come chiave
+    await db.conn.executescript(
+        """
+        DROP TABLE plan_days;
+        CREATE TABLE plan_days (
+            date TEXT PRIMARY KEY,
+            profile_id INTEGER NOT NULL,
+            template_id INTEGER NOT NULL,
+            hunger INTEGER,
+            notes TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX idx_plan_days_p ON plan_days(profile_id, date);
+        INSERT INTO plan_days VALUES ('2025-03-03', 1, 1, 4, 'n', 'c', 'u');
+        INSERT INTO plan_days VALUES ('2025-03-04', 2, 1, NULL, NULL, 'c', 'u');
+        UPDATE meta SET value='7' WHERE key='schema_version';
+        """
+        + LEGACY_DAY_MEALS
+    )
+    await db.conn.commit()
+    await db.async_close()
+
+    progress = []
+    db.migration_progress = progress.append
+    await db.async_open()
+    assert {p.version for p in progress} == {8, 9, 10}
+    assert progress[-1].step == progress[-1].steps
+    assert (await db.async_migration_history())[8]["rows"] == 2
+    async with db.conn.execute("PRAGMA table_info(plan_days)") as c:
+        pk = {r[1]: r[5] async for r in c if r[5]}
+    assert pk == {"profile_id": 1, "date": 2}
+    async with db.conn.execute("SELECT * FROM plan_days ORDER BY date") as c:
+        rows = [tuple(r) async for r in c]
+    assert rows == [
+        ("2025-03-03", 1, 1, 4, "n", "c", "u"),
+        ("2025-03-04", 2, 1, None, None, "c", "u"),
+    ]
+
+    # i trigger dei rollup su plan_days sono stati ricreati
+    await db.conn.execute(
+        "INSERT INTO plan_days(date,profile_id,template_id,hunger,created_at,updated_at) "
+        "VALUES ('2025-03-03', 2, 1, 2, 'c', 'u')"
+    )
+    await db.conn.commit()
+    async with db.conn.execute(
+        "SELECT hunger_sum FROM daily_rollups WHERE profile_id=2 AND date='2025-03-03'"
+    ) as c:
+        assert (await c.fetchone())[0] == 2
+
+    async with db.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'"
+    ) as c:
+        indexes = {r[0] async for r in c}
+    assert "idx_plan_days_p" not in indexes and "idx_snacks_p" not in indexes
+    assert {"idx_free_meals_p", "idx_template_meals_t", "idx_swaps_p"} <= indexes
+
+
+@pytest.mark.asyncio
+async def test_migrates_day_meals_to_current_choice(hass, diet_db):
+    db, _ = diet_db
+    await db.conn.executescript(
+        LEGACY_DAY_MEALS
+        + """
+        INSERT INTO day_meals(profile_id,date,meal_type,chosen_source,chosen_title,ts)
+        VALUES (1,'2025-03-03','dinner','free','FREE – dinner','t1'),
+               (1,'2025-03-03','dinner','alternative','Zuppa','t2'),
+               (1,'2025-03-03','lunch','proposed','Riso','t3'),
+               (1,'2025-03-03','dinner','proposed','Pesce','t4');
+        UPDATE meta SET value='8' WHERE key='schema_version';
+        """
+    )
+    await db.conn.commit()
+    await db.async_close()
+
+    await db.async_open()
+    async with db.conn.execute(
+        "SELECT meal_type, chosen_title FROM day_meals ORDER BY meal_type"
+    ) as c:
+        assert [tuple(r) async for r in c] == [("dinner", "Pesce"), ("lunch", "Riso")]
+    async with db.conn.execute("SELECT id, ts FROM day_meal_history ORDER BY id") as c:
+        assert [tuple(r) async for r in c] == [
+            (1, "t1"),
+            (2, "t2"),
+            (3, "t3"),
+            (4, "t4"),
+        ]
+    # i rollup contano le sole scelte correnti
+    async with db.conn.execute(
+        "SELECT choices_proposed, choices_alternative, choices_free FROM daily_rollups "
+        "WHERE profile_id=1 AND date='2025-03-03'"
+    ) as c:
+        assert tuple(await c.fetchone()) == (2, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_migration_logs_chunk_progress_by_default(hass, diet_db, caplog):
+    db, _ = diet_db
+    await db.conn.executescript(
+        LEGACY_DAY_MEALS
+        + """
+        INSERT INTO day_meals(profile_id,date,meal_type,chosen_source,chosen_title,ts)
+        VALUES (1,'2025-03-03','dinner','free','FREE – dinner','t1'),
+               (1,'2025-03-03','lunch','proposed','Riso','t2');
+        UPDATE meta SET value='8' WHERE key='schema_version';
+        """
+    )
+    await db.conn.commit()
+    await db.async_close()
+
+    caplog.set_level(logging.INFO, logger="custom_components.diet.migrations")
+    await db.async_open()
+    assert "v9 (passo 2/3): day_meals, 2/2 righe copiate" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_migration_keeps_one_free_meal_per_current_free_choice(hass, diet_db):
+    db, _ = diet_db
+    # v5: ogni set_choice free aggiungeva una riga, anche per slot già free
+    await _downgrade_to_v5(
+        db,
+        """
+        INSERT INTO day_meals(profile_id,date,meal_type,chosen_source,chosen_title,ts)
+        VALUES (1,'2025-03-03','dinner','free','Pizza','t1'),
+               (1,'2025-03-03','dinner','free','Sushi','t2'),
+               (1,'2025-03-03','dinner','proposed','Pesce','t3'),
+               (1,'2025-03-04','lunch','free','Kebab','t4'),
+               (1,'2025-03-04','lunch','free','Burger','t5');
+        INSERT INTO free_meals(profile_id,date,meal_type,notes,ts)
+        VALUES (1,'2025-03-03','dinner','Pizza','t1'),
+               (1,'2025-03-03','dinner','Sushi','t2'),
+               (1,'2025-03-04','lunch','Kebab','t4'),
+               (1,'2025-03-04','lunch','Burger','t5');
+        """,
+    )
+
+    await db.async_open()
+    async with db.conn.execute(
+        "SELECT date, meal_type, notes FROM free_meals ORDER BY date"
+    ) as c:
+        assert [tuple(r) async for r in c] == [("2025-03-04", "lunch", "Burger")]
+    async with db.conn.execute(
+        "SELECT free_meals, choices_free FROM weekly_rollups "
+        "WHERE profile_id=1 AND week_start='2025-03-03'"
+    ) as c:
+        assert tuple(await c.fetchone()) == (1, 1)
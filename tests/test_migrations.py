@@ -0,0 +1,85 @@
+import pytest
+import aiosqlite
+
+from custom_components.diet.db import MIGRATIONS, SCHEMA_VERSION
+from custom_components.diet.migrations import (
+    CopyRows,
+    Migration,
+    MigrationError,
+    Sql,
+    async_apply,
+    async_migration_history,
+    async_read_version,
+    migration_plan,
+)
+
+
+@pytest.fixture
+async def conn(tmp_path):
+    conn = await aiosqlite.connect(tmp_path / "m.db")
+    await conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    await conn.execute("INSERT INTO meta VALUES ('schema_version', '1')")
+    await conn.execute("CREATE TABLE big (a INTEGER, b TEXT, c TEXT)")
+    await conn.executemany(
+        "INSERT INTO big VALUES (?,?,?)",
+        [(i % 7, f"{i:05d}", f"v{i}") for i in range(95)],
+    )
+    await conn.commit()
+    yield conn
+    await conn.close()
+
+
+def test_registry_is_ordered_and_complete():
+    plan = migration_plan(MIGRATIONS, 5, SCHEMA_VERSION)
+    assert [m.version for m in plan] == list(range(6, SCHEMA_VERSION + 1))
+    assert migration_plan(MIGRATIONS, SCHEMA_VERSION, SCHEMA_VERSION) == []
+    with pytest.raises(MigrationError):
+        migration_plan(MIGRATIONS, 2, SCHEMA_VERSION)
+
+
+@pytest.mark.asyncio
+async def test_chunked_copy_reports_progress_and_records_timings(conn):
+    migration = Migration(
+        2,
+        "riscrittura di big",
+        [
+            Sql(["CREATE TABLE big_v2 (a INTEGER, b TEXT, c TEXT, PRIMARY KEY(a, b))"]),
+            CopyRows("big", "big_v2", ("a", "b", "c"), ("a", "b"), chunk_size=10),
+            Sql(["DROP TABLE big", "ALTER TABLE big_v2 RENAME TO big"]),
+        ],
+    )
+    events = []
+    stats = await async_apply(conn, migration, events.append)
+
+    copy_events = [e for e in events if e.step == 2 and e.total_rows]
+    assert [e.rows for e in copy_events] == [*range(10, 95, 10), 95]
+    assert all(e.total_rows == 95 and e.steps == 3 for e in copy_events)
+
+    assert await async_read_version(conn) == 2
+    async with conn.execute("SELECT COUNT(*), COUNT(DISTINCT b) FROM big") as c:
+        assert tuple(await c.fetchone()) == (95, 95)
+    history = await async_migration_history(conn)
+    assert history[2]["rows"] == stats["rows"] == 95
+    assert history[2]["duration_ms"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_failed_migration_rolls_back_whole_version(conn):
+    migration = Migration(
+        2,
+        "fallisce a metà",
+        [
+            Sql(["CREATE TABLE big_v2 (a INTEGER, b TEXT, c TEXT)"]),
+            CopyRows("big", "big_v2", ("a", "b", "c"), ("a", "b"), chunk_size=10),
+            Sql(["SELECT * FROM tabella_inesistente"]),
+        ],
+    )
+    with pytest.raises(MigrationError):
+        await async_apply(conn, migration)
+
+    assert await async_read_version(conn) == 1
+    async with conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name='big_v2'"
+    ) as c:
+        assert (await c.fetchone())[0] == 0
+    assert await async_migration_history(conn) == {}
@@ -0,0 +1,140 @@
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import orjson
+import pytest
+from homeassistant.helpers.json import json_bytes, json_fragment
+
+from custom_components.diet.const import MEAL_TYPES
+from custom_components.diet.repository import DietRepo
+
+from test_repository_read import _monday, _seed
+
+TABLETS = 4
+ROUNDS = 50
+
+
+@pytest.mark.asyncio
+async def test_day_json_is_serialized_once_and_matches_payload(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = _monday(date.today())
+    sunday = (monday + timedelta(days=6)).isoformat()
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+    await repo.set_choice(pid, monday.isoformat(), "lunch", "alternative", "Alt 0.1")
+
+    days = await repo.get_range(pid, monday.isoformat(), sunday)
+    first = repo.to_json(pid, days)
+    assert [orjson.loads(b) for b in first] == days
+    assert db.days.serializations == 7
+
+    # stesso giorno verso più connessioni: nessuna nuova serializzazione
+    again = repo.to_json(pid, await repo.get_range(pid, monday.isoformat(), sunday))
+    assert all(a is b for a, b in zip(first, again))
+    assert db.days.serializations == 7
+
+    # una scrittura riserializza solo il giorno toccato
+    await repo.set_hunger(pid, sunday, 2)
+    days = await repo.get_range(pid, monday.isoformat(), sunday)
+    third = repo.to_json(pid, days)
+    assert db.days.serializations == 8
+    assert third[:6] == first[:6] and orjson.loads(third[6])["hunger"] == 2
+
+    # giorni non in cache (es. fuori capacità): JSON costruito senza memorizzarlo
+    db.days.max_entries = 0
+    db.days.clear()
+    other = await repo.get_range(pid + 1, monday.isoformat(), sunday)
+    assert [orjson.loads(b) for b in repo.to_json(pid + 1, other)] == other
+
+
+def _measure(run) -> tuple[float, int]:
+    """Latenza media (ms) e picco di memoria allocata (byte) per round."""
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        run()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / ROUNDS * 1000, peak
+
+
+@pytest.mark.asyncio
+async def test_benchmark_fragments_vs_dict_payloads(diet_db):
+    """Benchmark (pytest -s): un mese inviato a più tablet, dict vs frammenti JSON."""
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    start = date(2025, 3, 3)
+    await repo.apply_template_range(pid, start.isoformat(), tpl_id, 5)
+    end = (start + timedelta(days=34)).isoformat()
+    days = await repo.get_range(pid, start.isoformat(), end)
+
+    def _dicts():
+        # percorso precedente: HA serializza i dict una volta per connessione
+        for msg_id in range(TABLETS):
+            json_bytes({"id": msg_id, "result": {"days": days}})
+
+    def _fragments():
+        for msg_id in range(TABLETS):
+            frags = [json_fragment(b) for b in repo.to_json(pid, days)]
+            json_bytes({"id": msg_id, "result": {"days": frags}})
+
+    repo.to_json(pid, days)
+    dict_ms, dict_bytes = _measure(_dicts)
+    frag_ms, frag_bytes = _measure(_fragments)
+    print(
+        f"\n{len(days)} giorni × {TABLETS} tablet: "
+        f"dict {dict_ms:.3f} ms / {dict_bytes} B, "
+        f"frammenti {frag_ms:.3f} ms / {frag_bytes} B"
+    )
+
+    # stesso contenuto inviato; i giorni sono stati serializzati una volta sola
+    expected = json_bytes({"id": 0, "result": {"days": days}})
+    sent = json_bytes(
+        {"id": 0, "result": {"days": [json_fragment(b) for b in repo.to_json(pid, days)]}}
+    )
+    assert orjson.loads(sent) == orjson.loads(expected)
+    assert db.days.serializations == len(days)
+
+
+@pytest.mark.asyncio
+async def test_compact_range_references_each_template_slot_once(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    start = date(2025, 3, 3)
+    end = (start + timedelta(days=34)).isoformat()
+    await repo.apply_template_range(pid, start.isoformat(), tpl_id, 5)
+    await repo.set_choice(pid, "2025-03-04", "lunch", "alternative", "Alt 1.0")
+
+    full, versions, no_templates = await repo.get_range_json(pid, start.isoformat(), end)
+    compact, _, templates = await repo.get_range_json(
+        pid, start.isoformat(), end, compact=True
+    )
+    assert no_templates == {} and len(compact) == len(full) == len(versions) == 35
+    # 7 giorni della settimana × (pranzo, cena), non 35 × 2
+    assert len(templates) == 14
+
+    # dizionario + riferimenti ricostruiscono il payload completo
+    dictionary = {tid: orjson.loads(b) for tid, b in templates.items()}
+    empty = {"proposed": None, "alternatives": [], "chosen": None}
+    for data, expected in zip(compact, full):
+        day = orjson.loads(data)
+        meals = {m["meal_type"]: m for m in day["meals"]}
+        day["meals"] = []
+        for mt in MEAL_TYPES:
+            meal = meals.get(mt, {"meal_type": mt, "ref": None, "chosen": None})
+            ref = meal.pop("ref")
+            day["meals"].append({**empty, **(dictionary[ref] if ref else {}), **meal})
+        assert day == orjson.loads(expected)
+    assert sum(map(len, compact)) + sum(map(len, templates.values())) < sum(map(len, full)) / 2
+
+    # entrambi i formati restano in cache
+    serialized = db.days.serializations
+    await repo.get_range_json(pid, start.isoformat(), end, compact=True)
+    await repo.get_range_json(pid, start.isoformat(), end)
+    assert db.days.serializations == serialized
@@ -0,0 +1,95 @@
+import pytest
+import voluptuous as vol
+from dataclasses import replace
+from datetime import date, timedelta
+
+from custom_components.diet.config_flow import options_schema
+from custom_components.diet.policy import DietPolicy
+from custom_components.diet.repository import DietRepo
+
+from test_repository_read import _monday, _seed
+
+
+def test_options_schema_and_policy_from_options():
+    defaults = options_schema({})({})
+    assert DietPolicy.from_options(defaults) == DietPolicy()
+
+    options = options_schema(defaults)(
+        {**defaults, "free_limit_mode": "hard", "write_batch_window_ms": 0}
+    )
+    policy = DietPolicy.from_options({**options, "sconosciuta": 1})
+    assert policy.hard_free_quota == 2 and policy.write_batch_window is None
+    assert DietPolicy().hard_free_quota is None
+    with pytest.raises(vol.Invalid):
+        options_schema({})({"free_limit_mode": "strict"})
+    # le letture non devono mai finire sul writer
+    with pytest.raises(vol.Invalid):
+        options_schema({})({"read_pool_size": 0})
+
+
+@pytest.mark.asyncio
+async def test_apply_policy_live(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = _monday(date.today())
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+    await repo.get_week(pid, monday.isoformat())
+    assert len(db.days) == 7 and len(db.readers) == 3
+
+    policy = replace(
+        db.policy, day_cache_size=2, read_pool_size=1, write_batch_window_ms=0
+    )
+    await db.async_apply_policy(policy)
+    assert db.policy is policy
+    assert len(db.days) == 2 and db.days.max_entries == 2
+    assert len(db.readers) == 1 and db.write_batch_window is None
+    # il pool ridotto continua a servire letture
+    assert len(await repo.get_week(pid, monday.isoformat())) == 7
+
+    await db.async_apply_policy(replace(policy, read_pool_size=2))
+    assert len(db.readers) == 2
+    await db.async_apply_policy(replace(policy, read_pool_size=0))
+    assert len(db.readers) == 1
+    await db.async_apply_policy(replace(policy, read_pool_size=2))
+
+    # quota hard letta dalla policy corrente, nella transazione della scrittura
+    used = await repo.free_meals_used_in_week(pid, monday.isoformat())
+    await db.async_apply_policy(
+        replace(policy, free_meals_per_week=used, free_limit_mode="hard")
+    )
+    # rimettere FREE uno slot già FREE non cambia il conteggio
+    await repo.set_choice(pid, monday.isoformat(), "dinner", "free", "Sushi")
+    with pytest.raises(ValueError):
+        await repo.set_choice(pid, monday.isoformat(), "lunch", "free", "Pizza")
+    assert await repo.free_meals_used_in_week(pid, monday.isoformat()) == used
+    await db.async_apply_policy(replace(policy, free_meals_per_week=used))
+    await repo.set_choice(pid, monday.isoformat(), "lunch", "free", "Pizza")
+    assert await repo.free_meals_used_in_week(pid, monday.isoformat()) == used + 1
+
+
+@pytest.mark.asyncio
+async def test_history_retention_prunes_old_rows(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    old = _monday(date.today() - timedelta(days=60)).isoformat()
+    recent = _monday(date.today()).isoformat()
+    for start in (old, recent):
+        await repo.apply_week_template(pid, start, tpl_id)
+        await repo.set_choice(pid, start, "lunch", "alternative", "Alt 0.1")
+
+    async def _history_dates() -> set[str]:
+        async with db.conn.execute("SELECT DISTINCT date FROM day_meal_history") as c:
+            return {r[0] for r in await c.fetchall()}
+
+    assert old in await _history_dates()
+    # retention illimitata (default): nulla da eliminare
+    assert await db.async_prune_history() == 0
+
+    await db.async_apply_policy(replace(db.policy, history_retention_days=30))
+    kept = await _history_dates()
+    assert recent in kept
+    assert min(kept) >= (date.today() - timedelta(days=30)).isoformat()
+    # lo stato corrente non è toccato
+    assert (await repo.get_day(pid, old))["date"] == old
@@ -37,3 +37,69 @@ async def test_sync_profiles_creates_entries_and_acl(hass, diet_db, fake_users_t
                 row = await c.fetchone()
             assert row is not None, f"ACL mancante {owner}->{subject}"
             assert row[0] == 1 and row[1] == 0
+
+
+@pytest.mark.asyncio
+async def test_sync_profiles_diff_benchmark(hass, diet_db, monkeypatch):
+    """Benchmark: sync di alcune centinaia di utenti sintetici (statement e tempo)."""
+    import time
+    from types import SimpleNamespace
+    from custom_components.diet.profiles import async_sync_profiles
+
+    db, _ = diet_db
+    n = 300
+    users = [
+        SimpleNamespace(id=f"user-{i:04d}", name=f"Utente {i}", is_active=True, system_generated=False)
+        for i in range(n)
+    ]
+
+    async def _fake_get_users():
+        return users
+
+    monkeypatch.setattr(hass.auth, "async_get_users", _fake_get_users)
+
+    statements: list[str] = []
+
+    async def _run():
+        statements.clear()
+        for conn in (db.conn, *db.readers):
+            await conn.set_trace_callback(statements.append)
+        t0 = time.perf_counter()
+        summary = await async_sync_profiles(hass, db)
+        elapsed = time.perf_counter() - t0
+        for conn in (db.conn, *db.readers):
+            await conn.set_trace_callback(None)
+        return summary, len(statements), elapsed
+
+    first, stmts_first, t_first = await _run()
+    users[0].name = "Rinominato"
+    second, stmts_second, t_second = await _run()
+    print(
+        f"\nsync iniziale {n} utenti: {stmts_first} statement, {t_first * 1000:.0f} ms"
+        f" (prima: ~{2 * n * (n - 1)} statement solo per le ACL)"
+        f"\nsync incrementale: {stmts_second} statement, {t_second * 1000:.0f} ms"
+    )
+
+    assert first["count"] == n
+    assert first["profiles_created"] == n
+    assert first["acl_created"] == n * (n - 1)
+    # l'INSERT dei profili è un executemany: n esecuzioni, le ACL un'unica INSERT ... SELECT
+    assert stmts_first < n + 20
+
+    assert second == {
+        "count": n,
+        "profiles_created": 0,
+        "profiles_renamed": 1,
+        "acl_created": 0,
+        "acl_updated": 0,
+    }
+    assert stmts_second < 20
+
+    async with db.conn.execute("SELECT COUNT(*) FROM profile_acl WHERE can_read=1 AND can_write=0") as c:
+        assert (await c.fetchone())[0] == n * (n - 1)
+    assert await get_profile_name(db, "user-0000") == "Rinominato"
+
+
+async def get_profile_name(db, uid):
+    async with db.conn.execute("SELECT display_name FROM diet_profiles WHERE ha_user_id=?", (uid,)) as c:
+        return (await c.fetchone())[0]
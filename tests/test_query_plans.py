@@ -0,0 +1,99 @@
+import pytest
+from datetime import date, datetime, timedelta
+
+from custom_components.diet.coordinator import DietCoordinator
+from custom_components.diet.repository import DietRepo
+
+from test_repository_read import _seed, _StatementCounter
+
+# Tabelle caricate per intero nell'indice ACL in memoria: la scansione è voluta.
+SNAPSHOT_TABLES = {"diet_profiles", "profile_acl"}
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+async def _full_scans(db, statements: list[str]) -> list[tuple[str, str]]:
+    """Esegue EXPLAIN QUERY PLAN su ogni statement e ritorna le scansioni complete."""
+    scans = []
+    async with db.read() as conn:
+        for stmt in dict.fromkeys(statements):
+            if not stmt.lstrip().upper().startswith(EXPLAINABLE):
+                continue
+            for row in await conn.execute_fetchall(f"EXPLAIN QUERY PLAN {stmt}"):
+                detail = row[3]
+                if not detail.startswith("SCAN"):
+                    continue
+                table = detail.split()[1]
+                if table in SNAPSHOT_TABLES or "CONSTANT ROW" in detail:
+                    continue
+                # json_each: liste di parametri, non tabelle
+                if "VIRTUAL TABLE" in detail:
+                    continue
+                scans.append((detail, stmt))
+    return scans
+
+
+@pytest.mark.asyncio
+async def test_hot_statements_never_scan_full_tables(hass, diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = date(2025, 3, 3)
+    # niente ANALYZE: senza statistiche il planner stima tabelle grandi,
+    # come dopo anni di storia
+    await repo.apply_template_range(pid, (monday - timedelta(weeks=8)).isoformat(), tpl_id, 8)
+    await repo.apply_template_range(pid + 1, monday.isoformat(), tpl_id, 1)
+    db.days.clear()
+    db.templates.invalidate()
+
+    counter = _StatementCounter()
+    await counter.attach(db)
+
+    d = monday.isoformat()
+    # letture del repository (WebSocket e servizi passano da qui)
+    await repo.get_active_template_id(pid)
+    await repo.get_active_template_id(None)
+    await repo.get_range(pid, (monday - timedelta(weeks=8)).isoformat(), d)
+    await repo.get_week(pid, d)
+    await repo.free_meals_used_in_week(pid, d)
+    await repo.get_next_meals(
+        [pid, pid + 1], datetime(2025, 3, 3, 9), datetime(2025, 3, 5, 9)
+    )
+    await repo.get_history_page(pid, "2024-01-01", d, 10, after="2025-01-20")
+    tm = await repo.get_template_meal(tpl_id, 0, "lunch")
+    await repo.get_template_alternatives(tm[0])
+    # scritture
+    await repo.apply_week_template(pid, d, tpl_id)
+    await repo.set_snack(pid, d, "am", True)
+    await repo.set_hunger(pid, d, 3)
+    await repo.set_choice(pid, d, "dinner", "free", "Pizza")
+    await repo.swap_meal(pid, d, (monday + timedelta(days=1)).isoformat(), "lunch")
+    # sensori: tutti i profili e singolo profilo
+    coord = DietCoordinator(hass, db)
+    await coord._async_compute()
+    await coord._async_compute(pid)
+
+    await counter.detach(db)
+
+    assert counter.statements
+    assert await _full_scans(db, counter.statements) == []
+
+
+@pytest.mark.asyncio
+async def test_plan_days_keyed_by_profile_and_date(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = date(2025, 3, 3).isoformat()
+
+    # due profili possono pianificare lo stesso giorno
+    await repo.apply_week_template(pid, monday, tpl_id)
+    await repo.apply_week_template(pid + 1, monday, tpl_id)
+    await repo.set_hunger(pid + 1, monday, 2)
+
+    async with db.read() as conn:
+        rows = await conn.execute_fetchall(
+            "SELECT profile_id, hunger FROM plan_days WHERE date=? ORDER BY profile_id",
+            (monday,),
+        )
+    assert [tuple(r) for r in rows] == [(pid, None), (pid + 1, 2)]
+    assert (await repo.get_day(pid, monday))["hunger"] is None
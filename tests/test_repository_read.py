@@ -0,0 +1,394 @@
+import pytest
+from datetime import date, timedelta
+
+from custom_components.diet.const import MEAL_TYPES
+from custom_components.diet.repository import DietRepo
+
+
+def _monday(d: date) -> date:
+    return d - timedelta(days=d.weekday())
+
+
+async def _seed(db) -> tuple[int, int]:
+    """Profilo + template condiviso con pranzo (2 alternative) e cena FREE ogni giorno."""
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        ("user-1", "Diego"),
+    )
+    async with db.conn.execute("SELECT id FROM diet_profiles WHERE ha_user_id='user-1'") as c:
+        pid = (await c.fetchone())[0]
+
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    async with db.conn.execute("SELECT id FROM week_templates WHERE is_active=1") as c:
+        tpl_id = (await c.fetchone())[0]
+
+    for dow in range(7):
+        cur = await db.conn.execute(
+            "INSERT INTO template_meals(template_id,dow,meal_type,title,proposed_items,required,default_source) "
+            "VALUES (?,?,?,?,?,?,?)",
+            (tpl_id, dow, "lunch", f"Pranzo {dow}", "riso", 1, "proposed"),
+        )
+        for n in range(2):
+            await db.conn.execute(
+                "INSERT INTO template_meal_alternatives(template_meal_id,title,items,calories) "
+                "VALUES (?,?,?,?)",
+                (cur.lastrowid, f"Alt {dow}.{n}", "pasta", 500 + n),
+            )
+        await db.conn.execute(
+            "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+            "VALUES (?,?,?,?,?,?)",
+            (tpl_id, dow, "dinner", None, 1, "free"),
+        )
+    await db.conn.commit()
+    return pid, tpl_id
+
+
+class _StatementCounter:
+    def __init__(self):
+        self.statements: list[str] = []
+
+    def __call__(self, stmt: str) -> None:
+        self.statements.append(stmt)
+
+    async def attach(self, db) -> None:
+        for conn in (db.conn, *db.readers):
+            await conn.set_trace_callback(self)
+
+    async def detach(self, db) -> None:
+        for conn in (db.conn, *db.readers):
+            await conn.set_trace_callback(None)
+
+
+@pytest.mark.asyncio
+async def test_get_day_payload_and_query_count(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+
+    monday = _monday(date.today())
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+    await repo.set_snack(pid, monday.isoformat(), "am", True)
+    await repo.set_choice(pid, monday.isoformat(), "lunch", "alternative", "Alt 0.1")
+
+    counter = _StatementCounter()
+    await counter.attach(db)
+    day = await repo.get_day(pid, monday.isoformat())
+    await counter.detach(db)
+
+    # numero di query costante, indipendente da MEAL_TYPES
+    assert len(counter.statements) <= 4
+
+    assert day["date"] == monday.isoformat()
+    assert day["snacks"]["am"]["done"] is True
+    assert day["snacks"]["pm"] == {"done": False}
+    assert [m["meal_type"] for m in day["meals"]] == list(MEAL_TYPES)
+
+    meals = {m["meal_type"]: m for m in day["meals"]}
+    assert meals["lunch"]["proposed"] == {"title": "Pranzo 0", "items": "riso"}
+    assert [a["title"] for a in meals["lunch"]["alternatives"]] == ["Alt 0.0", "Alt 0.1"]
+    assert meals["lunch"]["chosen"]["source"] == "alternative"
+    assert meals["dinner"]["chosen"]["source"] == "free"
+    assert meals["dinner"]["alternatives"] == []
+    assert meals["breakfast"]["proposed"] is None
+    assert meals["breakfast"]["chosen"] is None
+
+
+@pytest.mark.asyncio
+async def test_get_day_not_planned(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+
+    day = await repo.get_day(1, "2025-01-01")
+    assert day == {
+        "date": "2025-01-01",
+        "meals": [],
+        "snacks": {"am": {"done": False}, "pm": {"done": False}},
+        "hunger": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_range_matches_get_day_with_constant_queries(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+
+    monday = _monday(date.today())
+    for w in range(4):
+        start = (monday + timedelta(weeks=w)).isoformat()
+        await repo.apply_week_template(pid, start, tpl_id)
+    await repo.set_hunger(pid, (monday + timedelta(days=9)).isoformat(), 3)
+
+    end = monday + timedelta(days=34)  # oltre la parte pianificata
+
+    counter = _StatementCounter()
+    await counter.attach(db)
+    days = await repo.get_range(pid, monday.isoformat(), end.isoformat())
+    await counter.detach(db)
+
+    assert len(counter.statements) <= 4
+    assert len(days) == 35
+    assert days[9]["hunger"] == 3
+    assert days[-1]["meals"] == []
+    for i in (0, 9, 27, 34):
+        d = (monday + timedelta(days=i)).isoformat()
+        assert days[i] == await repo.get_day(pid, d)
+
+    week = await repo.get_week(pid, monday.isoformat())
+    assert week == days[:7]
+
+
+@pytest.mark.asyncio
+async def test_template_cache_serves_warm_reads_and_tracks_edits(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = _monday(date.today())
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+    await repo.get_day(pid, (monday + timedelta(days=1)).isoformat())
+
+    # template a caldo: solo lo stato del giorno (plan_days, snacks, day_meals)
+    counter = _StatementCounter()
+    await counter.attach(db)
+    day = await DietRepo(db).get_day(pid, monday.isoformat())
+    await counter.detach(db)
+    assert len(counter.statements) == 3
+    assert not any("template_meals" in s for s in counter.statements)
+
+    # una modifica al template (anche fuori dal repository) incrementa rev
+    async with db.conn.execute(
+        "SELECT id FROM template_meals WHERE template_id=? AND dow=0 AND meal_type='lunch'",
+        (tpl_id,),
+    ) as c:
+        tm_id = (await c.fetchone())[0]
+    await db.conn.execute(
+        "INSERT INTO template_meal_alternatives(template_meal_id,title,items,calories) "
+        "VALUES (?,?,?,?)",
+        (tm_id, "Alt nuova", "farro", 450),
+    )
+    await db.conn.commit()
+
+    # il giorno in DayCache è costruito sul rev precedente: viene riletto
+    day2 = await repo.get_day(pid, monday.isoformat())
+    lunch = next(m for m in day2["meals"] if m["meal_type"] == "lunch")
+    assert [a["title"] for a in lunch["alternatives"]][-1] == "Alt nuova"
+    week = await repo.get_week(pid, monday.isoformat())
+    assert all(len(d["meals"][1]["alternatives"]) == 2 for d in week[1:])
+    assert len(week[0]["meals"][1]["alternatives"]) == 3
+    # il payload assemblato non condivide stato con il template compilato
+    lunch["alternatives"].clear()
+    await repo.set_hunger(pid, monday.isoformat(), 2)
+    day3 = await repo.get_day(pid, monday.isoformat())
+    assert len(next(m for m in day3["meals"] if m["meal_type"] == "lunch")["alternatives"]) == 3
+    assert day["meals"][0]["meal_type"] == "breakfast"
+
+
+@pytest.mark.asyncio
+async def test_day_cache_hits_and_precise_invalidation(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = _monday(date.today())
+    tuesday = (monday + timedelta(days=1)).isoformat()
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+
+    week = await repo.get_week(pid, monday.isoformat())
+
+    # più display sulla stessa settimana: solo la verifica dei rev dei template
+    counter = _StatementCounter()
+    await counter.attach(db)
+    for _ in range(3):
+        assert await repo.get_week(pid, monday.isoformat()) == week
+    await counter.detach(db)
+    assert len(counter.statements) == 3
+    assert all("week_templates" in s for s in counter.statements)
+    assert db.days.hits >= 21
+
+    # una scrittura invalida solo il giorno toccato
+    await repo.set_snack(pid, tuesday, "pm", True)
+    counter.statements.clear()
+    await counter.attach(db)
+    week2 = await repo.get_week(pid, monday.isoformat())
+    await counter.detach(db)
+    assert week2[1]["snacks"]["pm"]["done"] is True
+    assert week2[0] is week[0] and week2[2] is week[2]
+    # rilettura limitata al solo martedì (oltre alla verifica dei rev della settimana)
+    check, *reads = counter.statements
+    assert "week_templates" in check and reads
+    assert all(f"'{tuesday}' AND '{tuesday}'" in s for s in reads)
+
+    # capacità limitata: LRU con eviction
+    db.days.max_entries = 3
+    await repo.get_week(pid, (monday + timedelta(weeks=1)).isoformat())
+    assert len(db.days) == 3
+    assert db.days.stats()["evictions"] > 0
+
+
+@pytest.mark.asyncio
+async def test_conditional_reads_return_only_changed_days(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = _monday(date.today())
+    sunday = (monday + timedelta(days=6)).isoformat()
+    tuesday = (monday + timedelta(days=1)).isoformat()
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+    await repo.apply_week_template(pid + 1, monday.isoformat(), tpl_id)
+
+    days, versions = await repo.get_range_if_modified(pid, monday.isoformat(), sunday, {})
+    assert len(days) == 7 and list(versions) == [d["date"] for d in days]
+
+    # versioni invariate: solo la lettura dei rev dei template
+    counter = _StatementCounter()
+    await counter.attach(db)
+    assert await repo.get_range_if_modified(pid, monday.isoformat(), sunday, versions) == (
+        [],
+        versions,
+    )
+    await counter.detach(db)
+    assert len(counter.statements) == 1 and "week_templates" in counter.statements[0]
+
+    # le scritture alzano la versione dei soli giorni toccati
+    await repo.set_hunger(pid, tuesday, 3)
+    await repo.set_hunger(pid + 1, tuesday, 1)
+    days, versions2 = await repo.get_range_if_modified(
+        pid, monday.isoformat(), sunday, versions
+    )
+    assert [d["date"] for d in days] == [tuesday] and days[0]["hunger"] == 3
+    assert versions2[tuesday] > versions[tuesday]
+    assert {d: v for d, v in versions2.items() if d != tuesday} == {
+        d: v for d, v in versions.items() if d != tuesday
+    }
+
+    # modifica diretta del template con tutti i giorni in cache:
+    # tutti i giorni vanno riletti
+    await db.conn.execute(
+        "UPDATE template_meals SET title='Nuovo' WHERE template_id=? AND dow=0 AND meal_type='lunch'",
+        (tpl_id,),
+    )
+    await db.conn.commit()
+    days, versions3 = await repo.get_range_if_modified(
+        pid, monday.isoformat(), sunday, versions2
+    )
+    assert len(days) == 7 and days[0]["meals"][1]["proposed"]["title"] == "Nuovo"
+    assert all(versions3[d] > versions2[d] for d in versions2)
+
+
+@pytest.mark.asyncio
+async def test_template_edit_changes_versions_of_uncached_days(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    monday = _monday(date.today())
+    sunday = (monday + timedelta(days=6)).isoformat()
+    await repo.apply_week_template(pid, monday.isoformat(), tpl_id)
+    db.days.resize(0)
+
+    _, versions = await repo.get_range_if_modified(pid, monday.isoformat(), sunday, {})
+    await db.conn.execute(
+        "UPDATE template_meals SET title='Nuovo' WHERE template_id=? AND dow=2 AND meal_type='lunch'",
+        (tpl_id,),
+    )
+    await db.conn.commit()
+
+    days, versions2 = await repo.get_range_if_modified(
+        pid, monday.isoformat(), sunday, versions
+    )
+    assert len(days) == 7 and days[2]["meals"][1]["proposed"]["title"] == "Nuovo"
+    assert all(versions2[d] > versions[d] for d in versions)
+    assert await repo.get_range_if_modified(pid, monday.isoformat(), sunday, versions2) == (
+        [],
+        versions2,
+    )
+
+
+@pytest.mark.asyncio
+async def test_iter_history_walks_years_in_bounded_pages(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    first_monday = date(2022, 1, 3)
+    weeks = 156  # tre anni
+    await repo.apply_template_range(pid, first_monday.isoformat(), tpl_id, weeks)
+    # un altro profilo negli stessi giorni non deve comparire
+    await repo.apply_template_range(pid + 1, first_monday.isoformat(), tpl_id, 4)
+    await repo.set_hunger(pid, "2023-06-15", 4)
+
+    counter = _StatementCounter()
+    await counter.attach(db)
+    pages = []
+    per_page = []
+    async for page in repo.iter_history(pid, "2000-01-01", "2100-01-01", page_size=50):
+        per_page.append(len(counter.statements))
+        counter.statements.clear()
+        pages.append(page)
+    await counter.detach(db)
+
+    dates = [d["date"] for page in pages for d in page]
+    assert len(dates) == 7 * weeks
+    assert dates == sorted(set(dates))
+    assert all(len(p) == 50 for p in pages[:-1]) and 0 < len(pages[-1]) <= 50
+    # latenza per pagina stabile: stesso numero di query per ogni pagina
+    assert max(per_page[1:]) <= 4
+    assert next(d for p in pages for d in p if d["date"] == "2023-06-15")["hunger"] == 4
+    # lo storico non riempie la cache dei giorni
+    assert len(db.days) == 0
+
+    # cursore esplicito e limiti dell'intervallo
+    page, cursor = await repo.get_history_page(pid, "2022-01-05", "2022-01-20", 7)
+    assert [d["date"] for d in page][0] == "2022-01-05" and cursor == "2022-01-11"
+    page, cursor = await repo.get_history_page(
+        pid, "2022-01-05", "2022-01-20", 7, after=cursor
+    )
+    assert [d["date"] for d in page] == [f"2022-01-{n}" for n in range(12, 19)]
+    page, cursor = await repo.get_history_page(
+        pid, "2022-01-05", "2022-01-20", 7, after=cursor
+    )
+    assert [d["date"] for d in page] == ["2022-01-19", "2022-01-20"] and cursor is None
+
+
+@pytest.mark.asyncio
+async def test_next_meals_for_household_in_one_query(diet_db):
+    from datetime import datetime, timezone
+
+    db, _ = diet_db
+    repo = DietRepo(db)
+    pid, tpl_id = await _seed(db)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        ("user-2", "Compagna"),
+    )
+    await db.conn.commit()
+    monday = date(2025, 3, 3)
+    await repo.apply_template_range(pid, monday.isoformat(), tpl_id, 2)
+    await repo.apply_template_range(pid + 1, monday.isoformat(), tpl_id, 2)
+    wednesday = (monday + timedelta(days=2)).isoformat()
+    await repo.set_choice(pid + 1, wednesday, "dinner", "alternative", "Zuppa")
+
+    # mercoledì 15:00: il pranzo è passato, orizzonte di 24 ore
+    now = datetime(2025, 3, 5, 15, 0, tzinfo=timezone.utc)
+    counter = _StatementCounter()
+    await counter.attach(db)
+    profiles = await repo.get_next_meals(
+        [pid + 1, pid, 999], now, now + timedelta(hours=24)
+    )
+    await counter.detach(db)
+
+    assert len(counter.statements) == 1
+    assert [(p["profile_id"], p["display_name"]) for p in profiles] == [
+        (pid + 1, "Compagna"),
+        (pid, "Diego"),
+    ]
+    upcoming = profiles[0]["upcoming"]
+    assert [(m["date"], m["type"]) for m in upcoming] == [
+        (wednesday, "dinner"),
+        ("2025-03-06", "lunch"),
+    ]
+    assert upcoming[0]["title"] == "Zuppa" and upcoming[0]["status"] == "alternative"
+    assert upcoming[1]["title"] == "Pranzo 3" and upcoming[1]["status"] == "planned"
+    assert upcoming[0]["at"] == f"{wednesday}T20:00+00:00"
+    # la cena FREE del template è una scelta registrata dall'apply
+    assert profiles[1]["upcoming"][0]["status"] == "free"
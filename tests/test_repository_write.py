@@ -0,0 +1,165 @@
+import pytest
+from dataclasses import replace
+from datetime import date, timedelta
+
+from custom_components.diet.repository import DietRepo
+
+
+def _monday(d: date) -> date:
+    return d - timedelta(days=d.weekday())
+
+
+async def _template_with_defaults(db) -> int:
+    """Template con cena FREE il lunedì, colazione SKIP la domenica, pranzo proposto ogni giorno."""
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    async with db.conn.execute("SELECT id FROM week_templates WHERE is_active=1") as c:
+        tpl_id = (await c.fetchone())[0]
+    rows = [(tpl_id, dow, "lunch", f"Pranzo {dow}", 1, "proposed") for dow in range(7)]
+    rows.append((tpl_id, 0, "dinner", None, 1, "free"))
+    rows.append((tpl_id, 6, "breakfast", None, 0, "skipped"))
+    await db.conn.executemany(
+        "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+        "VALUES (?,?,?,?,?,?)",
+        rows,
+    )
+    await db.conn.commit()
+    return tpl_id
+
+
+@pytest.mark.asyncio
+async def test_apply_template_range_bulk(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    tpl_id = await _template_with_defaults(db)
+    weeks = 13
+    monday = _monday(date.today())
+
+    statements: list[str] = []
+    await db.conn.set_trace_callback(statements.append)
+    await repo.apply_template_range(1, monday.isoformat(), tpl_id, weeks)
+    await db.conn.set_trace_callback(None)
+
+    # una lettura del template + tre executemany, indipendentemente dalle settimane
+    assert sum(1 for s in statements if s.lstrip().upper().startswith("SELECT")) == 1
+
+    async with db.conn.execute(
+        "SELECT COUNT(*) FROM plan_days WHERE profile_id=1"
+    ) as c:
+        assert (await c.fetchone())[0] == 7 * weeks
+    async with db.conn.execute(
+        "SELECT chosen_source, COUNT(*) FROM day_meals WHERE profile_id=1 GROUP BY chosen_source"
+    ) as c:
+        assert {r[0]: r[1] async for r in c} == {"free": weeks, "skipped": weeks}
+    async with db.conn.execute("SELECT MIN(date), COUNT(*) FROM free_meals") as c:
+        first, count = await c.fetchone()
+    assert first == monday.isoformat() and count == weeks
+
+    last_sunday = (monday + timedelta(weeks=weeks, days=-1)).isoformat()
+    day = await repo.get_day(1, last_sunday)
+    meals = {m["meal_type"]: m for m in day["meals"]}
+    assert meals["breakfast"]["chosen"]["source"] == "skipped"
+    assert meals["lunch"]["proposed"]["title"] == "Pranzo 6"
+
+
+@pytest.mark.asyncio
+async def test_set_choice_keeps_one_current_row_and_full_history(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    tpl_id = await _template_with_defaults(db)
+    monday = _monday(date.today()).isoformat()
+    await repo.apply_week_template(1, monday, tpl_id)
+
+    # cena di lunedì: FREE di default, poi ripensamenti
+    for source, title in [
+        ("alternative", "Zuppa"),
+        ("free", "Pizza"),
+        ("free", "Pizza"),
+        ("proposed", "Pesce"),
+    ]:
+        await repo.set_choice(1, monday, "dinner", source, title)
+    await repo.apply_week_template(1, monday, tpl_id)
+
+    async with db.conn.execute(
+        "SELECT COUNT(*), MAX(chosen_title) FROM day_meals "
+        "WHERE profile_id=1 AND date=? AND meal_type='dinner'",
+        (monday,),
+    ) as c:
+        assert tuple(await c.fetchone()) == (1, "Pesce")
+    async with db.conn.execute(
+        "SELECT chosen_source FROM day_meal_history "
+        "WHERE profile_id=1 AND date=? AND meal_type='dinner' ORDER BY id",
+        (monday,),
+    ) as c:
+        assert [r[0] async for r in c] == [
+            "free",
+            "alternative",
+            "free",
+            "free",
+            "proposed",
+        ]
+    # il pasto free segue la scelta corrente
+    assert await repo.free_meals_used_in_week(1, monday) == 0
+
+    await repo.set_choice(1, monday, "dinner", "free", "Pizza")
+    await repo.set_choice(1, monday, "dinner", "free", "Sushi")
+    assert await repo.free_meals_used_in_week(1, monday) == 1
+    dinner = next(
+        m
+        for m in (await repo.get_day(1, monday))["meals"]
+        if m["meal_type"] == "dinner"
+    )
+    assert dinner["chosen"]["title"] == "Sushi"
+
+
+@pytest.mark.asyncio
+async def test_set_bulk_single_commit_and_batch_wide_quota(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    tpl_id = await _template_with_defaults(db)
+    monday = _monday(date.today())
+    week = [(monday + timedelta(days=i)).isoformat() for i in range(7)]
+    await repo.apply_week_template(1, week[0], tpl_id)
+    await repo.apply_week_template(2, week[0], tpl_id)
+    before = await repo.get_week(1, week[0])
+    commits = db.write_stats["commits"]
+    db.policy = replace(db.policy, free_meals_per_week=2, free_limit_mode="hard")
+
+    # "settimana seguita": 7 pranzi, 14 spuntini, 7 livelli di fame, 2 profili
+    await repo.set_bulk(
+        choices=[
+            (1, d, "lunch", "proposed", f"Pranzo {i}", None) for i, d in enumerate(week)
+        ]
+        + [(2, week[2], "dinner", "free", "Pizza", "")],
+        snacks=[(1, d, p, True) for d in week for p in ("am", "pm")],
+        hunger=[(1, d, 3) for d in week],
+    )
+    assert db.write_stats["commits"] == commits + 1
+    after = await repo.get_week(1, week[0])
+    assert all(d["hunger"] == 3 and d["snacks"]["pm"]["done"] for d in after)
+    assert all(a is not b for a, b in zip(after, before))
+    assert await repo.free_meals_used_in_week(2, week[0]) == 2
+
+    # quota sull'intero batch: lunedì è già FREE, due nuovi free la superano
+    with pytest.raises(ValueError):
+        await repo.set_bulk(
+            choices=[
+                (1, week[3], "dinner", "free", "Pizza", None),
+                (1, week[4], "dinner", "free", "Sushi", None),
+            ],
+            hunger=[(1, week[3], 1)],
+        )
+    # nulla è stato scritto
+    assert await repo.free_meals_used_in_week(1, week[0]) == 1
+    assert (await repo.get_day(1, week[3]))["hunger"] == 3
+    # modalità soft: nessun limite
+    db.policy = replace(db.policy, free_limit_mode="soft")
+    await repo.set_bulk(
+        choices=[
+            (1, week[3], "dinner", "free", "Pizza", None),
+            (1, week[4], "dinner", "free", "Sushi", None),
+        ]
+    )
+    assert await repo.free_meals_used_in_week(1, week[0]) == 3
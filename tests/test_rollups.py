@@ -0,0 +1,127 @@
+import pytest
+from datetime import date, timedelta
+
+from custom_components.diet.repository import DietRepo
+
+ROLLUP_TABLES = ("daily_rollups", "weekly_rollups")
+
+
+async def _snapshot(db) -> dict[str, list[tuple]]:
+    out = {}
+    async with db.read() as conn:
+        for table in ROLLUP_TABLES:
+            rows = await conn.execute_fetchall(f"SELECT * FROM {table} ORDER BY 1, 2")
+            # righe azzerate (es. dopo un DELETE) equivalgono a righe assenti
+            out[table] = [tuple(r) for r in rows if any(r[2:])]
+    return out
+
+
+@pytest.mark.asyncio
+async def test_rollups_follow_writes_and_match_rebuild(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.execute(
+        "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+        "VALUES (1,0,'dinner',NULL,1,'free')"
+    )
+    await db.conn.commit()
+
+    monday = date(2025, 3, 3)
+    sunday = (monday + timedelta(days=6)).isoformat()
+    await repo.apply_template_range(1, monday.isoformat(), 1, 2)
+    await repo.set_hunger(1, monday.isoformat(), 4)
+    await repo.set_hunger(1, sunday, 2)
+    await repo.set_hunger(1, sunday, 3)
+    await repo.set_snack(1, sunday, "am", True)
+    await repo.set_snack(1, sunday, "pm", True)
+    await repo.set_snack(1, sunday, "pm", False)
+    await repo.set_choice(1, sunday, "lunch", "free", "Pizza")
+    await repo.set_choice(1, sunday, "breakfast", "alternative", "Yogurt")
+
+    async with db.read() as conn:
+        day = await conn.execute_fetchall(
+            "SELECT hunger_sum, hunger_count, snacks_done, free_meals, choices_free "
+            "FROM daily_rollups WHERE profile_id=1 AND date=?",
+            (sunday,),
+        )
+        week = await conn.execute_fetchall(
+            "SELECT hunger_sum, hunger_count, free_meals, choices_alternative "
+            "FROM weekly_rollups WHERE profile_id=1 AND week_start=?",
+            (monday.isoformat(),),
+        )
+    assert list(day[0]) == [3, 1, 1, 1, 1]
+    # domenica appartiene alla settimana ISO del lunedì precedente
+    assert list(week[0]) == [7, 2, 2, 1]
+    assert await repo.free_meals_used_in_week(1, sunday) == 2
+    assert await repo.free_meals_used_in_week(1, monday.isoformat()) == 2
+    next_week = (monday + timedelta(weeks=1)).isoformat()
+    assert await repo.free_meals_used_in_week(1, next_week) == 1
+
+    # cancellazioni dirette: i trigger sottraggono i contributi
+    await db.conn.execute("DELETE FROM free_meals WHERE date=?", (next_week,))
+    await db.conn.commit()
+    assert await repo.free_meals_used_in_week(1, next_week) == 0
+
+    incremental = await _snapshot(db)
+    await repo.rebuild_rollups()
+    assert await _snapshot(db) == incremental
+
+
+@pytest.mark.asyncio
+async def test_quota_lookup_is_single_row_read(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    start = date(2020, 1, 6)
+    # anni di storia: il lookup della quota non dipende dal numero di righe
+    await db.conn.executemany(
+        "INSERT INTO free_meals(profile_id,date,meal_type,notes,ts) VALUES (1,?,'dinner','',datetime('now'))",
+        [((start + timedelta(days=i)).isoformat(),) for i in range(0, 5 * 365, 3)],
+    )
+    await db.conn.commit()
+
+    async with db.read() as conn:
+        plan = await conn.execute_fetchall(
+            "EXPLAIN QUERY PLAN SELECT free_meals FROM weekly_rollups "
+            "WHERE profile_id=? AND week_start=date(?, 'weekday 0', '-6 days')",
+            (1, "2023-05-10"),
+        )
+    detail = " ".join(r[3] for r in plan)
+    assert "PRIMARY KEY" in detail and "SCAN" not in detail
+    assert await repo.free_meals_used_in_week(1, "2020-01-12") == 3
+
+
+@pytest.mark.asyncio
+async def test_rollup_update_triggers_skip_unrelated_columns(diet_db):
+    db, _ = diet_db
+    repo = DietRepo(db)
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.execute(
+        "INSERT INTO plan_days(profile_id,date,template_id,hunger,created_at,updated_at) "
+        "VALUES (1,'2025-03-03',1,4,datetime('now'),datetime('now'))"
+    )
+    await db.conn.commit()
+
+    # notes non entra nei rollup: solo la riga di plan_days cambia
+    before = db.conn.total_changes
+    await db.conn.execute(
+        "UPDATE plan_days SET notes='x' WHERE profile_id=1 AND date='2025-03-03'"
+    )
+    assert db.conn.total_changes - before == 1
+
+    # hunger sì: le righe giornaliera e settimanale vengono aggiornate dal trigger
+    before = db.conn.total_changes
+    await db.conn.execute(
+        "UPDATE plan_days SET hunger=2 WHERE profile_id=1 AND date='2025-03-03'"
+    )
+    assert db.conn.total_changes - before > 1
+    await db.conn.commit()
+    incremental = await _snapshot(db)
+    await repo.rebuild_rollups()
+    assert await _snapshot(db) == incremental
@@ -0,0 +1,93 @@
+import pytest
+from homeassistant.core import Context
+
+from custom_components.diet.repository import DietRepo
+from custom_components.diet.services import async_register_services
+
+
+async def _setup(hass, db, hass_admin_user) -> Context:
+    await async_register_services(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.execute(
+        "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+        "VALUES (1,0,'dinner',NULL,1,'free')"
+    )
+    await db.conn.commit()
+    return Context(user_id=hass_admin_user.id)
+
+
+@pytest.mark.asyncio
+async def test_write_services_return_state_read_in_transaction(hass, diet_db, hass_admin_user):
+    db, _ = diet_db
+    context = await _setup(hass, db, hass_admin_user)
+
+    response = await hass.services.async_call(
+        "diet",
+        "apply_week_template",
+        {"owner_profile_id": 1, "start_date": "2025-03-05"},
+        blocking=True,
+        context=context,
+        return_response=True,
+    )
+    assert [d["date"] for d in response["days"]][0] == "2025-03-03"
+    assert response["free_meals"] == [
+        {"week_start": "2025-03-03", "used": 1, "quota": 2, "remaining": 1}
+    ]
+
+    # nessuna lettura dal pool: lo stato arriva dal writer
+    statements: list[str] = []
+    for conn in db.readers:
+        await conn.set_trace_callback(statements.append)
+    response = await hass.services.async_call(
+        "diet",
+        "set_choice",
+        {"owner_profile_id": 1, "date": "2025-03-06", "meal_type": "lunch",
+            "source": "free", "title": "Pizza"},
+        blocking=True,
+        context=context,
+        return_response=True,
+    )
+    for conn in db.readers:
+        await conn.set_trace_callback(None)
+    assert not [s for s in statements if "day_meals" in s]
+    (day,) = response["days"]
+    lunch = next(m for m in day["meals"] if m["meal_type"] == "lunch")
+    assert lunch["chosen"]["title"] == "Pizza"
+    assert response["free_meals"][0]["remaining"] == 0
+    assert day == await DietRepo(db).get_day(1, "2025-03-06")
+
+    response = await hass.services.async_call(
+        "diet",
+        "set_day_bulk",
+        {"owner_profile_id": 1, "days": [
+            {"date": "2025-03-03", "hunger": 2},
+            {"date": "2025-03-10", "snacks": {"am": True}},
+        ]},
+        blocking=True,
+        context=context,
+        return_response=True,
+    )
+    (profile,) = response["profiles"]
+    assert profile["profile_id"] == 1
+    assert [d["hunger"] for d in profile["days"]] == [2, None]
+    assert [w["week_start"] for w in profile["free_meals"]] == ["2025-03-03", "2025-03-10"]
+
+    # senza risposta richiesta i servizi restano fire-and-forget
+    assert (
+        await hass.services.async_call(
+            "diet",
+            "set_hunger",
+            {"owner_profile_id": 1, "date": "2025-03-04", "score": 4},
+            blocking=True,
+            context=context,
+        )
+        is None
+    )
+    assert (await DietRepo(db).get_day(1, "2025-03-04"))["hunger"] == 4
@@ -128,21 +128,20 @@ async def test_ws_next_meals_minimal(hass, hass_ws_client, hass_admin_user, diet
     async with db.conn.execute("SELECT id FROM week_templates WHERE is_active=1") as c:
         tpl_id = (await c.fetchone())[0]
 
-    # Inserisci proposte per il dow odierno
-    from datetime import datetime as _dt
-    dow = _dt.today().weekday()
-    for meal_type, title in (("lunch", "Insalata di pollo"), ("dinner", "Salmone e patate")):
-        await db.conn.execute(
-            "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
-            "VALUES (?,?,?,?,?,?)",
-            (tpl_id, dow, meal_type, title, 1, "proposed"),
-        )
-    # Applica il template per questa settimana al profilo admin
+    # Inserisci proposte per ogni giorno della settimana
+    for dow in range(7):
+        for meal_type, title in (("lunch", "Insalata di pollo"), ("dinner", "Salmone e patate")):
+            await db.conn.execute(
+                "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+                "VALUES (?,?,?,?,?,?)",
+                (tpl_id, dow, meal_type, title, 1, "proposed"),
+            )
+    # Applica il template a questa settimana e alla successiva (l'orizzonte può scavalcare la domenica)
     from custom_components.diet.repository import DietRepo
 
     repo = DietRepo(db)
     monday = (date.today() - timedelta(days=date.today().weekday())).isoformat()
-    await repo.apply_week_template(pid_admin, monday, tpl_id)
+    await repo.apply_template_range(pid_admin, monday, tpl_id, 2)
 
     client = await hass_ws_client(hass)
     await client.send_json(
@@ -150,17 +149,312 @@ async def test_ws_next_meals_minimal(hass, hass_ws_client, hass_admin_user, diet
             "id": 10,
             "type": "diet/get_next_meals",
             "owner_profile_ids": [pid_admin],
-            "horizon_hours": 24,
+            "horizon_hours": 48,
         }
     )
     resp = await client.receive_json()
     assert resp["success"] is True
     payload = resp["result"]
     assert "profiles" in payload and len(payload["profiles"]) == 1
+    assert payload["profiles"][0]["display_name"] == "Admin"
     upcoming = payload["profiles"][0]["upcoming"]
-    # Dovremmo avere entries per lunch e dinner (planned, perchè non abbiamo marcato chosen)
+    # In 48 ore cadono almeno un pranzo e una cena (planned, perchè non abbiamo marcato chosen)
     types = {m["type"] for m in upcoming}
     assert {"lunch", "dinner"}.issubset(types)
     for m in upcoming:
         assert m["status"] in {"planned", "proposed",
                                "alternative", "free", "skipped"}
+
+
+@pytest.mark.asyncio
+async def test_ws_get_history_pages_with_cursor(hass, hass_ws_client, hass_admin_user, diet_db):
+    from custom_components.diet.repository import DietRepo
+
+    db, _ = diet_db
+    await async_register_ws(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.commit()
+    await DietRepo(db).apply_template_range(1, "2024-01-01", 1, 10)
+
+    client = await hass_ws_client(hass)
+    msg = {
+        "type": "diet/get_history",
+        "owner_profile_id": 1,
+        "start_date": "2024-01-01",
+        "end_date": "2024-12-31",
+        "page_size": 30,
+    }
+    dates, cursor, msg_id = [], None, 0
+    while True:
+        msg_id += 1
+        await client.send_json({**msg, "id": msg_id, "cursor": cursor})
+        resp = await client.receive_json()
+        assert resp["success"] is True
+        dates += [d["date"] for d in resp["result"]["days"]]
+        cursor = resp["result"]["next_cursor"]
+        if cursor is None:
+            break
+    assert msg_id == 3 and len(dates) == 70 and dates[-1] == "2024-03-10"
+
+    await client.send_json({**msg, "id": 10, "cursor": "non-una-data"})
+    resp = await client.receive_json()
+    assert resp["error"]["code"] == "invalid_format"
+
+    await client.send_json({**msg, "id": 11, "owner_profile_id": 99})
+    resp = await client.receive_json()
+    assert resp["error"]["code"] == "forbidden"
+
+
+@pytest.mark.asyncio
+async def test_ws_subscribe_week_pushes_only_changed_slots(hass, hass_ws_client, hass_admin_user, diet_db):
+    from homeassistant.helpers.dispatcher import async_dispatcher_send
+    from custom_components.diet.const import SIGNAL_DAY_CHANGED
+    from custom_components.diet.repository import DietRepo
+
+    db, _ = diet_db
+    await async_register_ws(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.execute(
+        "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+        "VALUES (1,1,'lunch','Riso',1,'proposed')"
+    )
+    await db.conn.commit()
+    repo = DietRepo(db)
+    await repo.apply_week_template(1, "2025-03-03", 1)
+
+    client = await hass_ws_client(hass)
+    await client.send_json(
+        {"id": 1, "type": "diet/subscribe_week", "owner_profile_id": 1, "start_date": "2025-03-05"}
+    )
+    resp = await client.receive_json()
+    assert resp["success"] is True
+    snapshot = await client.receive_json()
+    assert snapshot["event"]["type"] == "snapshot"
+    assert [d["date"] for d in snapshot["event"]["days"]][0] == "2025-03-03"
+
+    # scritture fuori dalla sottoscrizione: nessun push
+    await repo.set_snack(1, "2025-03-10", "am", True)
+    await repo.set_snack(2, "2025-03-04", "am", True)
+    # scrittura sottoscritta: solo lo slot cambiato
+    await repo.set_choice(1, "2025-03-04", "lunch", "alternative", "Farro")
+    event = (await client.receive_json())["event"]
+    assert event["type"] == "delta"
+    (change,) = event["changes"]
+    assert change["date"] == "2025-03-04"
+    assert set(change) == {"date", "meals"}
+    assert [m["meal_type"] for m in change["meals"]] == ["lunch"]
+    assert change["meals"][0]["chosen"]["title"] == "Farro"
+
+    await repo.set_snack(1, "2025-03-04", "pm", True)
+    await repo.set_hunger(1, "2025-03-04", 2)
+    await hass.async_block_till_done()
+    changes = []
+    while len(changes) < 2:
+        changes += (await client.receive_json())["event"]["changes"]
+    merged = {k: v for c in changes for k, v in c.items()}
+    assert merged["snacks"]["pm"]["done"] is True and merged["hunger"] == 2
+    assert "meals" not in merged
+
+    # una notifica senza modifiche effettive non genera push
+    async_dispatcher_send(hass, SIGNAL_DAY_CHANGED, 1, ("2025-03-04",))
+    await hass.async_block_till_done()
+
+    # cancellazione: il listener del dispatcher viene rimosso
+    await client.send_json({"id": 2, "type": "unsubscribe_events", "subscription": 1})
+    resp = await client.receive_json()
+    assert resp["id"] == 2 and resp["success"] is True
+    await repo.set_snack(1, "2025-03-04", "am", True)
+    await hass.async_block_till_done()
+
+    await client.send_json(
+        {"id": 3, "type": "diet/subscribe_day", "owner_profile_id": 99, "date": "2025-03-04"}
+    )
+    resp = await client.receive_json()
+    assert resp["id"] == 3 and resp["error"]["code"] == "forbidden"
+
+
+@pytest.mark.asyncio
+async def test_ws_batch_initial_load_in_one_round_trip(hass, hass_ws_client, hass_admin_user, diet_db):
+    db, _ = diet_db
+    await async_register_ws(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.commit()
+
+    weeks = ["2025-03-05", "2025-03-12", "2025-03-19"]
+    requests = [
+        {"type": "diet/get_capabilities"},
+        *({"type": "diet/get_week", "owner_profile_id": 1, "start_date": d} for d in weeks),
+        {"type": "diet/get_next_meals", "owner_profile_ids": [1]},
+        {"type": "diet/get_day", "owner_profile_id": 99, "date": "2025-03-05"},
+        {"type": "diet/get_week", "owner_profile_id": "uno"},
+        {"type": "diet/subscribe_week", "owner_profile_id": 1, "start_date": "2025-03-05"},
+        {"type": "diet/get_day", "owner_profile_id": 1, "date": "2025-02-30"},
+    ]
+    client = await hass_ws_client(hass)
+    await client.send_json({"id": 1, "type": "diet/batch", "requests": requests})
+    resp = await client.receive_json()
+    assert resp["success"] is True
+    results = resp["result"]["results"]
+    assert len(results) == len(requests)
+
+    # esiti nell'ordine delle sotto-richieste
+    assert results[0]["result"]["subject_profile_id"] == 1
+    assert [r["result"]["start"] for r in results[1:4]] == ["2025-03-03", "2025-03-10", "2025-03-17"]
+    assert results[4]["result"]["profiles"][0]["profile_id"] == 1
+    assert results[5] == {
+        "success": False,
+        "error": {"code": "forbidden", "message": "Permesso negato"},
+    }
+    assert results[6]["error"]["code"] == "invalid_format"
+    # le sottoscrizioni non sono multiplexabili
+    assert results[7]["error"]["code"] == "unknown_command"
+    # data malformata: stesso codice del comando singolo
+    assert results[8]["error"]["code"] == "invalid_format"
+    await client.send_json(
+        {"id": 2, "type": "diet/get_day", "owner_profile_id": 1, "date": "2025-02-30"}
+    )
+    resp = await client.receive_json()
+    assert resp["error"]["code"] == "invalid_format"
+
+    await client.send_json({"id": 3, "type": "diet/batch", "requests": []})
+    resp = await client.receive_json()
+    assert resp["error"]["code"] == "invalid_format"
+
+
+@pytest.mark.asyncio
+async def test_ws_get_week_and_day_not_modified(hass, hass_ws_client, hass_admin_user, diet_db):
+    from custom_components.diet.repository import DietRepo
+
+    db, _ = diet_db
+    await async_register_ws(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.commit()
+    week = {"type": "diet/get_week", "owner_profile_id": 1, "start_date": "2025-03-05"}
+
+    client = await hass_ws_client(hass)
+    await client.send_json({**week, "id": 1})
+    first = (await client.receive_json())["result"]
+    assert len(first["days"]) == 7 and first["not_modified"] is False
+
+    await client.send_json({**week, "id": 2, "versions": first["versions"]})
+    resp = (await client.receive_json())["result"]
+    assert resp["not_modified"] is True and resp["days"] == []
+
+    await DietRepo(db).set_hunger(1, "2025-03-06", 2)
+    await client.send_json({**week, "id": 3, "versions": first["versions"]})
+    resp = (await client.receive_json())["result"]
+    assert [d["date"] for d in resp["days"]] == ["2025-03-06"]
+
+    day = {"type": "diet/get_day", "owner_profile_id": 1, "date": "2025-03-06"}
+    await client.send_json({**day, "id": 4, "version": resp["versions"]["2025-03-06"]})
+    resp = (await client.receive_json())["result"]
+    assert resp == {"date": "2025-03-06", "version": resp["version"], "not_modified": True}
+    await client.send_json({**day, "id": 5, "version": first["versions"]["2025-03-06"]})
+    resp = (await client.receive_json())["result"]
+    assert "meals" in resp and resp["version"] > first["versions"]["2025-03-06"]
+
+
+@pytest.mark.asyncio
+async def test_ws_get_week_compact(hass, hass_ws_client, hass_admin_user, diet_db):
+    from custom_components.diet.repository import DietRepo
+
+    db, _ = diet_db
+    await async_register_ws(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.execute(
+        "INSERT INTO template_meals(template_id,dow,meal_type,title,required,default_source) "
+        "VALUES (1,1,'lunch','Riso',1,'proposed')"
+    )
+    await db.conn.commit()
+    await DietRepo(db).apply_week_template(1, "2025-03-03", 1)
+
+    client = await hass_ws_client(hass)
+    await client.send_json(
+        {"id": 1, "type": "diet/get_week", "owner_profile_id": 1,
+            "start_date": "2025-03-03", "compact": True}
+    )
+    result = (await client.receive_json())["result"]
+    assert result["templates"] == {"1": {"proposed": {"title": "Riso", "items": None}, "alternatives": []}}
+    tuesday = result["days"][1]
+    lunch = next(m for m in tuesday["meals"] if m["meal_type"] == "lunch")
+    assert lunch == {"meal_type": "lunch", "ref": 1, "chosen": None}
+    # lunedì pianificato ma senza slot né scelte
+    assert result["days"][0]["meals"] == []
+
+
+@pytest.mark.asyncio
+async def test_ws_set_day_bulk_authorizes_every_owner(hass, hass_ws_client, hass_admin_user, diet_db):
+    from custom_components.diet.repository import DietRepo
+
+    db, _ = diet_db
+    await async_register_ws(hass, db, coord=None)
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES(?,?,datetime('now'))",
+        (hass_admin_user.id, "Admin"),
+    )
+    await db.conn.execute(
+        "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) VALUES('user-other','Altro',datetime('now'))"
+    )
+    await db.conn.commit()
+    repo = DietRepo(db)
+    days = [
+        {"date": "2025-03-03", "hunger": 2, "snacks": {"am": True},
+            "choices": [{"meal_type": "lunch", "source": "alternative", "title": "Farro"}]},
+        {"date": "2025-03-04", "snacks": {"am": True, "pm": False}},
+    ]
+    await db.conn.execute(
+        "INSERT INTO week_templates(profile_id,name,description,is_active,created_at,updated_at) "
+        "VALUES (NULL,'Condiviso','Base',1,datetime('now'),datetime('now'))"
+    )
+    await db.conn.commit()
+    await repo.apply_week_template(1, "2025-03-03", 1)
+
+    client = await hass_ws_client(hass)
+    # un giorno di un profilo senza permesso di scrittura: niente viene scritto
+    await client.send_json(
+        {"id": 1, "type": "diet/set_day_bulk", "owner_profile_id": 1,
+            "days": [*days, {"owner_profile_id": 2, "date": "2025-03-05", "hunger": 1}]}
+    )
+    resp = await client.receive_json()
+    assert resp["error"]["code"] == "forbidden"
+    assert (await repo.get_day(1, "2025-03-03"))["hunger"] is None
+
+    await client.send_json({"id": 2, "type": "diet/set_day_bulk", "owner_profile_id": 1, "days": days})
+    resp = await client.receive_json()
+    assert resp["success"] is True and resp["result"] == {"written": 5}
+    async with db.conn.execute(
+        "SELECT chosen_title FROM day_meals WHERE profile_id=1 AND date='2025-03-03'"
+    ) as c:
+        assert [r[0] async for r in c] == ["Farro"]
+    assert (await repo.get_day(1, "2025-03-03"))["hunger"] == 2
+
+    await client.send_json({"id": 3, "type": "diet/set_choices_bulk", "owner_profile_id": 1, "entries": []})
+    resp = await client.receive_json()
+    assert resp["error"]["code"] == "invalid_format"
@@ -0,0 +1,124 @@
+import asyncio
+import time
+import pytest
+from datetime import date, timedelta
+
+from custom_components.diet.repository import DietRepo
+
+
+@pytest.mark.asyncio
+async def test_group_commit_isolates_failing_job(diet_db):
+    db, _ = diet_db
+    db.write_batch_window = 0.02
+    commits_before = db.write_stats["commits"]
+
+    def _ok(name):
+        async def _job(conn):
+            cur = await conn.execute(
+                "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) "
+                "VALUES(?,?,datetime('now'))",
+                (name, name),
+            )
+            return cur.lastrowid
+
+        return _job
+
+    async def _boom(conn):
+        await conn.execute(
+            "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) "
+            "VALUES('user-x','X',datetime('now'))"
+        )
+        raise ValueError("boom")
+
+    res = await asyncio.gather(
+        db.async_write(_ok("user-1")),
+        db.async_write(_boom),
+        db.async_write(_ok("user-2")),
+        return_exceptions=True,
+    )
+
+    assert isinstance(res[0], int) and isinstance(res[2], int)
+    assert isinstance(res[1], ValueError)
+    # un solo commit per l'intero gruppo
+    assert db.write_stats["commits"] - commits_before == 1
+
+    async with db.read() as conn:
+        async with conn.execute(
+            "SELECT ha_user_id FROM diet_profiles ORDER BY id"
+        ) as c:
+            assert [r[0] async for r in c] == ["user-1", "user-2"]
+
+
+@pytest.mark.parametrize("window", [0.02, None])
+@pytest.mark.asyncio
+async def test_group_commit_fails_every_job_when_transaction_breaks(diet_db, window):
+    db, _ = diet_db
+    db.write_batch_window = window
+    failed_before = db.write_stats["failed"]
+
+    async def _ok(conn):
+        await conn.execute(
+            "INSERT INTO diet_profiles(ha_user_id,display_name,created_at) "
+            "VALUES(hex(randomblob(8)),'Diego',datetime('now'))"
+        )
+
+    async def _commits(conn):
+        # chiude la transazione del gruppo: il RELEASE successivo fallisce
+        await conn.commit()
+
+    jobs = [_ok, _commits, _ok] if window else [_commits]
+    res = await asyncio.wait_for(
+        asyncio.gather(*(db.async_write(j) for j in jobs), return_exceptions=True),
+        timeout=5,
+    )
+    assert all(isinstance(r, Exception) for r in res)
+    assert db.write_stats["failed"] - failed_before == len(jobs)
+
+    # il writer resta utilizzabile
+    await db.async_write(_ok)
+
+
+async def _burst(db, repo, n: int, offset: int) -> tuple[int, float]:
+    start = date(2025, 1, 1) + timedelta(days=offset)
+    commits = db.write_stats["commits"]
+    t0 = time.perf_counter()
+    await asyncio.gather(
+        *(
+            repo.set_snack(
+                1,
+                (start + timedelta(days=i // 2)).isoformat(),
+                ("am", "pm")[i % 2],
+                True,
+            )
+            for i in range(n)
+        )
+    )
+    return db.write_stats["commits"] - commits, time.perf_counter() - t0
+
+
+@pytest.mark.asyncio
+async def test_benchmark_commits_per_second(diet_db):
+    """Benchmark: raffica di set_snack con e senza group commit."""
+    db, _ = diet_db
+    repo = DietRepo(db)
+    n = 200
+
+    db.write_batch_window = None
+    commits_single, t_single = await _burst(db, repo, n, 0)
+
+    db.write_batch_window = 0.005
+    commits_batched, t_batched = await _burst(db, repo, n, 1000)
+
+    print(
+        f"\nsenza batching: {n} scritture, {commits_single} commit, "
+        f"{commits_single / t_single:.0f} commit/s, {n / t_single:.0f} scritture/s"
+        f"\ncon batching:   {n} scritture, {commits_batched} commit, "
+        f"{commits_batched / t_batched:.0f} commit/s, {n / t_batched:.0f} scritture/s"
+    )
+
+    assert commits_single == n
+    assert commits_batched < commits_single
+
+    async with db.read() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM snacks WHERE done=1") as c:
+            assert (await c.fetchone())[0] == 2 * n